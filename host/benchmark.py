@@ -0,0 +1,199 @@
+# benchmarks for the sampling, detection, publish, persistence and display paths
+#
+# each benchmark calls the real sleep2mqtt.py code on the simulated hardware
+# from simulator.py and reports per-iteration latency percentiles and bytes
+# allocated per iteration. a simulated night adds sd card and mqtt traffic per
+# hour. results are JSON so runs from two versions can be compared:
+#
+#   python host/benchmark.py --output before.json
+#   python host/benchmark.py --compare before.json
+import argparse
+import array
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import simulator
+import utime
+
+import kernels
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def boot(config, seconds=120):
+    # run main() long enough to set everything up, then stop the clock
+    sim = simulator.Simulation(config)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.run(seconds)
+    utime.end = None
+    return sim
+
+
+def measure(name, run, prepare=None, iterations=1000):
+    # time run() on its own, then run it again under tracemalloc for allocations
+    # prepare() is called before each iteration and isn't counted
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(iterations):
+            if prepare is not None:
+                prepare()
+            start = time.perf_counter_ns()
+            run()
+            times.append(time.perf_counter_ns() - start)
+
+        allocated = []
+        retained = []
+        tracemalloc.start()
+        for i in range(max(iterations // 10, 10)):
+            if prepare is not None:
+                prepare()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            run()
+            current, peak = tracemalloc.get_traced_memory()
+            allocated.append(peak - before)
+            retained.append(current - before)
+        tracemalloc.stop()
+
+    return {
+        "name": name,
+        "iterations": iterations,
+        "p50_us": percentile(times, 50) / 1000,
+        "p90_us": percentile(times, 90) / 1000,
+        "p99_us": percentile(times, 99) / 1000,
+        "max_us": max(times) / 1000,
+        "mean_us": sum(times) / len(times) / 1000,
+        "alloc_bytes_p50": percentile(allocated, 50),
+        "alloc_bytes_max": max(allocated),
+        "retained_bytes_mean": sum(retained) / len(retained)
+        }
+
+
+def benchmarks(iterations):
+    config = simulator.load_config()
+    config['settings']['m5stack'] = True
+    sim = boot(config)
+    app = sim.app
+    sensor = app.BedSensor.sensors()[0]
+
+    def tick():
+        # one second of device time so the traces move
+        utime.advance(1)
+
+    def next_reading():
+        tick()
+        sensor.read()
+
+    def dirty():
+        app.BedSensor.store.mark(sensor)
+
+    results = [
+        measure('read', sensor.read, tick, iterations),
+        measure('update_mqtt_attributes', lambda: app.update_mqtt_attributes(sensor), tick, iterations),
+        measure('publish_config_mqtt', app.publish_config_mqtt, None, iterations),
+        measure('save_state', lambda: app.BedSensor.store.flush(force=True), dirty, iterations),
+        measure('update_screen', app.update_screen, next_reading, iterations),
+        ]
+    sim.close()
+    return results
+
+
+def kernel_benchmarks(iterations):
+    # each per-reading kernel on its own, kernels.benchmark() times them on the device
+    values = array.array('i', [5000] * 10)
+    read = lambda: 2000
+    return [
+        measure('kernels.adc_total', lambda: kernels.adc_total(read, 10), None, iterations),
+        measure('kernels.pressure', lambda: kernels.pressure(20000, 10), None, iterations),
+        measure('kernels.pressure_fixed', lambda: kernels.pressure_fixed(20000, 10), None, iterations),
+        measure('kernels.crossing', lambda: kernels.crossing(5100, 5000, 50), None, iterations),
+        measure('kernels.movement', lambda: kernels.movement(5100, 5000, 5050), None, iterations),
+        measure('kernels.ring_fill', lambda: kernels.ring_fill(values, 7, 5000, 5), None, iterations),
+        ]
+
+
+def traffic(hours):
+    # sd card and mqtt traffic over a simulated night with people getting in and out
+    sim = simulator.Simulation(simulator.load_config())
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.run(hours * 3600)
+    summary = sim.summary()
+    latency = [t for name in sim.config['sensors'] for t in sim.latency(name) if t is not None]
+    sim.close()
+    return {
+        "hours": hours,
+        "adc_reads_per_hour": summary['adc_reads_per_hour'],
+        "detect_latency_mean_s": sum(latency) / len(latency) if latency else None,
+        "detect_latency_max_s": max(latency) if latency else None,
+        "sd_bytes_per_hour": summary['sd_bytes_per_hour'],
+        "mqtt_messages_per_hour": summary['mqtt_messages_per_hour'],
+        "mqtt_bytes_per_hour": summary['mqtt_bytes'] / hours,
+        "reboots": summary['reboots']
+        }
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=simulator.ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    # print new/old ratios for every shared number, below 1.0 is better
+    old_runs = {b['name']: b for b in old['benchmarks']}
+    for bench in new['benchmarks']:
+        before = old_runs.get(bench['name'])
+        if before is None:
+            continue
+        for key in ('p50_us', 'p99_us', 'alloc_bytes_p50'):
+            if before[key]:
+                print('{:<24} {:<16} {:>10.2f} -> {:>10.2f}  x{:.2f}'.format(
+                    bench['name'], key, before[key], bench[key], bench[key] / before[key]))
+    for key, value in new['traffic'].items():
+        if key in old['traffic'] and old['traffic'][key]:
+            print('{:<24} {:<16} {:>10.2f} -> {:>10.2f}  x{:.2f}'.format(
+                'traffic', key[:16], old['traffic'][key], value, value / old['traffic'][key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark sleep2mqtt.py on simulated hardware')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--hours', type=float, default=8, help='simulated night for traffic numbers')
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--compare', help='earlier results to compare against')
+    args = parser.parse_args()
+
+    results = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "benchmarks": benchmarks(args.iterations) + kernel_benchmarks(args.iterations),
+        "traffic": traffic(args.hours)
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif not args.compare:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
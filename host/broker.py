@@ -0,0 +1,239 @@
+# in-process MQTT 3.1.1 broker stand-in
+#
+# enough of the protocol for sleep2mqtt and the host tools: CONNECT, SUBSCRIBE,
+# PUBLISH at QoS 0/1 with retained messages, PUBACK, PINGREQ and DISCONNECT.
+# the usocket stub talks to it directly, and serve() exposes it over TCP for
+# tools that use a real socket
+import asyncio
+import struct
+
+import utime
+
+# (host, port) -> Broker, looked up by the usocket stub
+BROKERS = {}
+
+
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != '+' and part != topic_parts[i]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def publish_packet(topic, payload, retain=False, qos=0, pid=0):
+    topic = topic.encode() if isinstance(topic, str) else topic
+    body = struct.pack('!H', len(topic)) + topic
+    if qos:
+        body += struct.pack('!H', pid)
+    body += payload
+    return bytes([0x30 | qos << 1 | retain]) + encode_length(len(body)) + body
+
+
+class Session():
+    def __init__(self, broker):
+        self.broker = broker
+        self.from_client = bytearray()
+        self.to_client = bytearray()
+        self.subscriptions = []
+        self.client_id = None
+        self.closed = False
+        self.writer = None
+        self.pid = 0
+
+    def send(self, data):
+        if self.closed:
+            return
+        if self.writer is not None:
+            self.writer.write(data)
+        else:
+            self.to_client += data
+
+    def close(self):
+        self.closed = True
+        if self in self.broker.sessions:
+            self.broker.sessions.remove(self)
+
+    def feed(self, data):
+        # buffer bytes from the client and handle every complete packet
+        if self.broker.stall == 'silent':
+            return
+        self.from_client += data
+        while True:
+            packet = self.take_packet()
+            if packet is None:
+                return
+            self.handle(*packet)
+
+    def take_packet(self):
+        buf = self.from_client
+        if len(buf) < 2:
+            return None
+        length = 0
+        shift = 0
+        i = 1
+        while True:
+            if i >= len(buf):
+                return None
+            byte = buf[i]
+            length |= (byte & 0x7f) << shift
+            i += 1
+            if not byte & 0x80:
+                break
+            shift += 7
+        if len(buf) < i + length:
+            return None
+        first = buf[0]
+        body = bytes(buf[i:i + length])
+        del buf[:i + length]
+        return first, body
+
+    def handle(self, first, body):
+        kind = first & 0xf0
+        broker = self.broker
+        broker.packets += 1
+        if kind == 0x10:
+            # CONNECT: protocol name, level, flags, keepalive, then the client id
+            name_len = struct.unpack('!H', body[:2])[0]
+            offset = 2 + name_len + 4
+            id_len = struct.unpack('!H', body[offset:offset + 2])[0]
+            self.client_id = body[offset + 2:offset + 2 + id_len].decode()
+            broker.connects += 1
+            self.send(b'\x20\x02\x00\x00')
+        elif kind == 0x80:
+            # SUBSCRIBE
+            pid = body[:2]
+            offset = 2
+            filters = []
+            while offset < len(body):
+                topic_len = struct.unpack('!H', body[offset:offset + 2])[0]
+                filters.append(body[offset + 2:offset + 2 + topic_len].decode())
+                offset += 2 + topic_len + 1
+            self.subscriptions += filters
+            self.send(bytes([0x90, 2 + len(filters)]) + pid + bytes(len(filters)))
+            # retained messages go to new subscribers
+            for topic, payload in list(broker.retained.items()):
+                if any(topic_matches(f, topic) for f in filters):
+                    self.send(publish_packet(topic, payload, retain=True))
+        elif kind == 0x30:
+            qos = (first >> 1) & 3
+            retain = first & 1
+            topic_len = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + topic_len].decode()
+            offset = 2 + topic_len
+            if qos:
+                pid = body[offset:offset + 2]
+                offset += 2
+            broker.publish(topic, body[offset:], retain, sender=self, qos=qos, dup=bool(first & 8))
+            if qos == 1:
+                if broker.lose_acks:
+                    broker.lose_acks -= 1
+                else:
+                    self.send(b'\x40\x02' + pid)
+        elif kind == 0x40:
+            # PUBACK for something we delivered at QoS 1
+            pass
+        elif kind == 0xc0:
+            broker.pings += 1
+            self.send(b'\xd0\x00')
+        elif kind == 0xe0:
+            self.close()
+
+
+class Broker():
+    '''
+    in-process broker. every publish is recorded in messages as
+    (seconds since boot, topic, payload, retain, qos) for the harness to inspect
+    '''
+    def __init__(self, address=('10.0.0.10', 1883)):
+        self.address = tuple(address)
+        BROKERS[self.address] = self
+        self.up = True
+        self.sessions = []
+        self.retained = {}
+        self.messages = []
+        self.listeners = []
+        self.connects = 0
+        self.packets = 0
+        self.pings = 0
+        self.bytes = 0
+        self.duplicates = 0
+        # PUBACKs to leave out, for testing retransmission
+        self.lose_acks = 0
+        # 'connect' never answers a connection attempt, 'silent' accepts the
+        # connection but never answers a packet, like a hung broker, and 'full'
+        # stops reading too, so the client's writes wait on a full send buffer
+        self.stall = None
+
+    def accept(self):
+        if not self.up:
+            raise OSError(111)  # ECONNREFUSED
+        session = Session(self)
+        self.sessions.append(session)
+        return session
+
+    def stop(self):
+        # drop every connection and refuse new ones
+        self.up = False
+        for session in list(self.sessions):
+            session.close()
+
+    def start(self):
+        self.up = True
+
+    def publish(self, topic, payload, retain=False, sender=None, qos=0, dup=False):
+        payload = payload.encode() if isinstance(payload, str) else bytes(payload)
+        self.messages.append((utime.now, topic, payload, bool(retain), qos))
+        self.bytes += len(topic) + len(payload)
+        if dup:
+            self.duplicates += 1
+        if retain:
+            self.retained[topic] = payload
+        for session in list(self.sessions):
+            if session is sender:
+                continue
+            for topic_filter in session.subscriptions:
+                if topic_matches(topic_filter, topic):
+                    session.send(publish_packet(topic, payload))
+                    break
+        for listener in self.listeners:
+            listener(topic, payload)
+
+    def topic(self, topic):
+        # every payload published to topic, oldest first
+        return [m for m in self.messages if m[1] == topic]
+
+    async def serve(self, host='127.0.0.1', port=1883):
+        # accept real TCP clients alongside the in-process ones
+        async def client(reader, writer):
+            session = self.accept()
+            session.writer = writer
+            try:
+                while not session.closed:
+                    data = await reader.read(4096)
+                    if not data:
+                        break
+                    session.feed(data)
+                    await writer.drain()
+            finally:
+                session.close()
+                writer.close()
+
+        return await asyncio.start_server(client, host, port)
@@ -0,0 +1,475 @@
+# pick ideal_pressure, delta and state_sensitivity from recorded nights
+#
+# runs BedSensor's adaptive on/off detection, with the device's read cadence,
+# over recorded pressure traces for a whole grid of settings at once. every
+# setting is one lane of a set of NumPy arrays, so each reading costs the same
+# handful of array operations however big the grid is, and the grid is split
+# across a process pool. each night is a trace (seconds,pressure rows, as
+# rawstream.py records them) and the real in/out times (seconds,in|out rows).
+# the best settings come out in config.json's format
+#
+#   python host/calibrate.py --night Bert=night1/bed001-Bert.csv,night1/bert-events.csv
+#   python host/calibrate.py --night Bert=... --night Ernie=... --config config.json --output tuned.json
+#   python host/calibrate.py --check
+#
+# needs NumPy
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+if HOST not in sys.path:
+    sys.path.insert(0, HOST)
+
+# the device's Cadence defaults
+BASE_MS = 1000
+NEAR = 0.25
+HOLD_MS = 5000
+
+EVENT_NAMES = {'in': True, 'on': True, '1': True, 'true': True,
+               'out': False, 'off': False, '0': False, 'false': False}
+
+
+class Detector():
+    '''
+    BedSensor.adaptive_state and the device's Cadence for many settings at
+    once, one lane of every array per setting. every push puts one reading in
+    each of a lane's two histories, so both share a head and the readings of
+    all lanes live in one flat array per history (0 = off, 1 = on)
+        Parameters:
+            ideal_pressure = array of ideal_pressure settings, one per lane
+            delta = array of delta settings, one per lane
+            sensitivity = array of state_sensitivity settings, one per lane
+            history_size = readings in the on/off sliding averages
+            occupied = whether the bed is occupied when the trace starts
+    '''
+    def __init__(self, ideal_pressure, delta, sensitivity, history_size=10, occupied=False):
+        n = len(delta)
+        size = history_size
+        self.n = n
+        self.size = size
+        self.lanes = np.arange(n)
+        self.delta = np.asarray(delta, dtype=np.float64)
+        self.threshold = self.delta * (10 - np.asarray(sensitivity, dtype=np.float64)) / 10
+        self.near = self.threshold * NEAR
+        self.state = np.full(n, bool(occupied))
+        # seeded like BedSensor.create_history: off at ideal - delta, on at ideal
+        seed = np.concatenate([ideal_pressure - self.delta,
+                               np.asarray(ideal_pressure, dtype=np.float64)])
+        # readings are float32 like History's array('f'), sums are doubles
+        self.values = np.repeat(seed.astype(np.float32), size).reshape(2, n * size)
+        self.totals = (seed.astype(np.float32).astype(np.float64) * size).reshape(2, n)
+        self.avgs = seed.reshape(2, n)
+        self.heads = np.zeros(n, dtype=np.int64)
+        self.base = self.lanes * size
+        self.last = None
+        self.pushed = None
+        self.active = np.zeros(n, dtype=bool)
+        self.onset = np.zeros(n, dtype=np.int64)
+        self.active_at = np.zeros(n, dtype=np.int64)
+        self.changes = np.zeros(n, dtype=np.int64)
+
+    def push(self, off, on, lanes=None):
+        # History.push on both histories of the given lanes, all of them by default
+        size = self.size
+        if lanes is None:
+            heads = self.heads
+            index = self.base + heads
+        else:
+            heads = self.heads[lanes]
+            index = self.base[lanes] + heads
+        for ring, values in ((0, off), (1, on)):
+            if lanes is None:
+                self.totals[ring] += values - self.values[ring].take(index)
+            else:
+                self.totals[ring][lanes] += values - self.values[ring].take(index)
+            self.values[ring].put(index, values)
+        heads += 1
+        wrapped = heads == size
+        if wrapped.any():
+            # re-sum once per lap like History.push
+            heads[wrapped] = 0
+            laps = self.lanes[lanes][wrapped] if lanes is not None else self.lanes[wrapped]
+            for ring in (0, 1):
+                self.totals[ring][laps] = self.values[ring].reshape(-1, size)[laps].sum(
+                    axis=1, dtype=np.float64)
+        if lanes is None:
+            np.divide(self.totals, size, out=self.avgs)
+        else:
+            self.heads[lanes] = heads
+            self.avgs[:, lanes] = self.totals[:, lanes] / size
+
+    def step(self, t, value):
+        # one reading at device time t ms, returns the lanes that changed state
+        n = self.n
+        if self.pushed is None:
+            self.pushed = np.full(n, t, dtype=np.int64)
+            self.last = value
+        state = self.state
+        avg = np.where(state, self.avgs[1], self.avgs[0])
+        change = np.abs(avg - value)
+        changed = (change > self.threshold) & ((value > avg) != state)
+
+        # Cadence.update: activity near the threshold or a moving reading
+        active = np.maximum(change, abs(value - self.last)) >= self.near
+        self.onset[active & ~self.active] = t
+        self.active |= active
+        self.active_at[active] = t
+        self.active &= (t - self.active_at) <= HOLD_MS
+
+        # Cadence.pushes: whole base periods since the last push, none while activity is new
+        held = self.active & ((t - self.onset) < HOLD_MS)
+        pushes = np.maximum((t - self.pushed + BASE_MS // 2) // BASE_MS, 0)
+        pushes[held] = 0
+        self.pushed += pushes * BASE_MS
+        np.minimum(pushes, self.size, out=pushes)
+
+        if changed.any():
+            # a transition goes into the histories once and restarts the base period
+            self.state = state = state ^ changed
+            pushes[changed] = 1
+            self.pushed[changed] = t
+            self.active &= ~changed
+            self.changes += changed
+
+        # the reading goes to the current state's history, the delta to the other
+        off = np.where(state, value - self.delta, value)
+        on = np.where(state, value, value + self.delta)
+        for i in range(int(pushes.max(initial=0))):
+            lanes = pushes > i
+            if lanes.all():
+                self.push(off, on)
+            else:
+                self.push(off[lanes], on[lanes], np.flatnonzero(lanes))
+        self.last = value
+        return changed
+
+
+def load_trace(path):
+    # seconds and pressure arrays from seconds,pressure rows, a header row is skipped
+    times = []
+    values = []
+    with open(path) as f:
+        for line in f:
+            parts = line.strip().split(',')
+            try:
+                t, p = float(parts[0]), float(parts[1])
+            except (ValueError, IndexError):
+                continue
+            times.append(t)
+            values.append(p)
+    if not times:
+        raise ValueError('no seconds,pressure rows in {}'.format(path))
+    return np.array(times), np.array(values)
+
+
+def load_events(path):
+    # [(seconds, occupied)] from seconds,in|out rows
+    events = []
+    with open(path) as f:
+        for line in f:
+            parts = [p.strip().lower() for p in line.split(',')]
+            if len(parts) < 2 or parts[1] not in EVENT_NAMES:
+                continue
+            try:
+                events.append((float(parts[0]), EVENT_NAMES[parts[1]]))
+            except ValueError:
+                continue
+    return sorted(events)
+
+
+def resample(times, values, rate):
+    # readings every 1/rate seconds, each the latest recorded value, as ms ticks
+    t = np.arange(times[0], times[-1], 1 / rate)
+    index = np.maximum(np.searchsorted(times, t, side='right') - 1, 0)
+    return np.round(t * 1000).astype(np.int64), values[index]
+
+
+class Night():
+    '''
+    one recorded night for one sensor
+        Parameters:
+            sensor = sensor name in config.json
+            times, values = recorded seconds and pressures
+            events = [(seconds, occupied)] of the real in/out times
+    '''
+    def __init__(self, sensor, times, values, events):
+        self.sensor = sensor
+        self.times = times
+        self.values = values
+        self.events = events
+        # occupied at the start if the first event is getting out
+        self.occupied = bool(events) and not events[0][1]
+
+    def levels(self, settle=30):
+        # median pressure while vacant and while occupied, away from the events
+        occupied = np.full(len(self.times), self.occupied)
+        near = np.zeros(len(self.times), dtype=bool)
+        for t, state in self.events:
+            occupied[self.times >= t] = state
+            near |= np.abs(self.times - t) < settle
+        vacant = self.values[~occupied & ~near]
+        taken = self.values[occupied & ~near]
+        if not len(vacant) or not len(taken):
+            raise ValueError('{} needs time both in and out of bed'.format(self.sensor))
+        return float(np.median(vacant)), float(np.median(taken))
+
+
+def run(night, ideal, delta, sensitivity, history_size, rate, slack, window):
+    # one night over one chunk of the grid: changes per lane, and for each event
+    # the ms of the first matching change in its window, -1 where there was none
+    ticks, values = resample(night.times, night.values, rate)
+    detector = Detector(ideal, delta, sensitivity, history_size, night.occupied)
+    events = [(int(round(t * 1000)), occupied) for t, occupied in night.events]
+    first = np.full((len(events), len(delta)), -1, dtype=np.int64)
+    start = ticks[0]
+    for t, value in zip(ticks.tolist(), values.tolist()):
+        changed = detector.step(t, value)
+        if not changed.any():
+            continue
+        for e, (at, occupied) in enumerate(events):
+            if at - slack <= t <= at + window:
+                hit = changed & (detector.state == occupied) & (first[e] < 0)
+                first[e][hit] = t - at
+    return detector.changes, first
+
+
+def grid(spec, default):
+    # START:STOP[:STEP], inclusive, or the default range
+    if spec is None:
+        return default
+    parts = [float(p) for p in spec.split(':')]
+    step = parts[2] if len(parts) > 2 else 1
+    return np.arange(parts[0], parts[1] + step / 2, step)
+
+
+def search(nights, args, history_sizes):
+    # every night of a sensor over that sensor's grid, chunked across a process pool
+    grids = {}
+    for sensor in sorted({night.sensor for night in nights}):
+        vacant, occupied = zip(*(night.levels() for night in nights if night.sensor == sensor))
+        vacant, occupied = np.median(vacant), np.median(occupied)
+        step = max(1, round((occupied - vacant) / 20))
+        ideal = grid(args.ideal, np.arange(round(occupied) - 5, round(occupied) + 6, 1))
+        delta = grid(args.delta, np.arange(max(step, round((occupied - vacant) * 0.5)),
+                                           round((occupied - vacant) * 1.5) + 1, step))
+        sensitivity = grid(args.sensitivity, np.arange(1, 10))
+        i, d, s = np.meshgrid(ideal, delta, sensitivity, indexing='ij')
+        grids[sensor] = (i.ravel(), d.ravel(), s.ravel(), occupied)
+
+    jobs = []
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        for night in nights:
+            ideal, delta, sensitivity, occupied = grids[night.sensor]
+            # by default every worker gets a share of each night
+            size = args.chunk or -(-len(delta) // (args.workers or os.cpu_count() or 1))
+            for start in range(0, len(delta), size):
+                chunk = slice(start, start + size)
+                jobs.append((night, chunk, pool.submit(
+                    run, night, ideal[chunk], delta[chunk], sensitivity[chunk],
+                    history_sizes.get(night.sensor, 10), args.rate,
+                    args.slack * 1000, args.window * 1000)))
+
+        results = {}
+        for sensor, (ideal, delta, sensitivity, occupied) in grids.items():
+            n = len(delta)
+            results[sensor] = {
+                "ideal_pressure": ideal, "delta": delta, "state_sensitivity": sensitivity,
+                "threshold": delta * (10 - sensitivity) / 10, "occupied": occupied, "rate": args.rate,
+                "changes": np.zeros(n, dtype=np.int64), "found": np.zeros(n, dtype=np.int64),
+                "events": 0, "latency": np.zeros(n), "latency_max": np.zeros(n)
+                }
+        counted = set()
+        for night, chunk, job in jobs:
+            changes, first = job.result()
+            result = results[night.sensor]
+            result['changes'][chunk] += changes
+            found = first >= 0
+            result['found'][chunk] += found.sum(axis=0)
+            latency = np.where(found, first, 0) / 1000
+            result['latency'][chunk] += latency.sum(axis=0)
+            result['latency_max'][chunk] = np.maximum(result['latency_max'][chunk], latency.max(axis=0, initial=0))
+            if id(night) not in counted:
+                counted.add(id(night))
+                result['events'] += len(night.events)
+
+    for result in results.values():
+        result['missed'] = result['events'] - result['found']
+        result['false'] = result['changes'] - result['found']
+        result['errors'] = result['missed'] + result['false']
+        result['latency'] = result['latency'] / np.maximum(result['found'], 1)
+    return results
+
+
+def ranked(result, lanes=None):
+    # fewest missed and false changes, then lowest latency to within a reading,
+    # then the biggest threshold for the most margin against noise, then the
+    # ideal pressure closest to what the traces show while occupied
+    if lanes is None:
+        lanes = np.arange(len(result['delta']))
+    order = np.lexsort((
+        np.abs(result['ideal_pressure'][lanes] - result['occupied']),
+        -result['threshold'][lanes],
+        np.round(result['latency'][lanes] * result['rate']),
+        result['errors'][lanes]))
+    return lanes[order]
+
+
+def best(results):
+    # state_sensitivity is shared by every sensor, so take the one whose best
+    # settings for each sensor add up to the fewest errors, lowest latency and
+    # most margin, in that order
+    scores = []
+    for s in np.unique(next(iter(results.values()))['state_sensitivity']):
+        picks = {}
+        errors = 0
+        latency = 0
+        margin = 0.0
+        for sensor, result in results.items():
+            lane = ranked(result, np.flatnonzero(result['state_sensitivity'] == s))[0]
+            picks[sensor] = lane
+            errors += result['errors'][lane]
+            latency += round(result['latency'][lane] * result['rate'])
+            margin += result['threshold'][lane]
+        scores.append((errors, latency, -margin, float(s), picks))
+    scores.sort(key=lambda score: score[:4])
+    errors, latency, margin, s, picks = scores[0]
+    return s, picks
+
+
+def report(results, top):
+    for sensor, result in results.items():
+        order = ranked(result)[:top]
+        print('{}: {} events, {} settings'.format(sensor, result['events'], len(result['delta'])))
+        print('  {:>8} {:>6} {:>11} {:>6} {:>6} {:>9} {:>9}'.format(
+            'ideal', 'delta', 'sensitivity', 'missed', 'false', 'latency', 'max'))
+        for lane in order:
+            print('  {:>8g} {:>6g} {:>11g} {:>6} {:>6} {:>8.1f}s {:>8.1f}s'.format(
+                result['ideal_pressure'][lane], result['delta'][lane], result['state_sensitivity'][lane],
+                result['missed'][lane], result['false'][lane], result['latency'][lane],
+                result['latency_max'][lane]))
+
+
+def settings(results, config=None):
+    # the best settings in config.json's format, merged into config when given
+    sensitivity, picks = best(results)
+    out = config if config is not None else {"settings": {}, "sensors": {}}
+    out['settings']['state_sensitivity'] = int(sensitivity)
+    for sensor, lane in picks.items():
+        entry = out['sensors'].setdefault(sensor, {})
+        entry['ideal_pressure'] = number(results[sensor]['ideal_pressure'][lane])
+        entry['delta'] = number(results[sensor]['delta'][lane])
+    return out
+
+
+def number(value):
+    # whole numbers stay ints like the rest of config.json
+    value = round(float(value), 2)
+    return int(value) if value.is_integer() else value
+
+
+def check(hours=8):
+    # compare random lanes against fleet.Streams.step_at, which matches the
+    # device read for read, then calibrate on the simulator's synthetic night
+    import fleet
+    import rawstream
+    import simulator
+
+    trace = simulator.synthetic_trace(off=40, delta=30, seed=1)
+    times = np.arange(0, hours * 3600, 0.5)
+    values = np.array([trace(t) for t in times])
+    events = sorted([(t, True) for t, _ in simulator.NIGHT] + [(t, False) for _, t in simulator.NIGHT])
+    night = Night('Bert', times, values, events)
+
+    rng = np.random.default_rng(0)
+    lanes = 64
+    ideal = rng.uniform(55, 85, lanes).round()
+    delta = rng.uniform(10, 45, lanes).round()
+    sensitivity = rng.integers(1, 10, lanes)
+    ticks, readings = resample(times, values, 1)
+    expected = []
+    for lane in range(lanes):
+        streams = fleet.Streams(sensitivity=int(sensitivity[lane]))
+        streams.add(lane, float(delta[lane]), float(ideal[lane]))
+        streams.pushed[0] = ticks[0]
+        expected.append([t for t, value in zip(ticks.tolist(), readings.tolist())
+                         if streams.step_at(0, value, t % rawstream.TICKS_PERIOD)])
+    detector = Detector(ideal, delta, sensitivity)
+    found = [[] for lane in range(lanes)]
+    for t, value in zip(ticks.tolist(), readings.tolist()):
+        for lane in np.flatnonzero(detector.step(t, value)):
+            found[lane].append(t)
+    mismatches = sum(found[lane] != expected[lane] for lane in range(lanes))
+    print('{} random settings over {} readings, {} differ from the fleet engine'.format(
+        lanes, len(ticks), mismatches))
+
+    args = argparse.Namespace(ideal=None, delta=None, sensitivity=None, workers=None,
+                              chunk=None, rate=1, slack=5, window=60)
+    start = time.perf_counter()
+    results = search([night], args, {})
+    elapsed = time.perf_counter() - start
+    report(results, 5)
+    print(json.dumps(settings(results)))
+    print('{} settings in {:.1f}s'.format(len(results['Bert']['delta']), elapsed))
+    return mismatches == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pick sleep2mqtt settings from recorded nights')
+    parser.add_argument('--night', action='append', default=[],
+                        help='NAME=trace.csv,events.csv for one night of one sensor, repeat for more')
+    parser.add_argument('--config', help='config.json to take history_size from and merge the results into')
+    parser.add_argument('--output', help='write the config here instead of printing it')
+    parser.add_argument('--ideal', help='ideal_pressure grid as START:STOP[:STEP], from the traces by default')
+    parser.add_argument('--delta', help='delta grid as START:STOP[:STEP], from the traces by default')
+    parser.add_argument('--sensitivity', help='state_sensitivity grid as START:STOP[:STEP], 1:9 by default')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='readings per second, higher follows the fast read cadence more closely')
+    parser.add_argument('--slack', type=float, default=5, help='seconds a change may come before its event')
+    parser.add_argument('--window', type=float, default=60, help='seconds after an event a change still counts')
+    parser.add_argument('--top', type=int, default=5, help='settings to list per sensor')
+    parser.add_argument('--workers', type=int, help='processes, one per core by default')
+    parser.add_argument('--chunk', type=int, help='settings per job, the grid split evenly across workers by default')
+    parser.add_argument('--check', action='store_true',
+                        help='compare against the fleet engine, calibrate a synthetic night and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check() else 1)
+    if not args.night:
+        parser.error('at least one --night is needed')
+
+    config = None
+    history_sizes = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        history_sizes = {name: sensor.get('history_size', 10) for name, sensor in config['sensors'].items()}
+
+    nights = []
+    for item in args.night:
+        sensor, _, paths = item.partition('=')
+        trace, _, events = paths.partition(',')
+        times, values = load_trace(trace)
+        nights.append(Night(sensor, times, values, load_events(events)))
+
+    start = time.perf_counter()
+    results = search(nights, args, history_sizes)
+    report(results, args.top)
+    print('searched in {:.1f}s'.format(time.perf_counter() - start))
+
+    out = json.dumps(settings(results, config), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
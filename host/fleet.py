@@ -0,0 +1,615 @@
+# occupancy detection for a whole fleet of beds in one CPython process
+#
+# subscribes to raw pressure readings from every device and runs the same
+# adaptive on/off detection as BedSensor.adaptive_state for each stream.
+# per-stream state lives in flat arrays indexed by slot, not an object per
+# sensor, so thousands of streams stay small and cache friendly. occupancy
+# changes are published retained to sleep2mqtt/<clientid>/fleet/<sensor>
+#
+#   python host/fleet.py --broker 10.0.0.10:1883 --config config.json
+#   python host/fleet.py --check
+#   python host/fleet.py --benchmark --streams 5000
+#
+# raw readings arrive on sleep2mqtt/<clientid>/raw/<sensor>, where sensor is
+# the name in the device's config.json, as the binary frames the raw_stream
+# setting sends (see rawstream.py) or as comma separated pressures (0-100)
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import struct
+import sys
+import time
+from array import array
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+if HOST not in sys.path:
+    sys.path.insert(0, HOST)
+
+import rawstream
+
+RAW_TOPIC = 'sleep2mqtt/+/raw/+'
+
+# the device's Cadence defaults, for streams that come with tick times
+BASE_MS = 1000
+NEAR = 0.25
+HOLD_MS = 5000
+
+
+class Streams():
+    '''
+    detection state for many sensor streams in flat arrays, one slot per stream
+    and two history rings per slot (0 = off, 1 = on)
+        Parameters:
+            history_size = number of readings in the on/off sliding averages
+            sensitivity = state_sensitivity for streams added without their own, 1-10
+    '''
+    def __init__(self, history_size=10, sensitivity=2):
+        self.size = history_size
+        self.sensitivity = float((10 - sensitivity) / 10)
+        # (clientid, sensor) -> slot, and back
+        self.slots = {}
+        self.keys = []
+        # per slot
+        self.state = bytearray()
+        self.delta = array('f')
+        self.threshold = array('f')
+        self.value = array('f')
+        self.samples = array('L')
+        # Cadence state for streams with tick times: last history push, and
+        # when activity was first and last seen while active is set
+        self.pushed = array('L')
+        self.active = bytearray()
+        self.onset = array('L')
+        self.active_at = array('L')
+        # per ring, ring = slot * 2 + state
+        self.values = array('f')
+        self.totals = array('d')
+        self.avgs = array('d')
+        self.heads = array('H')
+        self.counts = array('H')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, delta, ideal_pressure=None, first=None, state=False, sensitivity=None):
+        # seed like BedSensor.create_history: off at ideal - delta, on at ideal
+        # with no ideal pressure the first reading is taken as vacant
+        if ideal_pressure is None:
+            ideal_pressure = first + delta
+        factor = self.sensitivity if sensitivity is None else float((10 - sensitivity) / 10)
+        slot = len(self.keys)
+        self.slots[key] = slot
+        self.keys.append(key)
+        self.state.append(1 if state else 0)
+        self.delta.append(delta)
+        self.threshold.append(delta * factor)
+        self.value.append(0.0)
+        self.samples.append(0)
+        self.pushed.append(0)
+        self.active.append(0)
+        self.onset.append(0)
+        self.active_at.append(0)
+        size = self.size
+        for avg in (ideal_pressure - delta, ideal_pressure):
+            self.values.extend(array('f', [avg]) * size)
+            self.totals.append(float(avg) * size)
+            self.avgs.append(float(avg))
+            self.heads.append(0)
+            self.counts.append(size)
+        return slot
+
+    def push(self, ring, value):
+        # History.push over the flat arrays
+        size = self.size
+        base = ring * size
+        i = self.heads[ring]
+        values = self.values
+        self.totals[ring] += value - values[base + i]
+        values[base + i] = value
+        i += 1
+        if i == size:
+            i = 0
+            self.totals[ring] = sum(values[base:base + size])
+        self.heads[ring] = i
+        count = self.counts[ring]
+        if count < size:
+            count += 1
+            self.counts[ring] = count
+        if count == size:
+            self.avgs[ring] = self.totals[ring] / size
+
+    def step(self, slot, value, pushes=1):
+        # BedSensor.adaptive_state for one reading, returns True on an occupancy change
+        # pushes is how many times the histories move, a change moves them once
+        on = self.state[slot]
+        current = slot * 2 + on
+        avg = self.avgs[current]
+        changed = False
+        if abs(avg - value) > self.threshold[slot]:
+            if value > avg and not on:
+                on = 1
+                changed = True
+            elif value < avg and on:
+                on = 0
+                changed = True
+        self.value[slot] = value
+        self.samples[slot] += 1
+
+        delta = self.delta[slot]
+        if changed:
+            self.state[slot] = on
+            # the reading goes to the new state's history, the delta to the old one
+            self.push(slot * 2 + on, value)
+            self.push(current, value - delta if on else value + delta)
+        else:
+            for i in range(pushes):
+                self.push(current, value)
+                self.push(slot * 2 + 1 - on, value - delta if on else value + delta)
+        return changed
+
+    def step_at(self, slot, value, ticks):
+        # step() for a reading taken at device ticks_ms, moving the histories the
+        # way Cadence does: once per elapsed base period, and not at all while
+        # activity is new so a change stands out against the baseline from before
+        threshold = self.threshold[slot]
+        avg = self.avgs[slot * 2 + self.state[slot]]
+        last = self.value[slot] if self.samples[slot] else value
+        if threshold > 0:
+            activity = max(abs(avg - value), abs(value - last)) / threshold
+        else:
+            activity = 1
+        period = rawstream.TICKS_PERIOD
+        if activity >= NEAR:
+            if not self.active[slot]:
+                self.active[slot] = 1
+                self.onset[slot] = ticks
+            self.active_at[slot] = ticks
+        elif self.active[slot] and (ticks - self.active_at[slot]) % period > HOLD_MS:
+            self.active[slot] = 0
+
+        if self.active[slot] and (ticks - self.onset[slot]) % period < HOLD_MS:
+            pushes = 0
+        else:
+            pushes = ((ticks - self.pushed[slot]) % period + BASE_MS // 2) // BASE_MS
+            self.pushed[slot] = (self.pushed[slot] + pushes * BASE_MS) % period
+        changed = self.step(slot, value, min(pushes, self.size))
+        if changed:
+            self.pushed[slot] = ticks
+            self.active[slot] = 0
+        return changed
+
+    def nbytes(self):
+        # memory held by the per-stream arrays
+        return sum(a.itemsize * len(a) for a in (
+            self.delta, self.threshold, self.value, self.samples, self.pushed, self.onset,
+            self.active_at, self.values, self.totals, self.avgs, self.heads, self.counts)
+            ) + len(self.state) + len(self.active)
+
+
+def decode_readings(payload):
+    # comma separated pressures
+    return [float(v) for v in payload.split(b',') if v.strip()]
+
+
+class Fleet():
+    '''
+    routes raw readings to their stream and reports occupancy changes
+        Parameters:
+            streams = Streams holding the detection state
+            publish = callable(topic, payload) for occupancy changes, or None
+            delta = delta for streams that aren't in a device config
+            known = (clientid, sensor) -> (ideal_pressure, delta, sensitivity) from device configs
+    '''
+    def __init__(self, streams, publish=None, delta=30.0, known=None):
+        self.streams = streams
+        self.publish = publish
+        self.delta = delta
+        self.known = known or {}
+        self.readings = 0
+        self.changes = 0
+        self.busy = 0.0
+
+    def handle(self, topic, payload):
+        # sleep2mqtt/<clientid>/raw/<sensor>
+        start = time.perf_counter()
+        parts = topic.split('/')
+        if len(parts) != 4 or parts[2] != 'raw':
+            return
+        key = (parts[1], parts[3])
+        # binary frames from the raw_stream setting carry the device's tick for
+        # every read, text readings are taken as one a second
+        ticks = None
+        try:
+            if rawstream.is_frame(payload):
+                frame = rawstream.decode(payload)[1]
+                ticks = [t for t, adc in frame]
+                readings = [rawstream.pressure(adc) for t, adc in frame]
+            else:
+                readings = decode_readings(payload)
+        except (ValueError, struct.error):
+            return
+        if not readings:
+            return
+
+        streams = self.streams
+        slot = streams.slots.get(key)
+        if slot is None:
+            ideal_pressure, delta, sensitivity = self.known.get(key, (None, self.delta, None))
+            slot = streams.add(key, delta, ideal_pressure, first=readings[0], sensitivity=sensitivity)
+            if ticks is not None:
+                streams.pushed[slot] = ticks[0]
+
+        step = streams.step
+        for i, value in enumerate(readings):
+            if ticks is None:
+                changed = step(slot, value)
+            else:
+                changed = streams.step_at(slot, value, ticks[i])
+            if changed:
+                self.changes += 1
+                if self.publish is not None:
+                    self.publish(
+                        'sleep2mqtt/{}/fleet/{}'.format(*key),
+                        json.dumps({"occupancy": bool(streams.state[slot]), "pressure": round(value, 2)}))
+        self.readings += len(readings)
+        self.busy += time.perf_counter() - start
+
+
+class Client():
+    '''
+    just enough MQTT 3.1.1 over asyncio streams for the fleet: connect,
+    subscribe, QoS 0 publish, keepalive pings, and a callback per message
+        Parameters:
+            client_id = MQTT client id
+            callback = callable(topic str, payload bytes) for subscribed messages
+            keepalive = seconds between pings
+    '''
+    def __init__(self, client_id, callback=None, keepalive=60):
+        self.client_id = client_id.encode()
+        self.callback = callback
+        self.keepalive = keepalive
+        self.reader = None
+        self.writer = None
+        self.pid = 0
+
+    async def connect(self, host, port=1883, user=None, password=None):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        flags = 0x02
+        payload = self.string(self.client_id)
+        if user is not None:
+            flags |= 0x80
+            payload += self.string(user.encode())
+            if password is not None:
+                flags |= 0x40
+                payload += self.string(password.encode())
+        variable = self.string(b'MQTT') + bytes([4, flags]) + struct.pack('!H', self.keepalive)
+        self.send(0x10, variable + payload)
+        first, body = await self.read_packet()
+        if first != 0x20 or body[1] != 0:
+            raise ConnectionError('connect refused: {}'.format(body[1]))
+
+    async def subscribe(self, topic_filter):
+        self.pid = self.pid % 65535 + 1
+        self.send(0x82, struct.pack('!H', self.pid) + self.string(topic_filter.encode()) + b'\x00')
+        await self.writer.drain()
+
+    def publish(self, topic, payload, retain=False):
+        topic = topic.encode() if isinstance(topic, str) else topic
+        payload = payload.encode() if isinstance(payload, str) else payload
+        self.send(0x30 | retain, self.string(topic) + payload)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def run(self):
+        # read until the connection closes, pinging while it's quiet
+        pinger = asyncio.ensure_future(self.ping())
+        try:
+            while True:
+                first, body = await self.read_packet()
+                if first & 0xf0 == 0x30:
+                    topic_len = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_len].decode()
+                    offset = 2 + topic_len
+                    qos = (first >> 1) & 3
+                    if qos:
+                        pid = body[offset:offset + 2]
+                        offset += 2
+                        self.send(0x40, pid)
+                    if self.callback is not None:
+                        self.callback(topic, body[offset:])
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            pinger.cancel()
+
+    async def ping(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            self.send(0xc0, b'')
+
+    def close(self):
+        if self.writer is not None:
+            self.send(0xe0, b'')
+            self.writer.close()
+
+    def send(self, first, body):
+        length = bytearray()
+        n = len(body)
+        while True:
+            byte = n & 0x7f
+            n >>= 7
+            length.append(byte | 0x80 if n else byte)
+            if not n:
+                break
+        self.writer.write(bytes([first]) + bytes(length) + body)
+
+    async def read_packet(self):
+        first = (await self.reader.readexactly(1))[0]
+        n = 0
+        shift = 0
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            n |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        body = await self.reader.readexactly(n) if n else b''
+        return first, body
+
+    def string(self, data):
+        return struct.pack('!H', len(data)) + data
+
+
+def load_known(paths):
+    # (clientid, sensor) -> (ideal_pressure, delta, sensitivity) from device
+    # config.json files, sensitivity is None when the config has none
+    known = {}
+    for path in paths:
+        with open(path) as f:
+            config = json.load(f)
+        clientid = config['settings']['mqtt_clientid']
+        sensitivity = config['settings'].get('state_sensitivity')
+        for name, sensor in config['sensors'].items():
+            known[(clientid, name)] = (sensor['ideal_pressure'], sensor['delta'], sensitivity)
+    return known
+
+
+async def serve(args):
+    # the streams outlive the connection, a broker restart carries on where it left off
+    streams = Streams(history_size=args.history_size, sensitivity=args.sensitivity or 2)
+    host, _, port = args.broker.partition(':')
+    fleet = Fleet(streams, delta=args.delta, known=load_known(args.config))
+    client = Client(args.client_id, fleet.handle)
+    fleet.publish = lambda topic, payload: client.publish(topic, payload, retain=True)
+    delay = 1
+    while True:
+        try:
+            await client.connect(host, int(port or 1883), args.user, args.password)
+            await client.subscribe(RAW_TOPIC)
+            print('subscribed to {} on {}'.format(RAW_TOPIC, args.broker))
+            delay = 1
+            await client.run()
+            print('connection to {} closed'.format(args.broker))
+        except (OSError, asyncio.IncompleteReadError) as e:
+            print('connection to {} failed: {}'.format(args.broker, e))
+        finally:
+            if client.writer is not None:
+                client.writer.close()
+                client.writer = None
+        # jittered, doubling up to a minute, like the device's Backoff
+        await asyncio.sleep(delay * random.uniform(0.5, 1))
+        delay = min(delay * 2, 60)
+
+
+def check(hours=8):
+    # feed the same readings through BedSensor.adaptive_state and Streams and
+    # compare the state after every reading
+    import simulator
+    import utime
+
+    config = simulator.load_config()
+    sim = simulator.Simulation(config)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.run(60)
+    utime.end = None
+    app = sim.app
+    # the device pushes history once per read without a cadence
+    app.BedSensor.cadence = None
+    streams = Streams(sensitivity=config['settings']['state_sensitivity'])
+    mismatches = 0
+    changes = 0
+    for sensor in app.BedSensor.sensors():
+        name = sensor.key
+        sensor.current_state = False
+        sensor.create_history()
+        slot = streams.add(('check', name), sensor.delta, sensor.ideal_pressure)
+        trace = simulator.synthetic_trace(
+            off=sensor.ideal_pressure - sensor.delta, delta=sensor.delta, seed=len(name))
+        with contextlib.redirect_stdout(io.StringIO()):
+            for t in range(int(hours * 3600)):
+                sensor.value = trace(t)
+                changed = sensor.adaptive_state()
+                if streams.step(slot, sensor.value) != changed:
+                    mismatches += 1
+                elif sensor.current_state != bool(streams.state[slot]):
+                    mismatches += 1
+                changes += changed
+    sim.close()
+    print('{} readings per sensor, {} occupancy changes, {} mismatches'.format(
+        int(hours * 3600), changes, mismatches))
+
+    # a night streamed as binary frames, read at the device's adaptive cadence,
+    # has to change state at the same reads the device did
+    config['settings']['raw_stream'] = True
+    sim = simulator.Simulation(config)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.run(hours * 3600)
+    utime.end = None
+    streams = Streams(sensitivity=config['settings']['state_sensitivity'])
+    missed = 0
+    for name, sensor in config['sensors'].items():
+        slot = streams.add(('check', name), sensor['delta'], sensor['ideal_pressure'])
+        found = []
+        topic = 'sleep2mqtt/{}/raw/{}'.format(config['settings']['mqtt_clientid'], name)
+        for message in sim.broker.topic(topic):
+            for ticks, adc in rawstream.decode(message[2])[1]:
+                if not streams.samples[slot]:
+                    streams.pushed[slot] = ticks
+                if streams.step_at(slot, rawstream.pressure(adc), ticks):
+                    found.append((round(ticks / 1000, 3), bool(streams.state[slot])))
+        device = [(round(t, 3), occupied) for t, occupied in sim.transitions(name)[1:]]
+        missed += len(set(device) ^ set(found))
+        print('{}: {} changes on the device, {} from raw frames'.format(name, len(device), len(found)))
+    sim.close()
+    print('{} changes differ'.format(missed))
+    return check_known() and mismatches == 0 and missed == 0
+
+
+def check_known():
+    # two devices with their own state_sensitivity, each stream has to use its
+    # own device's threshold. the same step in pressure is a change for the
+    # more sensitive one only
+    import tempfile
+
+    paths = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for clientid, sensitivity in (('bedroom', 8), ('guest', 2)):
+            config = {"settings": {"mqtt_clientid": clientid, "state_sensitivity": sensitivity},
+                      "sensors": {"Bed": {"ideal_pressure": 70, "delta": 30}}}
+            path = os.path.join(tmp, clientid + '.json')
+            with open(path, 'w') as f:
+                json.dump(config, f)
+            paths.append(path)
+        known = load_known(paths)
+    fleet = Fleet(Streams(sensitivity=5), known=known)
+    # vacant at 40, then 15 up: over bedroom's threshold of 6, under guest's of 24
+    results = []
+    for clientid in ('bedroom', 'guest', 'other'):
+        topic = 'sleep2mqtt/{}/raw/Bed'.format(clientid)
+        fleet.handle(topic, b'40,40,40,55')
+        slot = fleet.streams.slots[(clientid, 'Bed')]
+        results.append((round(fleet.streams.threshold[slot], 2), bool(fleet.streams.state[slot])))
+    expected = [(6.0, True), (24.0, False), (15.0, False)]
+    print('per device sensitivity: thresholds and states {}, expected {}'.format(results, expected))
+    return results == expected
+
+
+def engine_benchmark(count, seconds):
+    # detection only: readings per second of cpu, so streams per core at 1 Hz
+    streams = Streams()
+    rng = random.Random(1)
+    slots = [streams.add(('bench{:05}'.format(i), 'Bed'), 30.0, 70.0) for i in range(count)]
+    readings = [[40.0 + rng.gauss(0, 0.2) + (30.0 if 20 <= t % 60 < 40 else 0.0)
+                 for t in range(seconds)] for i in range(4)]
+    step = streams.step
+    changes = 0
+    start = time.process_time()
+    for t in range(seconds):
+        for slot in slots:
+            changes += step(slot, readings[slot & 3][t])
+    cpu = time.process_time() - start
+    rate = count * seconds / cpu
+    return {
+        "streams": count,
+        "readings": count * seconds,
+        "changes": changes,
+        "readings_per_cpu_second": rate,
+        "streams_per_core_at_1hz": int(rate),
+        "state_bytes_per_stream": streams.nbytes() / count
+        }
+
+
+async def end_to_end(count, seconds, batch):
+    # raw readings from count streams through the in-process broker over TCP,
+    # batch readings per message, then count what the fleet detected
+    # simulator puts the stubs broker.py needs on the path
+    import simulator
+    import broker
+
+    server = broker.Broker(('127.0.0.1', 0))
+    tcp = await server.serve('127.0.0.1', 0)
+    port = tcp.sockets[0].getsockname()[1]
+
+    streams = Streams()
+    fleet = Fleet(streams, delta=30.0)
+    subscriber = Client('fleet', fleet.handle)
+    await subscriber.connect('127.0.0.1', port)
+    await subscriber.subscribe(RAW_TOPIC)
+    reading = asyncio.ensure_future(subscriber.run())
+
+    device = Client('devices')
+    await device.connect('127.0.0.1', port)
+    rng = random.Random(2)
+    topics = ['sleep2mqtt/bed{:05}/raw/Bed'.format(i) for i in range(count)]
+    start = time.perf_counter()
+    sent = 0
+    for t in range(0, seconds, batch):
+        # everyone gets in bed for the middle third
+        for topic in topics:
+            values = []
+            for s in range(t, min(t + batch, seconds)):
+                occupied = seconds // 3 <= s < 2 * seconds // 3
+                values.append('{:.2f}'.format(40.0 + rng.gauss(0, 0.2) + (30.0 if occupied else 0.0)))
+            device.publish(topic, ','.join(values))
+            sent += len(values)
+        await device.drain()
+    while fleet.readings < sent:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    device.close()
+    subscriber.close()
+    await reading
+    # let the broker see both connections close before the loop goes away
+    while server.sessions:
+        await asyncio.sleep(0.01)
+    tcp.close()
+    return {
+        "streams": count,
+        "readings": sent,
+        "batch": batch,
+        "changes": fleet.changes,
+        "wall_seconds": elapsed,
+        "fleet_busy_seconds": fleet.busy,
+        "streams_per_core_at_1hz": int(fleet.readings / fleet.busy)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='occupancy detection for many sleep2mqtt sensors')
+    parser.add_argument('--broker', default='127.0.0.1:1883', help='host:port of the MQTT broker')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--client-id', default='sleep2mqtt-fleet')
+    parser.add_argument('--config', action='append', default=[],
+                        help="a device's config.json, for its sensors' ideal pressure and delta")
+    parser.add_argument('--delta', type=float, default=30.0, help='delta for sensors not in a config')
+    parser.add_argument('--sensitivity', type=int, help='state_sensitivity for sensors not in a config, 1-10')
+    parser.add_argument('--history-size', type=int, default=10)
+    parser.add_argument('--check', action='store_true',
+                        help='compare against BedSensor.adaptive_state and exit')
+    parser.add_argument('--benchmark', action='store_true', help='measure streams per core and exit')
+    parser.add_argument('--streams', type=int, default=2000)
+    parser.add_argument('--seconds', type=int, default=120, help='readings per stream when benchmarking')
+    parser.add_argument('--batch', type=int, default=10, help='readings per message when benchmarking')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check() else 1)
+    if args.benchmark:
+        results = {
+            "engine": engine_benchmark(args.streams, args.seconds),
+            "end_to_end": asyncio.run(end_to_end(args.streams, args.seconds, args.batch))
+            }
+        print(json.dumps(results, indent=2))
+        return
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+# decode and record the binary raw frames sent with the raw_stream setting
+#
+# each sensor publishes frames to sleep2mqtt/<clientid>/raw/<sensor>:
+# an 8 byte header (version, readings in the frame, sequence number, ticks_ms
+# of the first reading) and 4 bytes per reading (ms after the first reading,
+# ADC average in 1/16 counts), all little endian. recordings are written as
+# seconds,pressure rows, the trace format simulator.py --trace reads
+#
+#   python host/rawstream.py --broker 10.0.0.10:1883 --output night/
+#   python host/rawstream.py --check
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import struct
+import sys
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+if HOST not in sys.path:
+    sys.path.insert(0, HOST)
+
+HEADER = struct.Struct('<BBHI')
+READING = struct.Struct('<HH')
+VERSION = 1
+# ticks_ms wraps here on the ESP32 port
+TICKS_PERIOD = 1 << 30
+# sensor min/max raw readings used by BedSensor.read
+RAW_MIN = 142
+RAW_MAX = 3150
+
+RAW_TOPIC = 'sleep2mqtt/+/raw/+'
+
+
+def is_frame(payload):
+    # text readings start with a printable character, frames with the version byte
+    return len(payload) >= HEADER.size and payload[0] == VERSION
+
+
+def decode(payload):
+    # (sequence number, [(ticks_ms, ADC average)]) from one frame
+    version, count, seq, base = HEADER.unpack_from(payload, 0)
+    if version != VERSION:
+        raise ValueError('unknown raw frame version {}'.format(version))
+    if HEADER.size + count * READING.size > len(payload):
+        raise ValueError('raw frame too short for {} readings'.format(count))
+    readings = []
+    for i in range(count):
+        offset, value = READING.unpack_from(payload, HEADER.size + i * READING.size)
+        readings.append(((base + offset) % TICKS_PERIOD, value / 16))
+    return seq, readings
+
+
+def pressure(adc):
+    # the scaling in BedSensor.read
+    return 100 - (adc - RAW_MIN) / (RAW_MAX - RAW_MIN) * 100
+
+
+class Recorder():
+    '''
+    one sensor's frames as a continuous timeline: ticks_ms wrapping and device
+    restarts are smoothed over, and frames lost on the way are counted
+    '''
+    def __init__(self):
+        self.start = None
+        self.last = None
+        self.offset = 0
+        self.seq = None
+        self.frames = 0
+        self.lost = 0
+        self.restarts = 0
+
+    def add(self, payload):
+        # (seconds since the first reading, pressure) for each reading in the frame
+        seq, readings = decode(payload)
+        if not readings:
+            return []
+        first = readings[0][0]
+        restarted = (self.last is not None and first < self.last
+                     and first >= self.last - TICKS_PERIOD // 2)
+        if restarted:
+            # ticks and the sequence both start over, carry on from the last reading
+            self.restarts += 1
+            self.offset += self.last - first
+        elif self.seq is not None:
+            self.lost += (seq - self.seq - 1) % 65536
+        self.seq = seq
+        self.frames += 1
+
+        out = []
+        for ticks, adc in readings:
+            if self.last is not None and ticks < self.last - TICKS_PERIOD // 2:
+                self.offset += TICKS_PERIOD
+            self.last = ticks
+            t = ticks + self.offset
+            if self.start is None:
+                self.start = t
+            out.append(((t - self.start) / 1000, pressure(adc)))
+        return out
+
+
+async def record(args):
+    import fleet
+
+    recorders = {}
+    files = {}
+
+    def handle(topic, payload):
+        parts = topic.split('/')
+        if len(parts) != 4 or parts[2] != 'raw' or not is_frame(payload):
+            return
+        key = (parts[1], parts[3])
+        if args.sensor and parts[3] not in args.sensor:
+            return
+        recorder = recorders.get(key)
+        if recorder is None:
+            recorder = recorders[key] = Recorder()
+            if args.output:
+                path = os.path.join(args.output, '{}-{}.csv'.format(*key))
+                files[key] = open(path, 'w')
+                files[key].write('seconds,pressure\n')
+                print('recording {}/{} to {}'.format(key[0], key[1], path))
+        try:
+            rows = recorder.add(payload)
+        except (ValueError, struct.error) as e:
+            print('bad frame on {}: {}'.format(topic, e))
+            return
+        for t, p in rows:
+            line = '{:.3f},{:.3f}\n'.format(t, p)
+            if args.output:
+                files[key].write(line)
+            else:
+                sys.stdout.write('{},{},{}'.format(key[0], key[1], line))
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    host, _, port = args.broker.partition(':')
+    topic = 'sleep2mqtt/{}/raw/+'.format(args.device) if args.device else RAW_TOPIC
+    client = fleet.Client(args.client_id, handle)
+    await client.connect(host, int(port or 1883), args.user, args.password)
+    await client.subscribe(topic)
+    print('subscribed to {} on {}'.format(topic, args.broker), file=sys.stderr)
+    try:
+        await client.run()
+    finally:
+        for key, f in files.items():
+            f.close()
+            recorder = recorders[key]
+            print('{}/{}: {} frames, {} lost, {} restarts'.format(
+                key[0], key[1], recorder.frames, recorder.lost, recorder.restarts), file=sys.stderr)
+
+
+def check(hours=4):
+    # stream a simulated night with noiseless traces and compare every decoded
+    # reading against the ADC value the device read at that tick
+    import simulator
+    import utime
+
+    config = simulator.load_config()
+    config['settings']['raw_stream'] = True
+    traces = {}
+    expected = {}
+    for name, sensor in config['sensors'].items():
+        trace = simulator.synthetic_trace(
+            off=sensor['ideal_pressure'] - sensor['delta'], delta=sensor['delta'], noise=0)
+        traces[name] = trace
+        expected[name] = simulator.raw_source(trace)
+    sim = simulator.Simulation(config, traces)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.run(hours * 3600)
+
+    ok = True
+    raw_bytes = 0
+    for name in config['sensors']:
+        topic = 'sleep2mqtt/{}/raw/{}'.format(config['settings']['mqtt_clientid'], name)
+        messages = sim.broker.topic(topic)
+        recorder = Recorder()
+        readings = 0
+        worst = 0.0
+        for message in messages:
+            payload = message[2]
+            raw_bytes += len(topic) + len(payload)
+            seq, decoded = decode(payload)
+            recorder.add(payload)
+            for ticks, adc in decoded:
+                worst = max(worst, abs(adc - expected[name](ticks / 1000)))
+            readings += len(decoded)
+        reads = sim.app.BedSensor.sensor_key(name).pin.reads
+        print('{}: {} frames, {} readings, {} lost, worst ADC error {:.4f} counts, {} ADC reads'.format(
+            name, recorder.frames, readings, recorder.lost, worst, reads))
+        # the last frame may still be filling, and each read averages 10 ADC samples
+        ok = ok and recorder.lost == 0 and worst <= 1 / 16 and reads // 10 - readings < 255
+    summary = sim.summary()
+    print('raw frames {:.0f} of {:.0f} mqtt bytes/hour'.format(
+        raw_bytes / hours, summary['mqtt_bytes'] / hours))
+    sim.close()
+    utime.end = None
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='record the binary raw frames from sleep2mqtt sensors')
+    parser.add_argument('--broker', default='127.0.0.1:1883', help='host:port of the MQTT broker')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--client-id', default='sleep2mqtt-rawstream')
+    parser.add_argument('--device', help="only this device's mqtt_clientid")
+    parser.add_argument('--sensor', action='append', default=[], help='only this sensor, by config name')
+    parser.add_argument('--output', help='directory for one <clientid>-<sensor>.csv per sensor, stdout otherwise')
+    parser.add_argument('--check', action='store_true',
+                        help='decode a few simulated hours against the readings it came from and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check() else 1)
+    try:
+        asyncio.run(record(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,552 @@
+# run sleep2mqtt.py under CPython against simulated hardware
+#
+# stand-ins for the MicroPython modules live in host/stubs: the ADC reads
+# pressure traces, /sd is a temp directory, utime is a virtual clock that
+# only moves when the program sleeps, and MQTT goes to the in-process broker
+# in broker.py. main() runs unmodified, a night of device time takes seconds
+#
+#   python host/simulator.py --hours 8
+#   python host/simulator.py --trace Bert=bert.csv --hours 2
+#   python host/simulator.py --check
+import argparse
+import bisect
+import calendar
+import contextlib
+import importlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HOST)
+
+# stubs first so they win over the vendored micropython_libs/ntptime.py
+for path in (ROOT, os.path.join(ROOT, 'micropython_libs'), HOST, os.path.join(HOST, 'stubs')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import broker
+import machine
+import network
+import ntptime
+import uos
+import utime
+
+# sensor min/max raw readings used by BedSensor.read
+RAW_MIN = 142
+RAW_MAX = 3150
+
+# 2024-01-01 22:00 UTC as a MicroPython timestamp, what ntp "returns" at boot
+DEFAULT_START = calendar.timegm((2024, 1, 1, 22, 0, 0, 0, 0, 0)) - utime.EPOCH_OFFSET
+
+# (in, out) seconds of the synthetic night: in bed, up for a few minutes, back to bed
+NIGHT = [(3600, 3 * 3600), (3 * 3600 + 300, 7 * 3600)]
+
+
+def pressure_to_raw(pressure):
+    # inverse of the scaling in BedSensor.read
+    return RAW_MIN + (100 - pressure) / 100 * (RAW_MAX - RAW_MIN)
+
+
+def raw_to_pressure(raw):
+    return 100 - (raw - RAW_MIN) / (RAW_MAX - RAW_MIN) * 100
+
+
+def csv_trace(path):
+    # "seconds,pressure" rows (a header row is skipped), held until the next row
+    times = []
+    values = []
+    with open(path) as f:
+        for line in f:
+            parts = line.strip().split(',')
+            try:
+                t, p = float(parts[0]), float(parts[1])
+            except (ValueError, IndexError):
+                continue
+            times.append(t)
+            values.append(p)
+
+    def trace(t):
+        i = bisect.bisect_right(times, t) - 1
+        return values[max(i, 0)]
+    return trace
+
+
+def synthetic_trace(off=40.0, delta=25.0, events=None, noise=0.15, drift=1.5, ramp=4.0,
+                    seed=0):
+    # an air bed overnight: a slow drift from temperature, sensor noise, and
+    # delta more pressure (ramping over a few seconds) between each (in, out) event
+    if events is None:
+        events = NIGHT
+    rng = random.Random(seed)
+
+    def occupancy(t):
+        level = 0.0
+        for t_in, t_out in events:
+            if t_in <= t < t_out:
+                level = max(level, min(1.0, (t - t_in) / ramp))
+            elif t_out <= t < t_out + ramp:
+                level = max(level, 1.0 - (t - t_out) / ramp)
+        return level
+
+    def trace(t):
+        base = off + drift * math.sin(t / 86400 * 2 * math.pi)
+        return base + delta * occupancy(t) + rng.gauss(0, noise)
+    return trace
+
+
+def raw_source(trace):
+    return lambda t: round(pressure_to_raw(trace(t)))
+
+
+class FakeGC():
+    # CPython's gc has no threshold or heap numbers, and a real collect every
+    # simulated second would be most of the run time
+    def collect(self):
+        pass
+
+    def threshold(self, amount=None):
+        pass
+
+    def mem_free(self):
+        return 80000
+
+    def mem_alloc(self):
+        return 30000
+
+
+class Simulation():
+    '''
+    one device with its own sd card, broker and clock
+        Parameters:
+            config = config.json contents
+            traces = sensor name -> trace function of seconds returning pressure %
+            sd_root = directory used as the sd card, a temp directory by default
+            start = wall clock set by ntp, MicroPython epoch seconds
+    '''
+    def __init__(self, config, traces=None, sd_root=None, start=DEFAULT_START):
+        self.config = config
+        self.sd_root = sd_root or tempfile.mkdtemp(prefix='sleep2mqtt-sd-')
+        self.temporary = sd_root is None
+        self.reboots = 0
+        self.app = None
+
+        utime.reset()
+        uos.root = self.sd_root
+        uos.bytes_written = 0
+        uos.files_written = 0
+        uos.op_seconds = 0
+        ntptime.start = start
+        ntptime.reachable = True
+        network.wifi_up = True
+        network.join_seconds = 2
+        with open(os.path.join(self.sd_root, 'config.json'), 'w') as f:
+            json.dump(config, f)
+
+        broker.BROKERS.clear()
+        self.broker = broker.Broker((config['settings']['mqtt_server'], 1883))
+
+        traces = traces or {}
+        machine.sources.clear()
+        for name, sensor in config['sensors'].items():
+            trace = traces.get(name)
+            if trace is None:
+                trace = synthetic_trace(
+                    off=sensor['ideal_pressure'] - sensor['delta'],
+                    delta=sensor['delta'],
+                    seed=sensor['pin'])
+            machine.sources[sensor['pin']] = raw_source(trace)
+
+    def at(self, seconds, callback):
+        # run callback() when the device clock reaches seconds since boot
+        utime.schedule(seconds, callback)
+
+    def boot(self):
+        # import a fresh copy of the program, like a power cycle
+        sys.modules.pop('sleep2mqtt', None)
+        app = importlib.import_module('sleep2mqtt')
+        app.open = uos.sd_open
+        app.gc = FakeGC()
+        self.app = app
+        return app
+
+    def run(self, seconds):
+        # run main() until the clock has moved on by seconds, rebooting on machine.reset()
+        utime.end = utime.now + seconds
+        while True:
+            app = self.boot()
+            try:
+                app.main()
+            except utime.SimulationEnd:
+                break
+            except machine.Reset:
+                self.reboots += 1
+                if utime.now >= utime.end:
+                    break
+        return self
+
+    def control(self, message):
+        # send a command to the control topic like Home Assistant would
+        self.broker.publish('sleep2mqtt/control', json.dumps(message))
+
+    def states(self, name):
+        # (seconds, payload) for every state topic publish of a sensor
+        topic = 'sleep2mqtt/{} Bed Occupancy'.format(name)
+        return [(m[0], json.loads(m[2])) for m in self.broker.topic(topic)]
+
+    def transitions(self, name):
+        # (seconds, occupancy) whenever the published occupancy changed
+        out = []
+        last = None
+        for t, payload in self.states(name):
+            if payload['occupancy'] != last:
+                out.append((t, payload['occupancy']))
+                last = payload['occupancy']
+        return out
+
+    def latency(self, name, events=NIGHT):
+        # seconds from each (in, out) event in the trace until the matching
+        # occupancy change reached the broker, None where it never did
+        changes = self.transitions(name)
+        out = []
+        for t_in, t_out in events:
+            for t, occupied in ((t_in, True), (t_out, False)):
+                seen = [c[0] for c in changes if c[0] >= t and c[1] == occupied]
+                out.append(seen[0] - t if seen else None)
+        return out
+
+    def adc_reads(self):
+        return sum(sensor.pin.reads for sensor in self.app.BedSensor.sensors())
+
+    def summary(self):
+        hours = max(utime.now, 1) / 3600
+        return {
+            "seconds": utime.now,
+            "reboots": self.reboots,
+            "mqtt_messages": len(self.broker.messages),
+            "mqtt_bytes": self.broker.bytes,
+            "mqtt_messages_per_hour": len(self.broker.messages) / hours,
+            "sd_bytes_written": uos.bytes_written,
+            "sd_bytes_per_hour": uos.bytes_written / hours,
+            "adc_reads_per_hour": self.adc_reads() / hours,
+            "transitions": {name: self.transitions(name) for name in self.config['sensors']}
+            }
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.sd_root, ignore_errors=True)
+
+
+def load_config(path=None):
+    with open(path or os.path.join(ROOT, 'config.json')) as f:
+        config = json.load(f)
+    # no display or log noise unless asked for
+    config['settings']['m5stack'] = False
+    return config
+
+
+def run_quiet(sim, seconds):
+    # run with the device's console captured, returns its lines
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        sim.run(seconds)
+    return out.getvalue().splitlines()
+
+
+def check_history(trials=200):
+    # History.push(value, n) goes through the ring_fill kernel for int
+    # readings, it must leave the same ring as n single pushes
+    app = importlib.import_module('sleep2mqtt')
+    rng = random.Random(0)
+    mismatches = 0
+    for trial in range(trials):
+        scale = 100 if trial % 2 else None
+        size = rng.randint(1, 40)
+        batched = app.History(size, scale)
+        single = app.History(size, scale)
+        for step in range(rng.randint(1, 60)):
+            n = rng.randint(1, 2 * size + 1)
+            value = rng.randint(0, 10000) if scale else rng.uniform(0, 100)
+            batched.push(value, n)
+            for i in range(n):
+                single.push(value)
+            if (list(batched.values), batched.total, batched.index, batched.count, batched.avg) != \
+                    (list(single.values), single.total, single.index, single.count, single.avg):
+                mismatches += 1
+                break
+    print('history: {} random rings, {} differ from single pushes'.format(trials, mismatches))
+    return mismatches == 0
+
+
+# days past a backoff reset or the last activity, either side of the ~6.2 day
+# point where a stored tick wraps to look like it's in the future
+WRAP_DAYS = [1, 5, 6.3, 8, 12]
+
+
+class Idle():
+    # just the fields Cadence.update keeps on a sensor
+    onset = None
+    active_at = None
+
+
+def check_ticks():
+    # Backoff and Cadence keep ticks around between calls, they must act the
+    # same however long ago that was, past the ~6.2 day ticks wrap too
+    app = importlib.import_module('sleep2mqtt')
+    wrong = 0
+    for days in WRAP_DAYS:
+        utime.reset()
+        backoff = app.Backoff(base_ms=15000, cap_ms=120000)
+        backoff.failed()
+        wrong += backoff.ready()
+        utime.advance(120)
+        wrong += not backoff.ready()
+        backoff.reset()
+        utime.advance(days * 86400)
+        wrong += not backoff.ready()
+        # a failure just before the wrap is still waited out
+        utime.now = (utime.TICKS_PERIOD - 1000) / 1000
+        backoff.failed()
+        utime.advance(5)
+        wrong += backoff.ready()
+        utime.advance(120)
+        wrong += not backoff.ready()
+
+        utime.reset()
+        cadence = app.Cadence()
+        sensor = Idle()
+        wrong += cadence.update(sensor, 10, 10, utime.ticks_ms()) != cadence.fast_ms
+        utime.advance(cadence.hold_ms / 1000 + 1)
+        wrong += cadence.update(sensor, 0, 10, utime.ticks_ms()) != cadence.slow_ms
+        utime.advance(days * 86400)
+        wrong += cadence.update(sensor, 0, 10, utime.ticks_ms()) != cadence.slow_ms
+    utime.reset()
+    print('ticks: backoff and cadence after {} days, {} wrong'.format(
+        ', '.join(str(days) for days in WRAP_DAYS), wrong))
+    return wrong == 0
+
+
+# control topic commands and the error each one must be turned away with, None if it's applied
+COMMANDS = [
+    ({"command": "delta", "sensor_name": "Bert Bed Occupancy", "value": 20}, None),
+    ({"command": "ideal_pressure", "sensor_name": "Ernie", "value": 55}, None),
+    ({"command": "settings", "setting": "state_sensitivity", "value": 6}, None),
+    ({"command": "reset", "sensor_name": "Bert"}, None),
+    ({"command": "delta", "sensor_name": "Nobody", "value": 20}, 'unknown sensor Nobody'),
+    ({"command": "delta", "sensor_name": "Bert", "value": "20"}, 'value must be a number from 0 to 100'),
+    ({"command": "delta", "sensor_name": "Bert", "value": True}, 'value must be a number from 0 to 100'),
+    ({"command": "delta", "sensor_name": "Bert", "value": 500}, 'value must be a number from 0 to 100'),
+    ({"command": ["x"]}, 'not recognized'),
+    ({"command": "launch"}, 'not recognized'),
+    ([1, 2], 'not recognized'),
+    ("hello", 'not recognized'),
+    ({"command": "settings", "setting": "nope", "value": 1}, 'unknown setting nope'),
+    ({"command": "settings", "setting": "state_sensitivity", "value": 11}, 'whole number from 1 to 10'),
+    ({"command": "settings", "setting": "state_sensitivity", "value": 2.5}, 'whole number from 1 to 10'),
+    ({"command": "settings", "setting": "mqtt_server", "value": 5}, 'mqtt_server must be a str'),
+    ]
+
+
+def check_commands():
+    # every bad command is turned away with its own error and changes nothing,
+    # the good ones are applied and saved to the sd card
+    sim = Simulation(load_config())
+    for i, (command, error) in enumerate(COMMANDS):
+        sim.at(200 + i * 5, lambda command=command: sim.control(command))
+    lines = run_quiet(sim, 400)
+    app = sim.app
+    errors = [line for line in lines if 'error (' in line or 'not recognized' in line]
+    expected = [error for command, error in COMMANDS if error is not None]
+    wrong = len(expected) - sum(error in line for line, error in zip(errors, expected))
+    wrong += abs(len(errors) - len(expected))
+    with open(os.path.join(sim.sd_root, 'config.json')) as f:
+        saved = json.load(f)
+    applied = [
+        app.BedSensor.sensor_key('Bert').delta == 20,
+        app.BedSensor.sensor_key('Ernie').ideal_pressure == 55,
+        app.config['settings']['state_sensitivity'] == 6,
+        saved['sensors']['Bert']['delta'] == 20,
+        saved['sensors']['Ernie']['ideal_pressure'] == 55,
+        saved['settings']['state_sensitivity'] == 6,
+        saved['settings']['mqtt_server'] == sim.config['settings']['mqtt_server']
+        ]
+    print('commands: {} sent, {} rejections wrong, {} of {} changes applied and saved'.format(
+        len(COMMANDS), wrong, sum(applied), len(applied)))
+    sim.close()
+    utime.end = None
+    return wrong == 0 and all(applied)
+
+
+def check_config_saves(runtime):
+    # a burst of commands is saved and published once, a batch with one bad
+    # command changes nothing, and a setting that needs a restart survives it
+    config = load_config()
+    config['settings']['runtime'] = runtime
+    sim = Simulation(config)
+    for i in range(6):
+        sim.at(200 + i, lambda i=i: sim.control({"command": "delta", "sensor_name": "Bert", "value": 20 + i}))
+    sim.at(300, lambda: sim.control([
+        {"command": "ideal_pressure", "sensor_name": "Ernie", "value": 50},
+        {"command": "settings", "setting": "state_sensitivity", "value": 5}]))
+    sim.at(400, lambda: sim.control([
+        {"command": "ideal_pressure", "sensor_name": "Ernie", "value": 40},
+        {"command": "delta", "sensor_name": "Bert", "value": 900}]))
+    sim.at(500, lambda: sim.control([
+        {"command": "settings", "setting": "brightness", "value": 40},
+        {"command": "delta", "sensor_name": "Ernie", "value": 33}]))
+    lines = run_quiet(sim, 700)
+    app = sim.app
+    messages = sim.broker.topic('sleep2mqtt/config')
+    published = [m[0] for m in messages]
+    # the save that needs a restart is published before it, and the boot after it publishes again
+    windows = [sum(start <= t < end for t in published) for start, end in
+               ((0, 200), (200, 300), (300, 400), (400, 500), (500, 700))]
+    results = [
+        windows == [1, 1, 1, 0, 2],
+        json.loads(messages[-2][2])['settings']['brightness'] == 40,
+        json.loads(messages[-1][2])['settings']['brightness'] == 40,
+        sum('saved config' in line for line in lines) == 3,
+        sum('error (' in line for line in lines) == 1,
+        sim.reboots == 1,
+        app.BedSensor.sensor_key('Bert').delta == 25,
+        app.BedSensor.sensor_key('Ernie').ideal_pressure == 50,
+        app.BedSensor.sensor_key('Ernie').delta == 33,
+        app.config['settings']['state_sensitivity'] == 5,
+        app.config['settings']['brightness'] == 40
+        ]
+    print('config saves ({}): config published at {}, {} of {} checks passed'.format(
+        runtime, [round(t) for t in published], sum(results), len(results)))
+    sim.close()
+    utime.end = None
+    return all(results)
+
+
+def check_qos(runtime):
+    # occupancy changes go at QoS 1. a lost PUBACK is retransmitted with DUP,
+    # a change made while the broker is down waits in the outbox, and one still
+    # in flight when the broker goes away is sent again after the reconnect
+    config = load_config()
+    config['settings']['runtime'] = runtime
+    sim = Simulation(config)
+    sim.at(NIGHT[0][0] - 100, lambda: setattr(sim.broker, 'lose_acks', len(config['sensors'])))
+    sim.at(NIGHT[0][1] - 10, sim.broker.stop)
+    sim.at(NIGHT[0][1] + 200, sim.broker.start)
+    sim.at(NIGHT[1][1] - 100, lambda: setattr(sim.broker, 'lose_acks', len(config['sensors'])))
+    sim.at(NIGHT[1][1] + 5, sim.broker.stop)
+    sim.at(NIGHT[1][1] + 200, sim.broker.start)
+    run_quiet(sim, 8 * 3600)
+    app = sim.app
+    changes = [False, True, False, True, False]
+    results = [sim.broker.duplicates == len(config['sensors']),
+               not app.client.inflight,
+               app.outbox.pending() == 0,
+               app.outbox.dropped == 0]
+    for name in config['sensors']:
+        transitions = sim.transitions(name)
+        topic = 'sleep2mqtt/{} Bed Occupancy'.format(name)
+        resent = [m for m in sim.broker.topic(topic) if m[0] >= NIGHT[1][1] + 200 and m[4] == 1]
+        results += [[occupied for t, occupied in transitions] == changes,
+                     transitions[2][0] >= NIGHT[0][1] + 200,
+                     len(resent) > 0]
+    print('qos ({}): {} retransmitted, {} of {} checks passed'.format(
+        runtime, sim.broker.duplicates, sum(results), len(results)))
+    sim.close()
+    utime.end = None
+    return all(results)
+
+
+def check_slow_io(mode, op_seconds=0.5):
+    # in the asyncio runtime a broker that stops reading never makes a sensor
+    # read late, and a slow sd card only by one file operation
+    config = load_config()
+    config['settings']['runtime'] = 'asyncio'
+    sim = Simulation(config)
+    name = next(iter(config['sensors']))
+    pin = config['sensors'][name]['pin']
+    source = machine.sources[pin]
+    reads = {'last': None, 'late': 0.0}
+
+    def timed(t):
+        # how far past its period each read of one sensor comes
+        if reads['last'] is not None and reads['last'] != utime.now and 3000 <= utime.now < 4200:
+            period = sim.app.BedSensor.sensor_key(name).period / 1000
+            reads['late'] = max(reads['late'], utime.now - reads['last'] - period)
+        reads['last'] = utime.now
+        return source(t)
+
+    def slow():
+        if mode == 'broker':
+            sim.broker.stall = 'full'
+        else:
+            uos.op_seconds = op_seconds
+
+    def fast():
+        sim.broker.stall = None
+        uos.op_seconds = 0
+
+    machine.sources[pin] = timed
+    sim.at(3000, slow)
+    sim.at(4200, fast)
+    run_quiet(sim, 4400)
+    limit = op_seconds if mode == 'sd' else 0.001
+    changes = [occupied for t, occupied in sim.transitions(name)]
+    print('slow {} (asyncio): reads at most {:.2f}s late, occupancy changes {}'.format(
+        mode, reads['late'], changes))
+    sim.close()
+    utime.end = None
+    return reads['late'] <= limit and changes == [False, True]
+
+
+def check():
+    # replay scenarios against the device logic and compare with what it should do
+    ok = check_history()
+    ok = check_ticks() and ok
+    ok = check_commands() and ok
+    for runtime in ('loop', 'asyncio'):
+        ok = check_config_saves(runtime) and ok
+        ok = check_qos(runtime) and ok
+    for mode in ('broker', 'sd'):
+        ok = check_slow_io(mode) and ok
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run sleep2mqtt.py on simulated hardware')
+    parser.add_argument('--config', help='config.json to use, the repo example by default')
+    parser.add_argument('--hours', type=float, default=8)
+    parser.add_argument('--trace', action='append', default=[],
+                        help='NAME=file.csv with seconds,pressure rows for a sensor')
+    parser.add_argument('--runtime', choices=['loop', 'asyncio'], help='override settings.runtime')
+    parser.add_argument('--m5stack', action='store_true', help='also drive the display code')
+    parser.add_argument('--sd', help='directory to use as the sd card, kept afterwards')
+    parser.add_argument('--check', action='store_true',
+                        help='replay command, config save, qos, slow i/o, history and ticks scenarios and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check() else 1)
+
+    config = load_config(args.config)
+    config['settings']['m5stack'] = args.m5stack
+    if args.runtime:
+        config['settings']['runtime'] = args.runtime
+    traces = {}
+    for item in args.trace:
+        name, path = item.split('=', 1)
+        traces[name] = csv_trace(path)
+
+    sim = Simulation(config, traces, sd_root=args.sd)
+    try:
+        sim.run(args.hours * 3600)
+        print(json.dumps(sim.summary(), indent=2))
+    finally:
+        sim.close()
+
+
+if __name__ == '__main__':
+    main()
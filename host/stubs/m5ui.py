@@ -0,0 +1,55 @@
+# stand-in for the M5Stack UIFlow m5ui module
+
+class M5TextBox():
+    def __init__(self, x, y, text, font, color, rotate=0):
+        self.x = x
+        self.y = y
+        self.text = text
+        lcd.draws += 1
+
+    def setText(self, text):
+        self.text = text
+        lcd.draws += 1
+
+
+class M5Rect():
+    def __init__(self, x, y, w, h, color, border):
+        lcd.draws += 1
+
+
+class _Lcd():
+    FONT_DejaVu18 = 18
+
+    def __init__(self):
+        self.brightness = 0
+        self.draws = 0
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def setRotation(self, rotation):
+        pass
+
+    def drawLine(self, x, y, x1, y1, color=0xFFFFFF):
+        self.draws += 1
+
+    def rect(self, x, y, w, h, color=0xFFFFFF, fillcolor=None):
+        self.draws += 1
+
+
+class _Button():
+    def __init__(self):
+        self.callback = None
+
+    def wasPressed(self, callback):
+        self.callback = callback
+
+    def press(self):
+        if self.callback is not None:
+            self.callback()
+
+
+lcd = _Lcd()
+btnA = _Button()
+btnB = _Button()
+btnC = _Button()
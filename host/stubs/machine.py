@@ -0,0 +1,77 @@
+# stand-in for MicroPython's machine module, driven by the utime virtual clock
+import utime
+
+
+class Reset(BaseException):
+    # raised by reset(), the simulator boots the program again
+    pass
+
+
+# pin -> callable(seconds since boot) returning a raw 12 bit ADC reading
+sources = {}
+
+
+def reset():
+    raise Reset()
+
+
+class Pin():
+    IN = 1
+    OUT = 3
+    IRQ_FALLING = 2
+
+    def __init__(self, id, *args, **kwargs):
+        self.id = id
+
+
+class ADC():
+    ATTN_0DB = 0
+    ATTN_11DB = 3
+    WIDTH_12BIT = 3
+
+    def __init__(self, pin):
+        self.pin = pin.id
+        self.reads = 0
+
+    def atten(self, attn):
+        pass
+
+    def width(self, width):
+        pass
+
+    def read(self):
+        self.reads += 1
+        source = sources.get(self.pin)
+        if source is None:
+            return 0
+        return min(4095, max(0, int(source(utime.now))))
+
+
+class Timer():
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1):
+        self.id = id
+        self.entry = None
+
+    def init(self, mode=PERIODIC, period=None, freq=None, callback=None):
+        self.deinit()
+        if period is None:
+            period = 1000 / freq
+        seconds = period / 1000
+        repeat = seconds if mode == Timer.PERIODIC else 0
+        self.entry = utime.schedule(utime.now + seconds, lambda: callback(self), repeat)
+
+    def deinit(self):
+        if self.entry is not None:
+            utime.cancel(self.entry)
+            self.entry = None
+
+
+class RTC():
+    def datetime(self, t=None):
+        if t is None:
+            lt = utime.localtime()
+            return (lt[0], lt[1], lt[2], lt[6] + 1, lt[3], lt[4], lt[5], 0)
+        utime.set_wall(utime.mktime((t[0], t[1], t[2], t[4], t[5], t[6], 0, 0)))
@@ -0,0 +1,36 @@
+# stand-in for MicroPython's network module
+import utime
+
+STA_IF = 0
+AP_IF = 1
+
+# flip to False to simulate the access point going away
+wifi_up = True
+# seconds from connect() until the station has an address
+join_seconds = 2
+
+
+class WLAN():
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self.is_active = False
+        self.joined = False
+        self.joined_at = 0
+
+    def active(self, flag=None):
+        if flag is None:
+            return self.is_active
+        self.is_active = flag
+
+    def connect(self, ssid=None, password=None):
+        self.joined = True
+        self.joined_at = utime.now + join_seconds
+
+    def disconnect(self):
+        self.joined = False
+
+    def isconnected(self):
+        return self.is_active and self.joined and wifi_up and utime.now >= self.joined_at
+
+    def ifconfig(self):
+        return ('10.0.0.50', '255.255.255.0', '10.0.0.1', '10.0.0.1')
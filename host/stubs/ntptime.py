@@ -0,0 +1,34 @@
+# stand-in for ntptime, settime() jumps the virtual wall clock to start
+import utime
+
+host = "pool.ntp.org"
+# MicroPython epoch seconds to set the clock to, and whether the server answers
+start = 0
+reachable = True
+
+
+def time():
+    if not reachable:
+        raise OSError(110)
+    return start + int(utime.now)
+
+
+class _Query():
+    # the socket query() hands back, the reply is there as soon as it's polled
+    def close(self):
+        pass
+
+
+def query():
+    return _Query()
+
+
+def reply(s):
+    # an unreachable server never answers, the caller times out
+    if not reachable:
+        return None
+    return time()
+
+
+def settime(t=None):
+    utime.set_wall(time() if t is None else t)
@@ -0,0 +1,63 @@
+# stand-in for uasyncio that runs coroutines on the utime virtual clock
+import heapq
+import utime
+
+
+class Task():
+    def __init__(self, coro):
+        self.coro = coro
+        self.done = False
+        _ready(self, utime.now)
+
+
+class _Sleep():
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __await__(self):
+        yield self.seconds
+
+
+_queue = []
+_seq = 0
+
+
+def _ready(task, due):
+    global _seq
+    _seq += 1
+    heapq.heappush(_queue, (due, _seq, task))
+
+
+def create_task(coro):
+    return Task(coro)
+
+
+def sleep(seconds):
+    return _Sleep(seconds)
+
+
+def sleep_ms(ms):
+    return _Sleep(ms / 1000)
+
+
+async def gather(*tasks):
+    while not all(task.done for task in tasks):
+        await sleep(1)
+
+
+def run(coro):
+    global _queue
+    _queue = []
+    main = Task(coro)
+    while _queue:
+        due, seq, task = heapq.heappop(_queue)
+        if due > utime.now:
+            utime.advance(due - utime.now)
+        try:
+            delay = task.coro.send(None)
+        except StopIteration:
+            task.done = True
+            if task is main:
+                return
+            continue
+        _ready(task, utime.now + (delay or 0))
@@ -0,0 +1 @@
+from binascii import hexlify, unhexlify, a2b_base64, b2a_base64
@@ -0,0 +1,79 @@
+# stand-in for MicroPython's uos, with the sd card mapped to a host directory
+#
+# the simulator replaces open() in sleep2mqtt with sd_open() so paths under
+# /sd land in root, and counts what gets written to the card
+import os
+
+import utime
+
+SDMODE_SPI = 1
+
+root = None
+bytes_written = 0
+files_written = 0
+# seconds each write, remove or rename takes on the virtual clock, for a slow card
+op_seconds = 0
+
+
+def path(p):
+    if p == '/sd' or p.startswith('/sd/'):
+        return os.path.join(root, p[4:])
+    return p
+
+
+def sdconfig(*args, **kwargs):
+    pass
+
+
+def mountsd():
+    pass
+
+
+def stat(p):
+    return tuple(os.stat(path(p)))
+
+
+def remove(p):
+    utime.advance(op_seconds)
+    os.remove(path(p))
+
+
+def rename(old, new):
+    utime.advance(op_seconds)
+    os.rename(path(old), path(new))
+
+
+def listdir(p='/sd'):
+    return os.listdir(path(p))
+
+
+class _Counted():
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        global bytes_written
+        bytes_written += len(data)
+        utime.advance(op_seconds)
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __iter__(self):
+        return iter(self.f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+
+def sd_open(p, mode='r', *args, **kwargs):
+    global files_written
+    f = open(path(p), mode, *args, **kwargs)
+    if 'w' in mode or 'a' in mode or '+' in mode:
+        files_written += 1
+        return _Counted(f)
+    return f
@@ -0,0 +1,25 @@
+# stand-in for MicroPython's uselect, enough poll() for the usocket stub
+POLLIN = 1
+POLLOUT = 4
+POLLERR = 8
+POLLHUP = 16
+
+
+class poll():
+    def __init__(self):
+        self.sockets = {}
+
+    def register(self, sock, mask=POLLIN | POLLOUT):
+        self.sockets[sock] = mask
+
+    def unregister(self, sock):
+        self.sockets.pop(sock, None)
+
+    def poll(self, timeout=-1):
+        # only ever asked with timeout 0, nothing happens in-process while waiting
+        events = []
+        for sock, mask in self.sockets.items():
+            ready = sock.events() & (mask | POLLERR | POLLHUP)
+            if ready:
+                events.append((sock, ready))
+        return events
@@ -0,0 +1,111 @@
+# stand-in for usocket that connects to in-process brokers from broker.py
+#
+# blocking calls that would wait on the network move the virtual clock on by
+# their timeout, so a broker with stall set shows what waiting costs the program
+import broker
+import utime
+import uselect
+
+AF_INET = 2
+SOCK_STREAM = 1
+SOCK_DGRAM = 2
+
+# how long a blocking connect to a host that never answers takes, roughly a
+# TCP stack's SYN retries
+SYN_TIMEOUT = 75
+# how long a blocking read with no timeout waits for a broker that never
+# answers, as good as forever
+FOREVER = 3600
+
+
+def getaddrinfo(host, port, *args):
+    return [(AF_INET, SOCK_STREAM, 0, '', (host, port))]
+
+
+class socket():
+    def __init__(self, *args):
+        self.session = None
+        # None blocks, 0 doesn't, anything else blocks for up to that many seconds
+        self.timeout = None
+        # the broker of a non-blocking connect that hasn't finished yet
+        self.pending = None
+
+    def connect(self, addr):
+        server = broker.BROKERS.get(tuple(addr))
+        if server is None:
+            raise OSError(113)  # EHOSTUNREACH
+        if self.timeout == 0:
+            # finishes when polled
+            self.pending = server
+            raise OSError(115)  # EINPROGRESS
+        if server.stall == 'connect':
+            self.wait(SYN_TIMEOUT)
+            raise OSError(110)  # ETIMEDOUT
+        self.session = server.accept()
+
+    def events(self):
+        # what uselect.poll() sees
+        if self.pending is not None:
+            if self.pending.stall == 'connect':
+                return 0
+            server = self.pending
+            self.pending = None
+            try:
+                self.session = server.accept()
+            except OSError:
+                return uselect.POLLERR | uselect.POLLHUP
+        if self.session is None or self.session.closed:
+            return uselect.POLLERR | uselect.POLLHUP
+        ready = uselect.POLLIN if self.session.to_client else 0
+        if self.session.broker.stall != 'full':
+            ready |= uselect.POLLOUT
+        return ready
+
+    def wait(self, forever):
+        # a blocking call with nothing coming, the program stalls until the timeout
+        utime.advance(self.timeout if self.timeout is not None else forever)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0
+
+    def write(self, buf, length=None):
+        if self.session is None or self.session.closed:
+            raise OSError(104)  # ECONNRESET
+        if self.session.broker.stall == 'full':
+            # the send buffer never empties
+            if self.timeout == 0:
+                raise OSError(11)  # EAGAIN
+            self.wait(FOREVER)
+            raise OSError(110)  # ETIMEDOUT
+        data = bytes(buf) if length is None else bytes(buf[:length])
+        self.session.feed(data)
+        return len(data)
+
+    def read(self, n):
+        pending = self.session.to_client
+        if len(pending) >= n:
+            data = bytes(pending[:n])
+            del pending[:n]
+            return data
+        if self.session.closed:
+            data = bytes(pending)
+            pending.clear()
+            return data
+        if self.timeout == 0:
+            if not pending:
+                return None
+            data = bytes(pending)
+            pending.clear()
+            return data
+        # whatever the broker had to say it already said, so this waits out the timeout
+        self.wait(FOREVER)
+        if len(pending) >= n:
+            return self.read(n)
+        raise OSError(110)  # ETIMEDOUT
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
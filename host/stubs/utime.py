@@ -0,0 +1,123 @@
+# virtual clock standing in for MicroPython's utime
+#
+# time only moves when the program sleeps, so hours of device time run in
+# seconds. timers and scheduled events registered here fire as the clock
+# passes them, and the simulation ends by raising SimulationEnd from sleep()
+import calendar
+import heapq
+import time as _time
+
+# MicroPython counts seconds from 2000-01-01, unix from 1970-01-01
+EPOCH_OFFSET = 946684800
+# ticks wrap at 2^30 like on the device, so code that forgets is caught here
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALF = TICKS_PERIOD // 2
+
+
+class SimulationEnd(BaseException):
+    # BaseException so the program's own "except Exception" blocks can't swallow it
+    pass
+
+
+# seconds since boot, and the wall clock (MicroPython epoch) at boot
+now = 0.0
+wall = 0
+# stop the simulation when the clock reaches this many seconds since boot
+end = None
+# heap of (due, seq, period, callback), period 0 for one shot events
+_events = []
+_seq = 0
+
+
+def reset(start=0.0):
+    global now, wall, end, _events, _seq
+    now = float(start)
+    wall = 0
+    end = None
+    _events = []
+    _seq = 0
+
+
+def schedule(due, callback, period=0):
+    # call callback() when the clock reaches due, then every period seconds
+    global _seq
+    _seq += 1
+    entry = [due, _seq, period, callback]
+    heapq.heappush(_events, entry)
+    return entry
+
+
+def cancel(entry):
+    # cancelled entries stay in the heap with no callback
+    entry[3] = None
+
+
+def advance(seconds):
+    # move the clock forward, firing everything that comes due on the way
+    global now
+    target = now + seconds
+    if end is not None and target >= end:
+        target = end
+    while _events and _events[0][0] <= target:
+        entry = heapq.heappop(_events)
+        if entry[3] is None:
+            continue
+        now = max(now, entry[0])
+        if entry[2]:
+            entry[0] += entry[2]
+            heapq.heappush(_events, entry)
+        entry[3]()
+    now = max(now, target)
+    if end is not None and now >= end:
+        raise SimulationEnd()
+
+
+def sleep(seconds):
+    advance(seconds)
+
+
+def sleep_ms(ms):
+    advance(ms / 1000)
+
+
+def sleep_us(us):
+    advance(us / 1000000)
+
+
+def time():
+    return int(wall + now)
+
+
+def ticks_ms():
+    return int(now * 1000) & TICKS_MAX
+
+
+def ticks_us():
+    return int(now * 1000000) & TICKS_MAX
+
+
+def ticks_diff(new, old):
+    # signed, only right while the two are less than half a period apart
+    return ((new - old + TICKS_HALF) & TICKS_MAX) - TICKS_HALF
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def localtime(secs=None):
+    if secs is None:
+        secs = time()
+    t = _time.gmtime(secs + EPOCH_OFFSET)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, t.tm_wday, t.tm_yday)
+
+
+def mktime(t):
+    return calendar.timegm((t[0], t[1], t[2], t[3], t[4], t[5], 0, 0, 0)) - EPOCH_OFFSET
+
+
+def set_wall(secs):
+    # set the wall clock (MicroPython epoch) to secs as of now
+    global wall
+    wall = secs - int(now)
@@ -0,0 +1,91 @@
+# per-reading kernels for sleep2mqtt.py: ADC averaging, scaling, the state
+# change test and history updates
+#
+# plain Python, so they run anywhere, including under CPython in the host
+# simulator. kernels.benchmark() on the device times them, a compiled version
+# of any of them has to beat those numbers there to be worth adding
+
+
+def adc_total(read, n):
+    # total of n ADC readings
+    total = 0
+    for i in range(n):
+        total += read()
+    return total
+
+
+def pressure(total, count):
+    # float percentage from an ADC total, the sensor's min reading of 142 is
+    # 100% and its max of 3150 is 0%
+    value = total / count
+    return 100 - float(value - 142) / float(3150 - 142) * 100
+
+
+def pressure_fixed(total, count):
+    # the same in hundredths of a percent, rounded, all in small ints. 10000 / 3008
+    # is 625 / 188, which keeps the product small enough for a few hundred
+    # samples per reading
+    return 10000 - ((total - 142 * count) * 625 + count * 94) // (count * 188)
+
+
+def crossing(value, avg, threshold):
+    # 1 when value is more than threshold above avg, -1 when it's more than
+    # threshold below, 0 otherwise
+    change = avg - value
+    if change < 0:
+        change = -change
+    if change > threshold:
+        if value > avg:
+            return 1
+        return -1
+    return 0
+
+
+def movement(value, avg, last):
+    # how far value is from avg, or from the last reading, whichever is more
+    change = avg - value
+    if change < 0:
+        change = -change
+    moved = value - last
+    if moved < 0:
+        moved = -moved
+    if moved > change:
+        return moved
+    return change
+
+
+def ring_fill(values, index, value, n):
+    # write value into n slots of a ring buffer from index on, and return the
+    # sum of what they held. values is an array('i')
+    size = len(values)
+    removed = 0
+    for i in range(n):
+        removed += values[index]
+        values[index] = value
+        index += 1
+        if index == size:
+            index = 0
+    return removed
+
+
+def benchmark(iterations=1000):
+    # us per call for each kernel, on the device
+    import utime
+    from array import array
+    values = array('i', [5000] * 10)
+    read = lambda: 2000
+    kernels = globals()
+    calls = (
+        ('adc_total', lambda f: f(read, 10)),
+        ('pressure', lambda f: f(20000, 10)),
+        ('pressure_fixed', lambda f: f(20000, 10)),
+        ('crossing', lambda f: f(5100, 5000, 50)),
+        ('movement', lambda f: f(5100, 5000, 5050)),
+        ('ring_fill', lambda f: f(values, 7, 5000, 5))
+        )
+    for name, call in calls:
+        f = kernels[name]
+        start = utime.ticks_us()
+        for i in range(iterations):
+            call(f)
+        print('{:<16} {:>8.2f} us'.format(name, utime.ticks_diff(utime.ticks_us(), start) / iterations))
@@ -12,6 +12,8 @@ NTP_DELTA = 3155673600
 
 # The NTP host can be configured at runtime by doing: ntptime.host = 'myhost.org'
 host = "pool.ntp.org"
+# host resolved by query(), kept so only the first query waits on dns
+address = None
 
 
 def time():
@@ -29,10 +31,44 @@ def time():
     return val - NTP_DELTA
 
 
+# time() split in two so the caller doesn't wait on the reply. query() sends
+# the request on a non-blocking socket, reply() is polled until it returns the
+# time. the caller closes the socket and gives up if no reply comes
+def query():
+    global address
+    NTP_QUERY = bytearray(48)
+    NTP_QUERY[0] = 0x1B
+    if address is None:
+        address = socket.getaddrinfo(host, 123)[0][-1]
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setblocking(False)
+    try:
+        s.sendto(NTP_QUERY, address)
+    except:
+        s.close()
+        raise
+    return s
+
+
+def reply(s):
+    # the server's time, None while there's no reply yet
+    try:
+        msg = s.recv(48)
+    except OSError as e:
+        if e.args[0] == 11:  # EAGAIN
+            return None
+        raise
+    if not msg or len(msg) < 48:
+        return None
+    val = struct.unpack("!I", msg[40:44])[0]
+    return val - NTP_DELTA
+
+
 # There's currently no timezone support in MicroPython, so
 # utime.localtime() will return UTC time (as if it was .gmtime())
-def settime():
-    t = time()
+def settime(t=None):
+    if t is None:
+        t = time()
     import machine
     import utime
 
@@ -1,14 +1,20 @@
 import usocket as socket
+import uselect as select
 import ustruct as struct
+import utime
 from ubinascii import hexlify
 
+# errno values for a non-blocking connect that's still going
+EINPROGRESS = 115
+EAGAIN = 11
+
 class MQTTException(Exception):
     pass
 
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, buf_size=512, timeout=None):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
@@ -26,6 +32,24 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # publish packets are assembled here and sent with one write,
+        # it only grows when a message doesn't fit
+        self.buf = bytearray(buf_size)
+        self.mv = memoryview(self.buf)
+        # keepalive pings, rtt is the last round trip in ms until the caller takes it
+        self.ping_sent = 0
+        self.ping_pending = False
+        self.rtt = None
+        # QoS 1 publishes waiting for their PUBACK: [pid, topic, msg, retain, sent ticks_ms]
+        self.inflight = []
+        # seconds any blocking socket operation may take, None waits forever
+        self.timeout = timeout
+        # non-blocking connect: 0 waiting for tcp, 1 waiting for CONNACK
+        self.stage = None
+        self.poller = None
+        self.resp = b""
+        # packet id of the last SUBACK
+        self.suback = None
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
@@ -54,11 +78,60 @@ class MQTTClient:
 
     def connect(self, clean_session=True):
         self.sock = socket.socket()
+        self.sock.settimeout(self.timeout)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
         if self.ssl:
             import ussl
             self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
+        self._send_connect(clean_session)
+        return self._connack(self.sock.read(4))
+
+    def connect_start(self, clean_session=True):
+        # begin connecting without blocking, connect_poll() carries it on.
+        # the server should be an IP address, a name lookup can still block
+        assert not self.ssl, "non-blocking connect is plain tcp only"
+        self.sock = socket.socket()
+        self.sock.setblocking(False)
+        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        try:
+            self.sock.connect(addr)
+        except OSError as e:
+            if e.args[0] not in (EINPROGRESS, EAGAIN):
+                raise
+        self.poller = select.poll()
+        self.poller.register(self.sock, select.POLLOUT)
+        self.clean_session = clean_session
+        self.stage = 0
+        self.resp = b""
+
+    def connect_poll(self):
+        # one step of a connect_start() connect, never blocks. returns True once
+        # the CONNACK is in, raises if the broker refused or went away
+        if self.stage == 0:
+            events = self.poller.poll(0)
+            if not events:
+                return False
+            if events[0][1] & (select.POLLERR | select.POLLHUP):
+                raise OSError(111)  # ECONNREFUSED
+            self.poller.unregister(self.sock)
+            self.poller = None
+            self._send_connect(self.clean_session)
+            self.stage = 1
+        resp = self.sock.read(4 - len(self.resp))
+        if resp is None:
+            return False
+        if resp == b"":
+            raise OSError(-1)
+        self.resp += resp
+        if len(self.resp) < 4:
+            return False
+        self.stage = None
+        self.sock.settimeout(self.timeout)
+        self._connack(self.resp)
+        return True
+
+    def _send_connect(self, clean_session):
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
 
@@ -93,10 +166,13 @@ class MQTTClient:
         if self.user is not None:
             self._send_str(self.user)
             self._send_str(self.pswd)
-        resp = self.sock.read(4)
+
+    def _connack(self, resp):
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
+        self.ping_sent = utime.ticks_ms()
+        self.ping_pending = False
         return resp[2] & 1
 
     def disconnect(self):
@@ -105,60 +181,91 @@ class MQTTClient:
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        self.ping_sent = utime.ticks_ms()
+        self.ping_pending = True
+
+    def publish(self, topic, msg, retain=False, qos=0, wait=True):
+        # topic and msg are bytes-like (bytes, bytearray or memoryview), nothing
+        # is allocated unless the packet is bigger than the buffer
+        # with qos=1 and wait=False this returns the packet id straight away, the
+        # PUBACK is matched in wait_msg() and msg is kept until then, so it must
+        # not be a buffer the caller reuses
+        pid = 0
+        if qos > 0:
+            self.pid = self.pid % 65535 + 1
+            pid = self.pid
+        self._send_publish(topic, msg, retain, qos, pid, False)
+        if qos == 1:
+            self.inflight.append([pid, topic, msg, retain, utime.ticks_ms()])
+            if not wait:
+                return pid
+            while not self.acked(pid):
+                self.wait_msg()
+        elif qos == 2:
+            assert 0
+        return pid
 
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+    def _send_publish(self, topic, msg, retain, qos, pid, dup):
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
+        if sz + 4 > len(self.buf):
+            self.buf = bytearray(sz + 4)
+            self.mv = memoryview(self.buf)
+        buf = self.buf
+        mv = self.mv
+        buf[0] = 0x30 | dup << 3 | qos << 1 | retain
         i = 1
         while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
+            buf[i] = (sz & 0x7f) | 0x80
             sz >>= 7
             i += 1
-        pkt[i] = sz
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        buf[i] = sz
+        i += 1
+        n = len(topic)
+        struct.pack_into("!H", buf, i, n)
+        i += 2
+        mv[i:i + n] = topic
+        i += n
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
+        n = len(msg)
+        mv[i:i + n] = msg
+        self.sock.write(buf, i + n)
+
+    def acked(self, pid):
+        for entry in self.inflight:
+            if entry[0] == pid:
+                return False
+        return True
 
-    def subscribe(self, topic, qos=0):
+    def retransmit(self, timeout_ms):
+        # resend QoS 1 publishes that weren't acked within timeout_ms, with DUP set
+        now = utime.ticks_ms()
+        count = 0
+        for entry in self.inflight:
+            if utime.ticks_diff(now, entry[4]) >= timeout_ms:
+                self._send_publish(entry[1], entry[2], entry[3], 1, entry[0], True)
+                entry[4] = now
+                count += 1
+        return count
+
+    def subscribe(self, topic, qos=0, wait=True):
+        # with wait=False the SUBACK is taken by wait_msg() whenever it arrives
         assert self.cb is not None, "Subscribe callback is not set"
         pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
+        self.pid = self.pid % 65535 + 1
         struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
         #print(hex(len(pkt)), hexlify(pkt, ":"))
         self.sock.write(pkt)
         self._send_str(topic)
         self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                #print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+        if not wait:
+            return
+        while self.suback != self.pid:
+            self.wait_msg()
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
@@ -166,15 +273,36 @@ class MQTTClient:
     # messages processed internally.
     def wait_msg(self):
         res = self.sock.read(1)
-        self.sock.setblocking(True)
+        # the rest of a packet is right behind its first byte, but don't wait
+        # on it forever
+        self.sock.settimeout(self.timeout)
         if res is None:
             return None
         if res == b"":
             raise OSError(-1)
+        if res == b"\x90":  # SUBACK
+            resp = self.sock.read(4)
+            if resp[3] == 0x80:
+                raise MQTTException(resp[3])
+            self.suback = resp[1] << 8 | resp[2]
+            return 0x90
+        if res == b"\x40":  # PUBACK
+            sz = self.sock.read(1)
+            assert sz == b"\x02"
+            pid = self.sock.read(2)
+            pid = pid[0] << 8 | pid[1]
+            for i in range(len(self.inflight)):
+                if self.inflight[i][0] == pid:
+                    del self.inflight[i]
+                    break
+            return 0x40
         if res == b"\xd0":  # PINGRESP
             sz = self.sock.read(1)[0]
             assert sz == 0
-            return None
+            if self.ping_pending:
+                self.rtt = utime.ticks_diff(utime.ticks_ms(), self.ping_sent)
+                self.ping_pending = False
+            return 0xd0
         op = res[0]
         if op & 0xf0 != 0x30:
             return op
@@ -195,10 +323,11 @@ class MQTTClient:
             self.sock.write(pkt)
         elif op & 6 == 4:
             assert 0
+        return op
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # the same processing as wait_msg and returns the packet type.
     def check_msg(self):
         self.sock.setblocking(False)
         return self.wait_msg()
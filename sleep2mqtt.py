@@ -1,29 +1,1135 @@
 import gc
 import json
+import machine
 import network
 import ntptime
 import uos
+import uselect
 import utime
-from copy import deepcopy
-from machine import Pin, ADC
+from array import array
+from machine import Pin, ADC, Timer
 from simple import MQTTClient
 from ubinascii import hexlify
-from m5ui import *
-
-# this program requires 4 additional python libraries to be manually loaded
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
+try:
+    import urandom as random
+except ImportError:
+    import random
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+import kernels
+
+# this program requires 2 additional python libraries to be manually loaded
 #
 # npttime.py 
 #    https://github.com/micropython/micropython/blob/master/ports/esp8266/modules/ntptime.py
 # simple.py
 #    https://github.com/micropython/micropython-lib/blob/master/umqtt.simple/umqtt/simple.py
-# copy.py
-#    https://github.com/micropython/micropython-lib/blob/master/copy/copy.py
-# types.py (needed by copy.py)
-#    https://github.com/micropython/micropython-lib/blob/master/types/types.py
+#
+# kernels.py from this repo holds the per-reading work
 #
 # I recommend compiling all libraies and sleep2mqtt.py with mypcross to save memory:
 #    https://github.com/micropython/micropython/tree/master/mpy-cross
 
+# log levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LOG_LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+# shortest mqtt_keepalive that isn't 0, the loop checks for the ping reply once a second
+KEEPALIVE_MIN_MS = 5000
+# most incoming packets handled in one pass, so a flood can't hold up sampling
+MAX_PACKETS = 16
+# a broker connection that isn't up this long after it was started is given up on
+CONNECT_TIMEOUT_MS = 10000
+# longest any blocking broker socket call may take once connected, in seconds
+SOCKET_TIMEOUT = 2
+# an ntp query with no reply this long after it was sent is given up on
+NTP_TIMEOUT_MS = 1000
+# broker port, part of the discovery hash as well as the connection
+MQTT_PORT = 1883
+
+# sensor state topic payload, rendered in one pass without building a dict
+ATTRIBUTES = ('{{"occupancy": {}, "pressure": "{:0.2f}", "avg_off": "{:0.2f}", "avg_on": "{:0.2f}", '
+              '"ideal_pressure": {}, "delta": {}, "last_seen": "{}"}}')
+
+def deadline(seconds):
+    # a ticks_ms value seconds from now. intervals are timed in ticks like
+    # Backoff, the wall clock jumps when ntp syncs
+    return utime.ticks_add(utime.ticks_ms(), int(seconds * 1000))
+
+
+def reached(due):
+    return utime.ticks_diff(utime.ticks_ms(), due) >= 0
+
+
+class History():
+    '''
+    fixed capacity ring buffer of pressure readings with a running sum, so the
+    on/off baselines update in O(1) per sample without allocating new lists
+        Parameters:
+            size = number of readings in the sliding average
+            scale = None for float percentages, or readings are ints in 1/scale percent
+    '''
+    def __init__(self, size=10, scale=None):
+        self.size = size
+        self.scale = scale
+        if scale:
+            # small ints never touch the heap, floats do on MicroPython
+            self.values = array('i', [0] * size)
+            self.total = 0
+            self.avg = 0
+        else:
+            # doubles, so the host runs the same sums as CPython's floats. the
+            # ring is small, and on the device a float is single precision anyway
+            self.values = array('d', [0.0] * size)
+            self.total = 0.0
+            self.avg = 0.0
+        self.count = 0
+        self.index = 0
+
+
+    def push(self, value, n=1):
+        # overwrite the n oldest readings with value and adjust the running sum
+        if self.scale:
+            # ints can't drift, so the running sum is never re-summed
+            self.total += value * n - kernels.ring_fill(self.values, self.index, value, n)
+            self.index = (self.index + n) % self.size
+            self.count = min(self.count + n, self.size)
+        else:
+            for k in range(n):
+                i = self.index
+                self.total += value - self.values[i]
+                self.values[i] = value
+                i += 1
+                if i == self.size:
+                    i = 0
+                    # re-sum once per lap so float rounding can't drift the running total
+                    self.total = sum(self.values)
+                self.index = i
+
+                if self.count < self.size:
+                    self.count += 1
+
+        # the average only moves once the window is fully populated
+        if self.count == self.size:
+            if self.scale:
+                self.avg = (self.total + (self.size >> 1)) // self.size
+            else:
+                self.avg = self.total / self.size
+
+
+    def fill(self, value):
+        # seed every slot with the same reading
+        for i in range(self.size):
+            self.values[i] = value
+        self.total = value * self.size
+        self.count = self.size
+        self.index = 0
+        self.avg = value
+
+
+    def load(self, values, avg):
+        # restore from a list of readings (oldest first) and a saved average,
+        # the state file always holds percentages
+        self.total = 0 if self.scale else 0.0
+        self.count = 0
+        self.index = 0
+        for i in range(self.size):
+            self.values[i] = 0
+        self.avg = self.units(avg)
+        for value in values[-self.size:]:
+            self.push(self.units(value))
+
+
+    def units(self, percent):
+        # a percentage as stored in this history
+        if self.scale:
+            return int(round(float(percent) * self.scale))
+        return float(percent)
+
+
+    def to_list(self):
+        # readings in the order they were taken, oldest first, as percentages
+        if self.count < self.size:
+            values = list(self.values[:self.count])
+        else:
+            values = list(self.values[self.index:]) + list(self.values[:self.index])
+        if self.scale:
+            return [value / self.scale for value in values]
+        return values
+
+
+class Sampler():
+    '''
+    sums ADC samples taken at a fixed rate from a hardware timer, and hands
+    back one averaged reading per decimation period. only running totals are
+    kept, so the timer callback never allocates
+        Parameters:
+            adc = the configured ADC to sample
+            decimation = number of samples averaged into each reading
+    '''
+    all_samplers = []
+    timer = None
+    def __init__(self, adc, decimation=10):
+
+        Sampler.all_samplers.append(self)
+
+        self.adc = adc
+        self.decimation = decimation
+        # samples so far in the period in progress
+        self.index = 0
+        # running total of the period in progress and of the last complete one
+        self.total = 0
+        self.reading = 0
+        self.fresh = False
+
+
+    def tick(self):
+        # called from the timer, so no allocation in here
+        self.total += self.adc.read()
+        self.index += 1
+        if self.index == self.decimation:
+            self.reading = self.total
+            self.total = 0
+            self.index = 0
+            self.fresh = True
+
+
+    def take(self):
+        # return the ADC total of the latest period, or None if no new period has completed
+        if not self.fresh:
+            return None
+        self.fresh = False
+        return self.reading
+
+
+    def start(period):
+        # one hardware timer drives every sampler, a sample every period ms
+        Sampler.timer = Timer(0)
+        Sampler.timer.init(period=period, mode=Timer.PERIODIC, callback=sample_tick)
+
+
+def sample_tick(timer):
+    for sampler in Sampler.all_samplers:
+        sampler.tick()
+
+
+class RawStream():
+    '''
+    packs raw readings and their tick times into binary frames for
+    sleep2mqtt/<clientid>/raw/<sensor>. the frames are preallocated, so the
+    stream can stay on all night without adding to the heap
+        Parameters:
+            topic = raw topic for this sensor, bytes
+            samples = readings per frame
+            frames = frames kept while waiting to be sent, the oldest is dropped when full
+    '''
+    # header: version, readings in the frame, sequence number, ticks_ms of the first reading
+    HEADER = '<BBHI'
+    # each reading: ms after the first one, ADC average in 1/16 counts
+    READING = '<HH'
+    VERSION = 1
+    def __init__(self, topic, samples=32, frames=4):
+        self.topic = topic
+        # the count goes in one byte
+        self.samples = min(samples, 255)
+        self.frames = [bytearray(8 + 4 * self.samples) for i in range(frames)]
+        self.views = [memoryview(frame) for frame in self.frames]
+        # complete frames start at head, the one being filled comes after them
+        self.head = 0
+        self.queued = 0
+        self.count = 0
+        self.base = 0
+        self.seq = 0
+        self.sent = 0
+        self.dropped = 0
+
+
+    def add(self, ticks, total, count):
+        # a reading too far from the start of the frame for its offset closes it early
+        if self.count and utime.ticks_diff(ticks, self.base) > 0xFFFF:
+            self.close()
+        if self.count == 0:
+            self.base = ticks
+        frame = self.frames[(self.head + self.queued) % len(self.frames)]
+        struct.pack_into(RawStream.READING, frame, 8 + 4 * self.count,
+            utime.ticks_diff(ticks, self.base), min(total * 16 // count, 0xFFFF))
+        self.count += 1
+        if self.count == self.samples:
+            self.close()
+
+
+    def close(self):
+        # finish the frame being filled, dropping the oldest unsent one if it's in the way
+        frame = self.frames[(self.head + self.queued) % len(self.frames)]
+        struct.pack_into(RawStream.HEADER, frame, 0,
+            RawStream.VERSION, self.count, self.seq, self.base & 0xFFFFFFFF)
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.count = 0
+        self.queued += 1
+        if self.queued == len(self.frames):
+            self.head = (self.head + 1) % len(self.frames)
+            self.queued -= 1
+            self.dropped += 1
+
+
+    def next(self):
+        # oldest complete frame, or None. a frame closed early is cut to the
+        # readings it has, the slots after them are left over from older frames
+        if not self.queued:
+            return None
+        return self.views[self.head][:8 + 4 * self.frames[self.head][1]]
+
+
+    def done(self):
+        # the frame from next() went out
+        self.head = (self.head + 1) % len(self.frames)
+        self.queued -= 1
+        self.sent += 1
+
+
+class StateStore():
+    '''
+    shared write-behind cache of the state file. sensors mark themselves dirty,
+    and one merged snapshot is written per flush via a temp file and rename
+        Parameters:
+            path = state file on the sd card
+            interval = seconds between flushes of routine history changes
+            settle = seconds to wait before flushing an occupancy change
+    '''
+    def __init__(self, path='/sd/state.json', interval=300, settle=2):
+        self.path = path
+        self.tmp = path + '.tmp'
+        self.interval = interval
+        self.settle = settle
+        self.dirty = {}
+        self.due = None
+        # flush stats
+        self.writes = 0
+        self.bytes = 0
+        self.last_ms = 0
+        self.max_ms = 0
+        self.total_ms = 0
+        self.state = self.load()
+
+
+    def load(self):
+        # the temp file only survives if power was lost between remove and rename
+        for path in (self.path, self.tmp):
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except Exception as e:
+                print('error loading state from {}: {}'.format(path, e))
+        return {}
+
+
+    def get(self, name):
+        return self.state.get(name)
+
+
+    def mark(self, sensor, urgent=False):
+        # remember the sensor and schedule a flush, occupancy changes go out sooner
+        self.dirty[sensor.name] = sensor
+        if urgent:
+            due = deadline(self.settle)
+        elif self.due is None:
+            due = deadline(self.interval)
+        else:
+            return
+        if self.due is None or utime.ticks_diff(due, self.due) < 0:
+            self.due = due
+
+
+    def flush(self, force=False):
+        # write one snapshot of every dirty sensor when due
+        for step in self.flushing(force):
+            pass
+
+
+    def flushing(self, force=False):
+        # flush() as a generator that yields between sd card operations, so the
+        # asyncio runtime can let the sensors run while the card is busy.
+        # sensors marked in the meantime go in the next snapshot
+        if not self.dirty or (not force and not reached(self.due)):
+            return
+
+        start = utime.ticks_ms()
+        dirty = self.dirty
+        self.dirty = {}
+        self.due = None
+        for name, sensor in dirty.items():
+            self.state[name] = sensor.state_entry()
+
+        try:
+            data = json.dumps(self.state)
+            with open(self.tmp, 'w') as f:
+                f.write(data)
+            yield
+            try:
+                uos.remove(self.path)
+            except OSError:
+                pass
+            yield
+            uos.rename(self.tmp, self.path)
+        except Exception as e:
+            print('error saving state: {}'.format(e))
+            mount_sd()
+            for name, sensor in dirty.items():
+                if name not in self.dirty:
+                    self.dirty[name] = sensor
+            # try again once the card had a chance to remount
+            due = deadline(self.settle)
+            if self.due is None or utime.ticks_diff(due, self.due) < 0:
+                self.due = due
+            return
+
+        ms = utime.ticks_diff(utime.ticks_ms(), start)
+        self.writes += 1
+        self.bytes += len(data)
+        self.last_ms = ms
+        self.max_ms = max(self.max_ms, ms)
+        self.total_ms += ms
+
+
+    def stats(self):
+        return {
+            "writes": self.writes,
+            "bytes": self.bytes,
+            "last_ms": self.last_ms,
+            "max_ms": self.max_ms,
+            "avg_ms": self.total_ms // self.writes if self.writes else 0
+            }
+
+
+class ConfigStore():
+    '''
+    debounced saves of config.json. mqtt commands mark the config changed, and
+    a burst of them is written to the sd card and republished to
+    sleep2mqtt/config once, after the commands stop coming
+        Parameters:
+            settle = seconds without another change before saving
+            limit = most seconds a change waits while more keep coming
+    '''
+    def __init__(self, settle=5, limit=60):
+        self.settle = settle
+        self.limit = limit
+        self.due = None
+        self.first = None
+        self.restart = False
+        self.writes = 0
+
+
+    def mark(self, restart=False):
+        # push the save back with every change, but no further than limit
+        # after the first one. restart when a changed setting only applies on boot
+        due = deadline(self.settle)
+        if self.first is None:
+            self.first = utime.ticks_ms()
+        last = utime.ticks_add(self.first, self.limit * 1000)
+        self.due = due if utime.ticks_diff(due, last) < 0 else last
+        if restart:
+            self.restart = True
+
+
+    def flush(self, force=False):
+        # save and publish once when due, then restart if a setting needs it.
+        # a forced flush comes from a restart that's already on its way
+        if self.due is None or (not force and not reached(self.due)):
+            return
+        if not save_config():
+            # keep the change, and any restart it needs, for another try
+            self.due = deadline(self.settle)
+            return
+        self.due = None
+        self.first = None
+        self.writes += 1
+        if self.restart and not force:
+            self.restart = False
+            restart_and_reconnect(1)
+
+
+class LogSink():
+    '''
+    buffers log lines in RAM and appends them to the sd card in batches,
+    rotating through a fixed number of files so the log can't grow without bound
+        Parameters:
+            path = log file on the sd card
+            level = lowest level that gets written to the sd card
+            flush_level = lines at or above this level are written out right away
+            max_lines = buffered lines that trigger a flush
+            interval = seconds between timed flushes
+            max_size = bytes before the log file is rotated
+            files = number of rotated files kept besides the current one
+    '''
+    def __init__(self, path='/sd/log.txt', level=INFO, flush_level=WARNING,
+                 max_lines=20, interval=60, max_size=65536, files=2):
+        self.path = path
+        self.level = level
+        self.flush_level = flush_level
+        self.max_lines = max_lines
+        self.interval = interval
+        self.max_size = max_size
+        self.files = files
+        self.lines = []
+        self.due = None
+        # the asyncio runtime leaves every write to the persistence task
+        self.deferred = False
+        try:
+            self.size = uos.stat(path)[6]
+        except OSError:
+            self.size = 0
+
+
+    def write(self, line, level=INFO):
+        if level < self.level:
+            return
+        self.lines.append(line)
+        if self.due is None:
+            self.due = deadline(self.interval)
+        if level >= self.flush_level or len(self.lines) >= self.max_lines:
+            if self.deferred:
+                # due right away, written on the next persistence pass
+                self.due = utime.ticks_ms()
+            else:
+                self.flush(force=True)
+
+
+    def flush(self, force=False):
+        # append the buffered lines in one write when full, due or forced
+        for step in self.flushing(force):
+            pass
+
+
+    def flushing(self, force=False):
+        # flush() as a generator that yields between sd card operations,
+        # lines logged in the meantime wait for the next flush
+        if not self.lines or (not force and not reached(self.due)):
+            return
+        lines = self.lines
+        self.lines = []
+        self.due = None
+        data = '\n'.join(lines) + '\n'
+        try:
+            with open(self.path, 'a') as f:
+                f.write(data)
+        except Exception as e:
+            print('ERROR writing log file: {}'.format(e))
+            mount_sd()
+            # keep the lines for the next attempt, but never more than a buffer full
+            self.lines[0:0] = lines
+            del self.lines[:-self.max_lines]
+            self.due = deadline(self.interval)
+            return
+
+        self.size += len(data)
+        if self.size > self.max_size:
+            yield
+            self.rotate()
+
+
+    def rotate(self):
+        # log.txt -> log.txt.1 -> log.txt.2 ... dropping the oldest
+        try:
+            if self.files < 1:
+                # no rotated copies kept, start log.txt over
+                with open(self.path, 'w'):
+                    pass
+            for i in range(self.files, 0, -1):
+                older = '{}.{}'.format(self.path, i)
+                newer = '{}.{}'.format(self.path, i - 1) if i > 1 else self.path
+                try:
+                    uos.remove(older)
+                except OSError:
+                    pass
+                try:
+                    uos.rename(newer, older)
+                except OSError:
+                    pass
+            self.size = 0
+        except Exception as e:
+            print('ERROR rotating log file: {}'.format(e))
+
+
+class Outbox():
+    '''
+    bounded queue of publishes held while the broker is unreachable. a newer
+    retained message replaces a queued one for the same topic, and critical
+    messages (occupancy transitions) are never dropped
+        Parameters:
+            size = messages held in RAM before the oldest non-critical one is dropped
+            spill = file on the sd card for critical overflow, None keeps them in RAM
+    '''
+    def __init__(self, size=32, spill=None):
+        self.size = size
+        self.spill = spill
+        # entries are [topic, msg, critical], oldest first
+        self.queue = []
+        # topic -> queued entry that a newer message may still replace
+        self.latest = {}
+        self.dropped = 0
+        self.spilled = 0
+        if spill:
+            try:
+                uos.stat(spill)
+                # left over from before a reboot, replay it on the next drain
+                self.spilled = 1
+            except OSError:
+                pass
+
+
+    def pending(self):
+        return len(self.queue) + self.spilled
+
+
+    def put(self, topic, msg, critical=False):
+        entry = self.latest.get(topic)
+        if entry is not None and not critical:
+            # only the newest retained value matters
+            entry[1] = msg
+            return
+
+        entry = [topic, msg, critical]
+        self.queue.append(entry)
+        if critical:
+            # later updates queue behind the transition instead of replacing anything before it
+            self.latest.pop(topic, None)
+        else:
+            self.latest[topic] = entry
+
+        if len(self.queue) > self.size:
+            self.evict()
+
+
+    def evict(self):
+        # drop the oldest message that isn't critical
+        for i in range(len(self.queue)):
+            entry = self.queue[i]
+            if not entry[2]:
+                del self.queue[i]
+                self.forget(entry)
+                self.dropped += 1
+                return
+
+        # everything queued is critical, move the oldest to the sd card if allowed
+        # otherwise keep it, transitions are rare and must not be lost
+        if self.spill:
+            entry = self.queue[0]
+            try:
+                topic = entry[0]
+                msg = entry[1]
+                if isinstance(topic, bytes):
+                    topic = topic.decode()
+                if isinstance(msg, bytes):
+                    msg = msg.decode()
+                with open(self.spill, 'a') as f:
+                    f.write(json.dumps([topic, msg]) + '\n')
+                self.queue.pop(0)
+                self.spilled += 1
+            except Exception as e:
+                print('error spilling outbox: {}'.format(e))
+
+
+    def forget(self, entry):
+        if self.latest.get(entry[0]) is entry:
+            del self.latest[entry[0]]
+
+
+    def requeue(self, entries):
+        # put [topic, msg] pairs that were sent but never confirmed back in
+        # front of everything else, as critical
+        self.queue[0:0] = [[entry[0], entry[1], True] for entry in entries]
+        for i in range(len(self.queue) - self.size):
+            self.evict()
+
+
+    def drain(self, send):
+        # send everything in order, send() raises on failure and the rest stays queued
+        # send() returning False means not right now, and the rest waits too
+        count = 0
+        if self.spilled:
+            count += self.drain_spill(send)
+            if self.spilled:
+                return count
+        while self.queue:
+            entry = self.queue[0]
+            if send(entry[0], entry[1], entry[2]) is False:
+                break
+            self.queue.pop(0)
+            self.forget(entry)
+            count += 1
+        return count
+
+
+    def drain_spill(self, send):
+        # spilled messages are older than anything in RAM
+        try:
+            with open(self.spill, 'r') as f:
+                lines = f.readlines()
+        except OSError:
+            self.spilled = 0
+            return 0
+
+        sent = 0
+        try:
+            for line in lines:
+                topic, msg = json.loads(line)
+                if send(topic, msg, True) is False:
+                    break
+                sent += 1
+        finally:
+            if sent < len(lines):
+                # keep whatever didn't make it for the next drain
+                try:
+                    with open(self.spill, 'w') as f:
+                        for line in lines[sent:]:
+                            f.write(line)
+                except OSError as e:
+                    print('error rewriting outbox spill: {}'.format(e))
+        if sent < len(lines):
+            return sent
+
+        # an sd card error isn't the broker's fault, the file is sent again next pass
+        try:
+            uos.remove(self.spill)
+        except OSError as e:
+            print('error removing outbox spill: {}'.format(e))
+            return sent
+        self.spilled = 0
+        return sent
+
+
+class PublishPolicy():
+    '''
+    decides when a sensor's state topic is worth publishing. occupancy changes
+    always go out, other changes at most every interval, and nothing is quiet
+    for longer than the heartbeat
+        Parameters:
+            interval = minimum seconds between updates that aren't occupancy changes
+            heartbeat = maximum seconds between updates
+            deadband = how far pressure or an average must move to count as changed
+    '''
+    def __init__(self, interval=30, heartbeat=300, deadband=0.5):
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.deadband = deadband
+
+
+    def due(self, sensor, state_changed):
+        if state_changed:
+            return True
+        silence = utime.ticks_diff(utime.ticks_ms(), sensor.timestamp())
+        if silence >= self.heartbeat * 1000:
+            return True
+        if silence < self.interval * 1000:
+            return False
+        return self.changed(sensor)
+
+
+    def changed(self, sensor):
+        # compare each field against what was last published
+        last = sensor.published
+        if last is None:
+            return True
+        deadband = self.deadband
+        return (last[0] != sensor.current_state
+            or abs(last[1] - sensor.value) >= deadband
+            or abs(last[2] - sensor.history["on"].avg) >= deadband
+            or abs(last[3] - sensor.history["off"].avg) >= deadband
+            or last[4] != sensor.ideal_pressure
+            or last[5] != sensor.delta)
+
+
+class Cadence():
+    '''
+    adaptive read rate. a sensor whose pressure is moving or getting close to
+    the state change threshold is read fast so a transition is seen sooner, and
+    a stable one is read slowly. the history still advances once per base period
+    however often the sensor is read
+        Parameters:
+            fast_ms = read period while active
+            slow_ms = read period while stable
+            base_ms = history period, one push per base_ms of elapsed time
+            near = fraction of the state change threshold that counts as active
+            hold_ms = how long to stay fast after the last sign of activity
+    '''
+    def __init__(self, fast_ms=100, slow_ms=2000, base_ms=1000, near=0.25, hold_ms=5000):
+        self.fast_ms = fast_ms
+        self.slow_ms = slow_ms
+        self.base_ms = base_ms
+        # as a percentage, so the test stays in ints for fixed point sensors
+        self.near = int(round(near * 100))
+        self.hold_ms = hold_ms
+
+
+    def pushes(self, sensor, now):
+        # base periods since the last history push, rounded so reads that wobble
+        # around the period still push once each. for a while after activity
+        # starts the history is held, so a change stands out against the baseline
+        # from before it instead of one that's already following it
+        if sensor.onset is not None and utime.ticks_diff(now, sensor.onset) < self.hold_ms:
+            return 0
+        pushes = (utime.ticks_diff(now, sensor.pushed_at) + (self.base_ms >> 1)) // self.base_ms
+        if pushes <= 0:
+            return 0
+        sensor.pushed_at = utime.ticks_add(sensor.pushed_at, pushes * self.base_ms)
+        return pushes
+
+
+    def update(self, sensor, moved, threshold, now):
+        # moved is how far the reading is from the average, or moved since the
+        # last read. near enough to the threshold counts as activity. returns
+        # the next period
+        if moved * 100 >= threshold * self.near:
+            if sensor.onset is None:
+                sensor.onset = now
+            sensor.active_at = now
+        if sensor.active_at is not None and utime.ticks_diff(now, sensor.active_at) <= self.hold_ms:
+            return self.fast_ms
+        # forget the activity, an old tick would wrap after ~6 days and count again
+        sensor.onset = None
+        sensor.active_at = None
+        return self.slow_ms
+
+
+    def due(self, sensor, now):
+        return utime.ticks_diff(now, sensor.read_at) >= sensor.period
+
+
+    def wake(self, now):
+        # ms until the next sensor read is due
+        wait = self.slow_ms
+        for sensor in BedSensor.sensors():
+            wait = min(wait, sensor.period - utime.ticks_diff(now, sensor.read_at))
+        return max(0, wait)
+
+
+class Backoff():
+    '''
+    jittered exponential backoff between reconnect attempts, timed in ticks so
+    the ntp clock jump doesn't matter. each failure doubles the delay up to a
+    cap, and the actual wait is picked at random from the upper half so devices
+    that lost the same broker don't all come back at the same moment
+        Parameters:
+            base_ms = delay after the first failure
+            cap_ms = longest delay
+    '''
+    def __init__(self, base_ms=1000, cap_ms=60000):
+        self.base_ms = base_ms
+        self.cap_ms = cap_ms
+        self.failures = 0
+        # None when there's nothing to wait for. a stored tick that old would
+        # wrap after ~6 days and look like it's still in the future
+        self.at = None
+
+
+    def ready(self):
+        return self.at is None or utime.ticks_diff(utime.ticks_ms(), self.at) >= 0
+
+
+    def failed(self):
+        # schedule the next attempt, returns the wait in ms
+        delay = min(self.cap_ms, self.base_ms << min(self.failures, 16))
+        self.failures += 1
+        half = delay >> 1
+        delay = half + ((delay - half) * random.getrandbits(16) >> 16)
+        self.at = utime.ticks_add(utime.ticks_ms(), delay)
+        return delay
+
+
+    def reset(self):
+        self.failures = 0
+        self.at = None
+
+
+class Discovery():
+    '''
+    Home Assistant discovery configs, built once as encoded topic and payload
+    bytes. a hash of the whole set is kept on the sd card so an unchanged set
+    isn't republished at boot, the retained copies on the broker are still good.
+    the broker and client id are hashed too, a new broker has none of them
+        Parameters:
+            broker = broker host, port and client id the set is published with
+            path = file on the sd card holding the hash of the last published set
+    '''
+    def __init__(self, broker='', path='/sd/discovery.txt'):
+        self.broker = broker.encode()
+        self.path = path
+        # (topic, payload) bytes, in publish order
+        self.configs = []
+        self.hash = None
+
+
+    def add(self, topic, payload):
+        self.configs.append((topic.encode(), payload.encode()))
+        self.hash = None
+
+
+    def digest(self):
+        if self.hash is None:
+            h = hashlib.sha256()
+            h.update(self.broker)
+            h.update(b'\n')
+            for topic, payload in self.configs:
+                h.update(topic)
+                h.update(b'\n')
+                h.update(payload)
+                h.update(b'\n')
+            self.hash = hexlify(h.digest()).decode()
+        return self.hash
+
+
+    def changed(self):
+        # compare against the hash saved after the last publish
+        try:
+            with open(self.path, 'r') as f:
+                return f.read().strip() != self.digest()
+        except OSError:
+            return True
+
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as f:
+                f.write(self.digest())
+        except Exception as e:
+            print('error saving discovery hash: {}'.format(e))
+
+
+    def replay(self, publish):
+        # hand every cached config to publish(topic, payload), nothing gets rebuilt
+        for topic, payload in self.configs:
+            publish(topic, payload)
+        return len(self.configs)
+
+
+class JsonBuffer():
+    '''
+    reusable bytearray that json is written into a piece at a time. the
+    message goes to the mqtt client as a memoryview of it, so a big payload
+    is built once without a str copy, and later ones reuse the memory
+        Parameters:
+            size = starting size in bytes, it grows when a message doesn't fit
+    '''
+    def __init__(self, size=1024):
+        self.buf = bytearray(size)
+        self.length = 0
+
+
+    def reset(self):
+        self.length = 0
+
+
+    def write(self, s):
+        if isinstance(s, str):
+            s = s.encode()
+        end = self.length + len(s)
+        if end > len(self.buf):
+            # at least double, so a growing message doesn't reallocate every write
+            self.buf.extend(bytearray(max(end, 2 * len(self.buf)) - len(self.buf)))
+        self.buf[self.length:end] = s
+        self.length = end
+
+
+    def view(self):
+        # the message so far, only valid until the next reset
+        return memoryview(self.buf)[:self.length]
+
+
+class Display():
+    '''
+    M5Stack lcd status screen. the widgets are created once, and a line is only
+    erased and redrawn when its text has changed
+        Parameters:
+            sensors = bed sensors to show, 4 lines each
+            top = y position of the first line
+            height = line height
+    '''
+    def __init__(self, sensors, top=50, height=20):
+        self.height = height
+        self.rows = []
+        y = top
+        for sensor in sensors:
+            # the name label never changes, so it isn't tracked
+            M5TextBox(0, y, '{}:'.format(sensor.key),
+                lcd.FONT_DejaVu18, 0xFFFFFF, rotate=0)
+            lines = []
+            for i in range(3):
+                y += height
+                # y, the widget and the text last drawn on it
+                lines.append([y, M5TextBox(0, y, '', lcd.FONT_DejaVu18, 0xFFFFFF, rotate=0), None])
+            y += height
+            # sensor, its pressure/occupancy/averages lines, then the values they
+            # were last formatted from, so an unchanged value isn't even formatted
+            self.rows.append([sensor, lines, None, None, None, None])
+
+
+    def refresh(self):
+        for row in self.rows:
+            sensor = row[0]
+            lines = row[1]
+
+            if sensor.value != row[2]:
+                row[2] = sensor.value
+                self.draw(lines[0], '  p: {}%'.format(sensor.pressure_text()))
+
+            if sensor.current_state != row[3]:
+                row[3] = sensor.current_state
+                self.draw(lines[1], '  occupied' if sensor.current_state else '  vacant')
+
+            on_avg = sensor.history['on'].avg
+            off_avg = sensor.history['off'].avg
+            if on_avg != row[4] or off_avg != row[5]:
+                row[4] = on_avg
+                row[5] = off_avg
+                self.draw(lines[2], '  on: {:0.2f} / off: {:0.2f}'.format(
+                    sensor.percent(on_avg), sensor.percent(off_avg)))
+
+
+    def draw(self, line, text):
+        # erase the previous text and write the new one, unless it reads the same
+        if text == line[2]:
+            return
+        line[2] = text
+        lcd.rect(0, line[0], 320, self.height, 0x000000, 0x000000)
+        line[1].setText(text)
+
+
+    def invalidate(self):
+        # forget what's on screen so every line is redrawn on the next refresh
+        for row in self.rows:
+            row[2] = None
+            row[3] = None
+            row[4] = None
+            row[5] = None
+            for line in row[1]:
+                line[2] = None
+
+
+class Diagnostics():
+    '''
+    always-on runtime metrics. each stage keeps a count, min/avg/max and a
+    histogram of its time in microseconds, and the window starts over every
+    time a report is taken
+        Parameters:
+            interval = seconds between reports, 0 never reports
+            period_ms = loop period, passes that take longer are overruns
+            started = ticks_ms when the program started, boot phases are timed from here
+    '''
+    # histogram buckets in ms: <1, <2, <4, <8, <16, <32, <64, <128, >=128
+    buckets = 9
+    def __init__(self, interval=300, period_ms=1000, started=None):
+        self.interval = interval
+        self.period_us = period_ms * 1000
+        # boot phase -> ms after start when it finished
+        self.started = utime.ticks_ms() if started is None else started
+        self.boot = {}
+        self.stages = {}
+        self.due = deadline(interval)
+        # uptime is summed from ticks, the wall clock jumps when ntp syncs
+        self.uptime = 0
+        self.ticks = utime.ticks_ms()
+        self.loops = 0
+        self.overruns = 0
+        self.heap_min = None
+        self.heap_free = 0
+        self.reconnects = 0
+        self.connect_failures = 0
+        self.wifi_drops = 0
+        self.retransmits = 0
+
+
+    def record(self, name, us):
+        stat = self.stages.get(name)
+        if stat is None:
+            # count, total, min, max, histogram
+            stat = [0, 0, us, us, array('H', [0] * Diagnostics.buckets)]
+            self.stages[name] = stat
+        stat[0] += 1
+        stat[1] += us
+        if us < stat[2]:
+            stat[2] = us
+        if us > stat[3]:
+            stat[3] = us
+        bucket = 0
+        ms = us >> 10
+        while ms and bucket < Diagnostics.buckets - 1:
+            ms >>= 1
+            bucket += 1
+        if stat[4][bucket] < 65535:
+            stat[4][bucket] += 1
+
+
+    def phase(self, name):
+        # mark a boot phase as done, returns ms since start
+        ms = utime.ticks_diff(utime.ticks_ms(), self.started)
+        self.boot[name] = ms
+        return ms
+
+
+    def lap(self, name, since):
+        # record the time since a ticks_us mark and return a new mark
+        now = utime.ticks_us()
+        self.record(name, utime.ticks_diff(now, since))
+        return now
+
+
+    def loop(self, us, heap_free):
+        self.loops += 1
+        self.record('loop', us)
+        if us > self.period_us:
+            self.overruns += 1
+        self.heap_free = heap_free
+        if self.heap_min is None or heap_free < self.heap_min:
+            self.heap_min = heap_free
+
+
+    def ready(self):
+        return self.interval and reached(self.due)
+
+
+    def report(self):
+        # compact summary of the window, then start a new one
+        stages = {}
+        for name, stat in self.stages.items():
+            # count, min, avg, max in us, then the histogram
+            stages[name] = [stat[0], stat[2], stat[1] // stat[0], stat[3], list(stat[4])]
+        now = utime.ticks_ms()
+        self.uptime += utime.ticks_diff(now, self.ticks)
+        self.ticks = now
+        message = {
+            "uptime": self.uptime // 1000,
+            "loops": self.loops,
+            "overruns": self.overruns,
+            "heap_free": self.heap_free,
+            "heap_min": self.heap_min,
+            "reconnects": self.reconnects,
+            "connect_failures": self.connect_failures,
+            "wifi_drops": self.wifi_drops,
+            "retransmits": self.retransmits,
+            "boot": self.boot,
+            "stages": stages
+            }
+        self.stages = {}
+        self.loops = 0
+        self.overruns = 0
+        self.heap_min = None
+        self.due = deadline(self.interval)
+        return message
+
+
 class BedSensor():
     '''
     only tested with MPXV7002GP analog differential pressure sensors on ESP32
@@ -33,64 +1139,105 @@ class BedSensor():
             pin = analog pin on ESP32 connected to the MPXV7002GP sensor
             ideal_pressure = the perfect pressure to maintain at all times
             delta = the amount of pressure increase for a person
+            history_size = number of readings in the on/off sliding averages
+            decimation = samples per reading when sampled by the timer, None reads inline
+            key = the sensor's name in config.json, the first word of name if not given
     '''
     all_sensors = []
+    # registry of sensors by name and by config key, for lookups from mqtt commands
+    by_name = {}
+    by_key = {}
     sensitivity = 1
-    def __init__(self, name, pin, ideal_pressure, delta):
+    # 10 - state_sensitivity, the integer form of sensitivity
+    tenths = 0
+    # 100 when readings, averages and thresholds are hundredths of a percent in
+    # small ints, None for floats. set from the fixed_point setting before any
+    # sensor is created
+    scale = None
+    # shared StateStore for the state file on the sd card
+    store = None
+    # shared Cadence for adaptive read rates, None pushes history every read
+    cadence = None
+    def __init__(self, name, pin, ideal_pressure, delta, history_size=10, decimation=None, key=None):
         
         BedSensor.all_sensors.append(self)
 
         self.name = name
+        self.key = key if key is not None else name.split(' ')[0]
+        BedSensor.by_name[name] = self
+        BedSensor.by_key[self.key] = self
+        # state topic, encoded once
+        self.topic = 'sleep2mqtt/{}'.format(name).encode()
         self.ideal_pressure = ideal_pressure
+        # latest pressure, a percentage or 1/scale percent
         self.value = 0
-        self.p_value = 0
         self.pin = ADC(Pin(pin))
         self.pin.atten(ADC.ATTN_11DB)
         self.pin.width(ADC.WIDTH_12BIT)
+        # bound once, so inline reads don't allocate a bound method each time
+        self.adc_read = self.pin.read
+        if decimation:
+            self.sampler = Sampler(self.pin, decimation)
+        else:
+            self.sampler = None
 
         # keep and track a pressure history that adapts to a delta
-        self.history = {}
+        self.history = {
+            "on": History(history_size, BedSensor.scale),
+            "off": History(history_size, BedSensor.scale)
+            }
         # the % of difference between on/off
-        self.delta = delta
+        self.set_delta(delta)
         # timestamps
         self.ts = None
         self.timestamp(update=True)
-        self.saved_timestamp = utime.time()
+        # fields of the last state topic publish, for change detection
+        self.published = None
         self.ideal_pressure_ts = utime.time()
         self.warmed_up = False
+        # adaptive read rate: last read, current period, last history push, and
+        # when activity was last seen and first seen in this episode
+        self.read_at = utime.ticks_ms()
+        self.period = 1000
+        self.pushed_at = self.read_at
+        self.active_at = None
+        self.onset = None
+        self.last_value = None
+        # RawStream when raw readings are streamed, see main()
+        self.stream = None
         # load sensor data from state file on disk
         self.restore_state()
 
 
     def quiet_read(self):
-        # read sensor, but don't process it
-        smooth = []
-        for x in range(10):
-            smooth.append(self.pin.read())
-        value = sum(smooth) / len(smooth)
-        return value
+        # read sensor, but don't process it, returns the total of 10 readings
+        return kernels.adc_total(self.adc_read, 10)
 
 
     def read(self):
+        self.read_at = utime.ticks_ms()
+
+        # new value is taken from the timer sampler's latest period,
+        # or the total of 10 readings when there is no sampler
+        if self.sampler is not None:
+            total = self.sampler.take()
+            if total is None:
+                # nothing new since the last read
+                return False
+            count = self.sampler.decimation
+        else:
+            total = self.quiet_read()
+            count = 10
 
-        # new value is taken from the average of 10 readings
-        smooth = []
-        for x in range(10):
-            smooth.append(self.pin.read())
-        
-        value = sum(smooth) / len(smooth)
-
-        # scale voltage to 0-1 range based on sensor min/max
-        scaled = float(value - 142) / float(3150 - 142)
-        
-        # convert the scaled value to percentage of total
-        self.value = 100 - (scaled * 100)
+        if self.stream is not None:
+            self.stream.add(self.read_at, total, count)
 
-        # create a "print" value - 100 should have no decimal, otherwise pad to 2 decimal points
-        if self.value == 100:
-            self.p_value = "100"
+        # scale the average to a percentage of the sensor's range, or to
+        # hundredths of one in small ints
+        if BedSensor.scale:
+            self.value = kernels.pressure_fixed(total, count)
         else:
-            self.p_value = "{:0.2f}".format(self.value) # 2 decimal points with trailing 0
+            self.value = kernels.pressure(total, count)
 
         # determine if the state has changed using self-updating adptive data
         state_changed = self.adaptive_state()
@@ -101,6 +1248,31 @@ class BedSensor():
         # sets how sensitive the sensor is to state change
         # 1 is least sensitive, 10 is most sensitive
         BedSensor.sensitivity = float((10 - sensivity)/10)
+        BedSensor.tenths = 10 - sensivity
+
+
+    def set_delta(self, delta):
+        # the delta as a percentage, and in the units the histories use
+        self.delta = delta
+        if BedSensor.scale:
+            self.delta_units = int(round(delta * BedSensor.scale))
+        else:
+            self.delta_units = delta
+
+
+    def percent(self, value):
+        # a reading or average of this sensor as a percentage, for payloads and the screen
+        if BedSensor.scale:
+            return value / BedSensor.scale
+        return value
+
+
+    def pressure_text(self):
+        # 100 has no decimals, otherwise pad to 2 decimal points
+        value = self.percent(self.value)
+        if value == 100:
+            return "100"
+        return "{:0.2f}".format(value)
 
 
     def adaptive_state(self):
@@ -108,81 +1280,88 @@ class BedSensor():
         # and continually adapt the sensor on/off baselines
         # 
         # This function tracks sensor history for both on/off and compares new readings 
-        # against a sliding average of the last 10 readings to determine state change 
+        # against a sliding average of the last history_size readings to determine state change 
         # 
 
         state_changed = False
+        value = self.value
+        last = self.last_value
+        self.last_value = value
+
 
         # store history data (by on/off name) based on state
-        if self.state():
-            state = "on"
-            anti_state = "off"
+        if self.current_state:
+            history = self.history["on"]
+            anti_history = self.history["off"]
         else:
-            state = "off"
-            anti_state = "on"
+            history = self.history["off"]
+            anti_history = self.history["on"]
 
-        history = self.history[state]
-        history_avg = self.history["{}_avg".format(state)]
+        # the history average only moves once it's fully populated
+        avg = history.avg
 
-        # average the history when fully populated
-        if len(history) == 10:
-            avg = sum(history) / len(history)
+        # the difference between history average and current value that counts
+        if BedSensor.scale:
+            threshold = self.delta_units * BedSensor.tenths // 10
         else:
-            avg = history_avg
-
-        # calc the difference between history average and current value
-        change = abs(avg - float(self.value))
+            threshold = self.delta * BedSensor.sensitivity
 
         # check for state change
-        if change > (self.delta * BedSensor.sensitivity):
-            if float(self.value) > avg:  # if the pressure is rising...
-                if self.state(): # who cares if it's already on
-                    pass 
-                else: # somebody got in bed
-                    self.state(state=True)
-                    state_changed = True
-            else: # the pressure is dropping...
-                if self.state(): # somebody got out of bed
-                    self.state(state=False)
-                    state_changed = True
-                else: 
-                    pass # nobody was in bed anyway
+        crossed = kernels.crossing(value, avg, threshold)
+        if crossed > 0:  # if the pressure is rising...
+            if self.current_state: # who cares if it's already on
+                pass 
+            else: # somebody got in bed
+                self.state(state=True)
+                state_changed = True
+        elif crossed < 0: # the pressure is dropping...
+            if self.current_state: # somebody got out of bed
+                self.state(state=False)
+                state_changed = True
+            else: 
+                pass # nobody was in bed anyway
+
+        # read fast while the pressure is near the threshold or moving, and only
+        # move the history once per base period however often it's read
+        cadence = BedSensor.cadence
+        if cadence is None:
+            pushes = 1
+        else:
+            now = self.read_at
+            if last is None:
+                last = value
+            self.period = cadence.update(self, kernels.movement(value, avg, last), threshold, now)
+            if state_changed:
+                # time from the first sign of activity until the change was called
+                diagnostics.record('detect', utime.ticks_diff(now, self.onset) * 1000)
+                self.onset = None
+                # a transition always goes into the histories, and restarts the base period
+                pushes = 1
+                self.pushed_at = now
+            else:
+                pushes = min(cadence.pushes(self, now), self.history["on"].size)
 
         # direct self.value and a delta of self.value to the correct histories
         if state_changed:
             self.ideal_pressure_ts = utime.time()
             self.warmed_up = False
-            value_target = anti_state
-            delta_target = state
+            value_target = anti_history
+            delta_target = history
         else:
-            value_target = state
-            delta_target = anti_state
-
-        # save the current self.value to the correct history
-        self.history[value_target].append(float(self.value))
-
-        # save a delta of self.value to the opposite history
-        if self.state(): # if it's on, delta is removed
-            self.history[delta_target].append(float(self.value) - float(self.delta))
-        else: # if it's off, delta is added
-            self.history[delta_target].append(float(self.value) + float(self.delta))
-            
-        # keep only last 10 values of each history
-        while len(self.history[state]) > 10:
-            self.history[state].pop(0)
-
-        while len(self.history[anti_state]) > 10:
-            self.history[anti_state].pop(0)
-
-        # update averages
-        if len(self.history[state]) == 10:
-            self.history["{}_avg".format(state)] = sum(self.history[state]) / len(self.history[state])
-
-        if len(self.history[anti_state]) == 10:
-            self.history["{}_avg".format(anti_state)] = sum(self.history[anti_state]) / len(self.history[anti_state])
-
-        # update state file every 5m
-        if utime.time() - self.saved_timestamp > 300:
+            value_target = history
+            delta_target = anti_history
+
+        if pushes:
+            if self.current_state: # if it's on, delta is removed
+                delta = value - self.delta_units
+            else: # if it's off, delta is added
+                delta = value + self.delta_units
+            # save the current self.value to the correct history
+            value_target.push(value, pushes)
+            # save a delta of self.value to the opposite history
+            delta_target.push(delta, pushes)
+
+            # the history changed, the state store writes it out every few minutes
             self.save_state()
 
         return state_changed
@@ -193,7 +1372,7 @@ class BedSensor():
         # otherwise, update internal state and write to disk
         if state is not None:
             self.current_state = state
-            self.save_state()
+            self.save_state(urgent=True)
         else:
             return self.current_state
 
@@ -218,70 +1397,69 @@ class BedSensor():
             print('error reading: {}'.format(e))
 
 
-    def save_state(self):
-        # read last state file from sd card
-        try:
-            with open('/sd/state.json', 'r') as f:
-                state = json.load(f)
-        except Exception as e:
-            print('error loading state {}'.format(e))
-            state = {}
+    def save_state(self, urgent=False):
+        # mark for the shared state store, which coalesces writes from all sensors
+        BedSensor.store.mark(self, urgent)
 
-        # udpate state for self
-        state[self.name] = {}
-        state[self.name]['state'] = self.state()
-        state[self.name]['history'] = self.history
 
-        # write state to back to file
-        try:
-            with open('/sd/state.json', 'w+') as f: 
-                json.dump(state, f)
-            self.saved_timestamp = utime.time()
-        except Exception as e:
-            print('error saving state: {}'.format(e))
-            mount_sd()
+    def state_entry(self):
+        # this sensor's entry in the state file
+        return {
+            "state": self.current_state,
+            "history": self.history_state()
+            }
 
 
     def restore_state(self):
         # load previous state from sd card
-        loaded = False
-        try:
-            with open('/sd/state.json', 'r') as f: 
-                state = json.load(f)
-            loaded = True
-        except Exception as e:
-            print('Error loading state json for {}: {}'.format(self.name, e))
+        state = BedSensor.store.get(self.name)
+        if state is None:
+            print('No saved state for {}'.format(self.name))
             self.current_state = False
             self.create_history()
+            return
 
-        if loaded:
-            try:
-                self.current_state = state[self.name]['state']
-            except Exception as e:
-                print('Error restoring state for {}: {}'.format(self.name, e))
-                self.current_state = False
+        try:
+            self.current_state = state['state']
+        except Exception as e:
+            print('Error restoring state for {}: {}'.format(self.name, e))
+            self.current_state = False
 
-            try:
-                self.history = state[self.name]['history']
-            except Exception as e:
-                print('Error restoring history for {}: {}'.format(self.name, e))
-                self.create_history()
+        try:
+            self.load_history(state['history'])
+        except Exception as e:
+            print('Error restoring history for {}: {}'.format(self.name, e))
+            self.create_history()
 
 
     def create_history(self):
         # seed history data with reasonable assumptions
-        self.history["on"] = []
-        self.history["off"] = []
-        for i in range(10):
-            self.history["off"].append(float(self.ideal_pressure - self.delta))
-            self.history["on"].append(float(self.ideal_pressure))
-        self.history["off_avg"] = float(float(self.ideal_pressure - self.delta))
-        self.history["on_avg"] = float(self.ideal_pressure)
+        off = self.history["off"]
+        on = self.history["on"]
+        off.fill(off.units(self.ideal_pressure - self.delta))
+        on.fill(on.units(self.ideal_pressure))
+
+
+    def load_history(self, saved):
+        # restore histories from the state file layout
+        self.history["on"].load(saved["on"], saved["on_avg"])
+        self.history["off"].load(saved["off"], saved["off_avg"])
+
+
+    def history_state(self):
+        # histories in the state file layout
+        return {
+            "on": self.history["on"].to_list(),
+            "off": self.history["off"].to_list(),
+            "on_avg": self.percent(self.history["on"].avg),
+            "off_avg": self.percent(self.history["off"].avg)
+            }
 
 
     def timestamp(self, update=False):
+        # ticks_ms of the last publish
         if update:
-            self.ts = utime.time()
+            self.ts = utime.ticks_ms()
         else:
             return self.ts
 
@@ -291,10 +1469,11 @@ class BedSensor():
 
 
     def sensor_name(name):
-        for sensor in BedSensor.sensors():
-            if sensor.name == name:
-                return sensor
-        return None
+        return BedSensor.by_name.get(name)
+
+
+    def sensor_key(key):
+        return BedSensor.by_key.get(key)
 
 
 ##################################
@@ -305,14 +1484,17 @@ class BedSensor():
 
 
 def save_config():
+    # returns whether the config made it to the sd card
     try:
         with open(config_file, 'w+') as f: 
             json.dump(config, f)
         log('saved config')
-        publish_config_mqtt()
     except Exception as e:
-        log('error saving config: {}'.format(e))
+        log('error saving config: {}'.format(e), ERROR)
         mount_sd()
+        return False
+    publish_config_mqtt()
+    return True
 
 
 def load_config():
@@ -325,22 +1507,14 @@ def load_config():
                 config = json.load(f)
             return config
         except Exception as e:
-            log('error loading config file {}'.format(e))
+            log('error loading config file {}'.format(e), ERROR)
             machine.reset()
     except Exception as e:
-        log('cannot find {}'.format(config_file))
-        log('Error: {}'.format(e))
+        log('cannot find {}'.format(config_file), ERROR)
+        log('Error: {}'.format(e), ERROR)
         machine.reset()
 
 
-def fib(n):
-    # return the nth number in the Fibonacci sequence
-    # this is used for retry backoffs
-    if n == 0: return 0
-    elif n == 1: return 1
-    else: return fib(n-1)+fib(n-2)
-
-
 def buttonA_wasPressed():
     # decrease brightness 
     global brightness
@@ -374,21 +1548,16 @@ def mount_sd():
         pass
 
 
-def log(thing):
+def log(thing, level=INFO):
     # print to console for live logging over usb serial
-    print('{} - {}'.format(current_time(), thing))
-    if config:
-        if config['settings']['logging']:
-            try:
-                with open('/sd/log.txt', 'a+') as f: 
-                    if current_time().startswith('1999'):
-                        f.write('{}\n'.format(thing))
-                    else:
-                        f.write('{} - {}\n'.format(current_time(), thing))
-
-            except Exception as e:
-                print('ERROR writing log file: {}'.format(e))
-                mount_sd()
+    now = current_time()
+    print('{} - {}'.format(now, thing))
+    # buffer for the sd card, it gets written in batches
+    if logger is not None:
+        if now.startswith('1999'):
+            logger.write('{}'.format(thing), level)
+        else:
+            logger.write('{} - {}'.format(now, thing), level)
 
 
 def current_time(gmt_offset=-5):
@@ -401,54 +1570,162 @@ def current_time(gmt_offset=-5):
 
 
 def restart_and_reconnect(sec=10):
-    log('Restarting device in {} sec...'.format(sec))
+    log('Restarting device in {} sec...'.format(sec), WARNING)
+    # don't lose config changes or sensor history still waiting to be saved
+    if config_store is not None:
+        config_store.flush(force=True)
+    send_queued()
+    if BedSensor.store is not None:
+        BedSensor.store.flush(force=True)
+    if logger is not None:
+        logger.flush(force=True)
     utime.sleep(sec)
     machine.reset()
 
 
-def connect_wifi():
-    # setup WiFi network
+def start_wifi():
+    # start joining the WiFi network, check_wifi() looks after it from the loop
+    global station
+    global wifi_connected
     station = network.WLAN(network.STA_IF)
     station.active(True)
     station.connect(config['settings']['wifi_ssid'], config['settings']['wifi_pass'])
-    
-    log('connecting to wifi, restarting...')
-    
-    r = 1
-    while not station.isconnected():
-        time.sleep_ms(500)
-        r = r + 1
-        # status dots
-        print('.', end=' ')
-        if r > 30:
-            print('')
-            log('cannot connect to wifi, restarting...')
-            machine.reset()
-
-    print('')
-    log('WiFi connection successful')
-    log(station.ifconfig())
-
+    wifi_connected = False
+    # ask again if it hasn't joined by the time the backoff runs out
+    wifi_backoff.failed()
+    log('connecting to wifi')
+
+
+def check_wifi():
+    # returns True while the station has an address. when it doesn't, the
+    # broker connection is dropped and the network is rejoined with backoff
+    global wifi_connected
+    if station.isconnected():
+        if not wifi_connected:
+            wifi_connected = True
+            wifi_backoff.reset()
+            log('WiFi connection successful')
+            log(station.ifconfig())
+        return True
+
+    if wifi_connected:
+        wifi_connected = False
+        diagnostics.wifi_drops += 1
+        log('WiFi connection lost', WARNING)
+        if mqtt_connected:
+            mqtt_disconnected()
+
+    if wifi_backoff.ready():
+        log('trying to join wifi again', WARNING)
+        wifi_backoff.failed()
+        try:
+            station.disconnect()
+            station.connect(config['settings']['wifi_ssid'], config['settings']['wifi_pass'])
+        except OSError as e:
+            log('Error joining wifi: {}'.format(e), ERROR)
+    return False
 
-def network_setup():
-    # setup WiFi network
-    connect_wifi()
 
-    # sync clock with ntp
+def sync_clock():
+    # one non-blocking step of an ntp sync. the first call sends the query and
+    # later ones pick up the reply, ntp_socket is set while it's outstanding.
+    # on failure carry on and try again later
+    global clock_synced
+    global ntp_socket
+    global ntp_started
     try:
-        ntptime.settime()
-        log('Clock synced with ntp server')
+        if ntp_socket is None:
+            # only the first query waits on the dns lookup, ntptime keeps the address
+            ntp_socket = ntptime.query()
+            ntp_started = utime.ticks_ms()
+        t = ntptime.reply(ntp_socket)
+        if t is None:
+            if utime.ticks_diff(utime.ticks_ms(), ntp_started) < NTP_TIMEOUT_MS:
+                return False
+            raise OSError(110)  # ETIMEDOUT
+        ntptime.settime(t)
     except Exception as e:
-        log('Error during clock sync: {}'.format(e))
-        restart_and_reconnect(1)
+        log('Error during clock sync: {}'.format(e), ERROR)
+        ntp_backoff.failed()
+        ntp_close()
+        return False
+    ntp_close()
+    clock_synced = True
+    log('Clock synced with ntp server')
+    return True
+
+
+def ntp_close():
+    global ntp_socket
+    if ntp_socket is not None:
+        ntp_socket.close()
+        ntp_socket = None
+
+
+def boot_step():
+    # one non-blocking step of the network side of booting, called from check_mqtt
+    # sensors are already sampling, so nothing here may wait on the network
+    # returns True once the broker is connected
+    global boot_stage
+
+    if boot_stage == 'wifi':
+        if not check_wifi():
+            return False
+        diagnostics.phase('wifi')
+        boot_stage = 'ntp'
+
+    if boot_stage == 'ntp':
+        # a failed sync is retried from check_mqtt, boot only waits on the reply
+        if not sync_clock() and ntp_socket is not None:
+            return False
+        diagnostics.phase('ntp')
+        boot_stage = 'mqtt'
+
+    if boot_stage == 'mqtt':
+        # setup mqtt, if the broker isn't there yet publishes wait in the outbox.
+        # the connection is carried on over the next few passes, and retried
+        # with backoff until the broker is there
+        if not check_wifi():
+            return False
+        reconnect_mqtt()
+        if not mqtt_connected:
+            return False
+        diagnostics.phase('mqtt')
+        # sensor states go out first, anything queued before ntp had a 1999 time
+        # so it gets replaced
+        for sensor in BedSensor.sensors():
+            update_mqtt_attributes(sensor)
+        boot_stage = 'publish'
 
-    # setup mqtt
-    try:
-        mqtt_connect()
+    if boot_stage == 'publish':
+        # config and discovery only follow once the states are sent, which
+        # can take a few passes
+        if not mqtt_connected:
+            return True
+        drain_outbox()
+        if outbox.pending():
+            return True
+        diagnostics.phase('first_publish')
         publish_config_mqtt()
-    except OSError as e:
-        log('Error creating MQTT client: {}'.format(e))
-        restart_and_reconnect()
+        if publish_ha_configs():
+            boot_stage = 'discovery'
+        else:
+            boot_stage = 'done'
+
+    if boot_stage == 'discovery':
+        # the hash is only saved once the configs actually reached the broker
+        if outbox.pending():
+            return True
+        discovery.save()
+        boot_stage = 'done'
+
+    if boot_stage == 'done':
+        diagnostics.phase('discovery')
+        boot_stage = None
+        log('boot finished, first state published {} ms after start'.format(
+            diagnostics.boot['first_publish']))
+
+    return True
 
 
 ##################################
@@ -459,12 +1736,15 @@ def network_setup():
 
 
 def create_ha_configs():
-    # create home assistant mqtt config topics from config data
-    # and publush them to mqtt
+    # create home assistant mqtt config topics from config data, they're
+    # published later by publish_ha_configs()
+    global discovery
+    discovery = Discovery('{}:{}/{}'.format(
+        config['settings']['mqtt_server'], MQTT_PORT, config['settings']['mqtt_clientid']))
     i = 0
     for sensor, values in config['sensors'].items():
         # create/update home assistant occupancy config topics
-        publish_ha_config(
+        ha_config(
             name='{} Bed Occupancy'.format(sensor),
             state_topic="sleep2mqtt/{} Bed Occupancy".format(sensor),
             number=i,
@@ -477,7 +1757,7 @@ def create_ha_configs():
         i+=1
 
         # create/update home assistant pressure config topics
-        publish_ha_config(
+        ha_config(
             name='{} Bed Pressure'.format(sensor),
             state_topic="sleep2mqtt/{} Bed Occupancy".format(sensor),
             number=i,
@@ -491,9 +1771,8 @@ def create_ha_configs():
         i+=1    
 
 
-def publish_ha_config(name, state_topic, number, device_class, model, template=None, payload_on=None):
-    # create mqtt config topics for "homeassistant/" topic
-    # run this function this after creating the "sleep2mqtt/" topics
+def ha_config(name, state_topic, number, device_class, model, template=None, payload_on=None):
+    # create mqtt config topics for "homeassistant/" topic and add them to discovery
     if payload_on is not None:
         sensor_type = "binary_sensor"
     else:
@@ -530,7 +1809,19 @@ def publish_ha_config(name, state_topic, number, device_class, model, template=N
     else:
         ha_conf["unit_of_measurement"] = "%"
 
-    publish_mqtt(message=ha_conf, topic=topic)
+    discovery.add(topic, json.dumps(ha_conf))
+
+
+def publish_ha_configs(force=False):
+    # publish the cached discovery configs, unless the same set went out before
+    # returns True when anything was published
+    if not force and not discovery.changed():
+        log('home assistant configs unchanged, not republishing')
+        return False
+    count = discovery.replay(
+        lambda topic, payload: publish_mqtt(payload, topic=topic, raw=True))
+    log('published {} home assistant configs'.format(count), DEBUG)
+    return True
 
 
 ##################################
@@ -540,193 +1831,517 @@ def publish_ha_config(name, state_topic, number, device_class, model, template=N
 ##################################
 
 
+def command_sensor(message):
+    # the sensor a command is for, by its friendly name or its config key
+    name = message.get('sensor_name')
+    if type(name) is not str:
+        raise ValueError('sensor_name missing')
+    sensor = BedSensor.sensor_name(name) or BedSensor.sensor_key(name)
+    if sensor is None:
+        raise ValueError('unknown sensor {}'.format(name))
+    return sensor
+
+
+def command_value(message, low, high, kinds=(int, float)):
+    # the command's numeric value, within low and high
+    value = message.get('value')
+    if type(value) not in kinds or not low <= value <= high:
+        if kinds == (int,):
+            raise ValueError('value must be a whole number from {} to {}'.format(low, high))
+        raise ValueError('value must be a number from {} to {}'.format(low, high))
+    return value
+
+
+def command_reset(message, apply=True):
+    sensor = command_sensor(message)
+    if not apply:
+        return
+    log('mqtt reset message for {}'.format(sensor.name))
+    sensor.reset()
+    update_mqtt_attributes(sensor)
+
+
+def command_ideal_pressure(message, apply=True):
+    sensor = command_sensor(message)
+    value = command_value(message, 0, 100)
+    if not apply:
+        return
+    log('mqtt change ideal_pressure on {} from {} to {}'.format(
+        sensor.key,
+        sensor.ideal_pressure,
+        value)
+    )
+    # update sensor
+    sensor.ideal_pressure = value
+    # save to config file
+    config['sensors'][sensor.key]['ideal_pressure'] = value
+    config_store.mark()
+
+
+def command_delta(message, apply=True):
+    sensor = command_sensor(message)
+    value = command_value(message, 0, 100)
+    if not apply:
+        return
+    log('mqtt change delta on {} from {} to {}'.format(
+        sensor.name,
+        sensor.delta,
+        value)
+    )
+    # update sensor
+    sensor.set_delta(value)
+    # save to config file
+    config['sensors'][sensor.key]['delta'] = value
+    config_store.mark()
+
+
+def command_settings(message, apply=True):
+    # only settings already in the config file can be changed, to a value of the same kind
+    setting = message.get('setting')
+    if type(setting) is not str or setting not in config['settings']:
+        raise ValueError('unknown setting {}'.format(setting))
+    old = config['settings'][setting]
+    if setting == 'state_sensitivity':
+        # a whole number keeps BedSensor.tenths, and the fixed point threshold, an int
+        value = command_value(message, 1, 10, (int,))
+    else:
+        value = message.get('value')
+        number = (int, float)
+        if type(old) != type(value) and not (type(old) in number and type(value) in number):
+            raise ValueError('{} must be a {}'.format(setting, type(old).__name__))
+    if not apply:
+        return
+
+    log('mqtt change setting {} from {} to {}'.format(setting, old, value))
+
+    config['settings'][setting] = value
+
+    # update bed sensor sensitivity if needed, other settings need a restart
+    # once the config is saved
+    if setting == "state_sensitivity":
+        BedSensor.set_sensitivity(value)
+        config_store.mark()
+    else:
+        config_store.mark(restart=True)
+
+
+# sleep2mqtt/control commands. each handler checks its own arguments first,
+# and stops there when apply is False
+COMMANDS = {
+    'reset': command_reset,
+    'ideal_pressure': command_ideal_pressure,
+    'delta': command_delta,
+    'settings': command_settings
+    }
+
+
 def mqtt_callback(top, msg):
     # call back function for receiving messages on subscribed topics
     #
-    #   examples for sending commands to topic sleep2mqtt/control:
+    #   examples for sending commands to topic sleep2mqtt/control, see COMMANDS:
     #       {"command": "reset", "sensor_name": "Dan Bed Occupancy"}
-    #       {"command": "calibrate", "sensor_name": "Dan Bed Occupancy"}
     #       {"command": "ideal_pressure", "sensor_name": "Dan Bed Occupancy", "value": 42}
-    #       {"command": "settings", "variable": "max_drift", "value": 6}
-    #       {"command": "air_exchange", "variable": "cycles", "value": 3}
+    #       {"command": "delta", "sensor_name": "Dan", "value": 12}
+    #       {"command": "settings", "setting": "state_sensitivity", "value": 6}
+    #
+    #   or a list of them, applied together only if every one of them is valid:
+    #       [{"command": "delta", "sensor_name": "Dan", "value": 12},
+    #        {"command": "ideal_pressure", "sensor_name": "Dan", "value": 40}]
     #   
-    global config
 
     topic = top.decode()
     try:
         message = json.loads(msg.decode())
     except:
-        log('mqtt message not json, reading string')
+        log('mqtt message not json, reading string', DEBUG)
         message = msg.decode()
 
-    log('mqtt callback topic: {}, message: {}'.format(topic, message))
+    log('mqtt callback topic: {}, message: {}'.format(topic, message), DEBUG)
     if topic == "sleep2mqtt/control":
+        # one dict lookup finds each handler, anything else is turned away
+        commands = message if type(message) is list else [message]
+        handlers = []
+        for command in commands:
+            name = command.get('command') if type(command) is dict else None
+            handler = COMMANDS.get(name) if type(name) is str else None
+            if handler is None:
+                log('message "{}" not recognized'.format(message), ERROR)
+                return
+            handlers.append(handler)
+        # check every command before any of them changes something
         try:
-            if message['command'] == 'reset':
-                for sensor in BedSensor.sensors():
-                    if sensor.name == message['sensor_name']:
-                        log('mqtt reset message for {}'.format(sensor.name))
-                        sensor.reset()
-                        update_mqtt_attributes(sensor)
-
-            if message['command'] == 'ideal_pressure':
-                for sensor in BedSensor.sensors():
-                    if sensor.name == message['sensor_name']:
-                        name = sensor.name.split(' ')[0]
-                        log('mqtt change delta on {} from {} to {}'.format(
-                            name,
-                            sensor.ideal_pressure,
-                            message['value'])
-                        )  
-                        # update sensor
-                        sensor.ideal_pressure = message['value']
-                        # save to config file
-                        config['sensors'][name]['ideal_pressure'] = message['value']
-                        save_config()
-
-            if message['command'] == 'delta':
-                for sensor in BedSensor.sensors():
-                    if sensor.name == message['sensor_name']:
-                        log('mqtt change delta on {} from {} to {}'.format(
-                            sensor.name,
-                            sensor.delta,
-                            message['value'])
-                        )                        
-                        # update sensor
-                        sensor.delta = message['value']
-                        # save to config file
-                        name = sensor.name.split(' ')[0]
-                        config['sensors'][name]['delta'] = message['value']
-                        save_config()
-
-            if message['command'] == 'settings':
-                try:
-
-                    log('mqtt change setting {} from {} to {}'.format(
-                        message['setting'],
-                        config['settings'][message['setting']],
-                        message['value'])
-                    )
-
-                    config['settings'][message['setting']] = message['value']
-
-                    save_config()
-
-                    # update bed sensor sensitivity if needed
-                    if message['setting'] == "state_sensitivity":
-
-                        BedSensor.set_sensitivity(message['value'])
-                    else:
-                        log('rebooting')
-                        time.sleep(1)
-                        machine.reset()
-                
-                except Exception as e:
-                    log('error ({}) setting config with: {}'.format(e, message))
-
+            for i in range(len(commands)):
+                handlers[i](commands[i], False)
         except Exception as e:
-            log('message "{}" not recognized: {}'.format(message, e))
+            log('error ({}) with command: {}'.format(e, message), ERROR)
+            return
+        for i in range(len(commands)):
+            try:
+                handlers[i](commands[i])
+            except Exception as e:
+                log('error ({}) with command: {}'.format(e, commands[i]), ERROR)
 
-    if topic == "hass/status":
-        # when home assistant reboots, push latest data to mqtt
+    if topic == "hass/status" and message == 'online':
+        # when home assistant reboots, replay the cached configs and push latest data to mqtt
         log('homeassistant online, publishing configs')
-        create_ha_configs()
+        publish_ha_configs(force=True)
         for sensor in BedSensor.sensors():
             update_sensor(sensor, push=True)
 
 
+def dump_redacted(obj, write):
+    # write obj as json through write(), masking *_pass values on the way out
+    # so the live config never needs to be copied
+    if isinstance(obj, dict):
+        write('{')
+        dump_members(obj, write)
+        write('}')
+    elif isinstance(obj, list):
+        write('[')
+        for i in range(len(obj)):
+            if i:
+                write(', ')
+            dump_redacted(obj[i], write)
+        write(']')
+    elif isinstance(obj, str):
+        dump_string(obj, write)
+    elif obj is True:
+        write('true')
+    elif obj is False:
+        write('false')
+    elif obj is None:
+        write('null')
+    else:
+        write(str(obj))
+
+
+def dump_members(obj, write):
+    # the members of dict obj without its braces, returns how many were written
+    count = 0
+    for key, value in obj.items():
+        # separator, key and colon go in one write
+        dump_string(key, write, ', ' if count else '', ': ')
+        count += 1
+        if key.endswith('_pass'):
+            write('"***"')
+        else:
+            dump_redacted(value, write)
+    return count
+
+
+def dump_string(s, write, before='', after=''):
+    # s quoted, between before and after. config strings rarely need escaping,
+    # those that do go through json
+    if '"' in s or '\\' in s or (s and min(s) < ' '):
+        write('{}{}{}'.format(before, json.dumps(s), after))
+    else:
+        write('{}"{}"{}'.format(before, s, after))
+
+
 def publish_config_mqtt():
-    # copy config and remove passwords first
-    message = deepcopy(config)
-    message['published'] = current_time()
-    for item, value in message['settings'].items():
-        if item.endswith('_pass'):
-            message['settings'][item] = '***'
+    # serialize the config with passwords masked, plus when it was published,
+    # straight into the reusable buffer the client publishes from
+    config_json.reset()
+    write = config_json.write
+    write('{')
+    count = dump_members(config, write)
+    dump_string('published', write, ', ' if count else '', ': ')
+    dump_string(current_time(), write)
+    write('}')
     # publish to config topic
-    publish_mqtt(message, topic='sleep2mqtt/config')
+    publish_mqtt(config_json.view(), topic='sleep2mqtt/config', raw=True)
 
 
-def check_mqtt():
-    # check for new messages to any subscribed topics, new messages to go callback
-    for retry in range(10):
-        try:
-            client.check_msg()
+def check_mqtt(writes=None):
+    # drive the connection from the loop: finish booting, then make sure wifi
+    # and the broker are there, then publish anything queued and check for new
+    # messages to any subscribed topics, new messages to go callback
+    # a lost connection is retried with backoff, it never reboots the device
+    # writes limits the socket writes in this pass, see mqtt_ready()
+    global mqtt_writes
+    mqtt_writes = writes
+    if boot_stage is not None and not boot_step():
+        return
+
+    if not check_wifi():
+        return
+
+    if not clock_synced and (ntp_socket is not None or ntp_backoff.ready()):
+        sync_clock()
+
+    if not mqtt_connected:
+        reconnect_mqtt()
+        return
+
+    if outbox.pending():
+        drain_outbox()
+        if not mqtt_connected:
             return
-        except OSError as e:
-            log("Error checking MQTT messages: {}".format(e))
-            utime.sleep(fib(retry))
 
-    # should only get here after 10 failed backed off retries
-    restart_and_reconnect()
+    try:
+        keepalive()
+        # everything that came in since the last pass, acks first of all
+        for i in range(MAX_PACKETS):
+            if not mqtt_ready(uselect.POLLIN) or client.check_msg() is None:
+                break
+        if retransmit_due() and mqtt_ready():
+            diagnostics.retransmits += client.retransmit(qos_timeout_ms)
+        send_raw()
+    except OSError as e:
+        log("Error checking MQTT messages: {}".format(e), ERROR)
+        mqtt_disconnected()
+
+
+def keepalive():
+    # ping every half keepalive period. a ping that goes unanswered for a whole
+    # period means the broker is gone even if the socket hasn't noticed yet.
+    # a keepalive of 0 turns it off, like it does for the broker
+    if not keepalive_ms:
+        return
+    if client.rtt is not None:
+        diagnostics.record('ping', client.rtt * 1000)
+        client.rtt = None
+    elapsed = utime.ticks_diff(utime.ticks_ms(), client.ping_sent)
+    if client.ping_pending:
+        if elapsed > keepalive_ms:
+            raise OSError('no ping response in {} ms'.format(elapsed))
+    elif elapsed >= keepalive_ms // 2 and mqtt_ready():
+        client.ping()
+
+
+def retransmit_due():
+    # whether a QoS 1 publish has waited qos_timeout for its PUBACK
+    now = utime.ticks_ms()
+    for entry in client.inflight:
+        if utime.ticks_diff(now, entry[4]) >= qos_timeout_ms:
+            return True
+    return False
+
+
+def mqtt_ready(event=uselect.POLLOUT):
+    # whether the next socket read or write can go ahead in this pass. with
+    # no write limit it always can. the asyncio runtime only reads or writes
+    # once a poll says it won't wait, and writes one packet per pass so the
+    # sensor tasks get the event loop in between
+    global mqtt_writes
+    if mqtt_writes is None:
+        return True
+    if event == uselect.POLLOUT and not mqtt_writes:
+        return False
+    for entry in mqtt_poller.poll(0):
+        if entry[1] & (uselect.POLLERR | uselect.POLLHUP):
+            raise OSError('broker connection closed')
+        if entry[1] & event:
+            if event == uselect.POLLOUT:
+                mqtt_writes -= 1
+            return True
+    return False
 
 
 def mqtt_connect():
+    # start connecting to the broker without waiting on it, mqtt_connect_step()
+    # carries it on a step at a time from check_mqtt
     global client
+    global mqtt_connecting
+    global connect_started
 
     client = MQTTClient(
         config['settings']['mqtt_clientid'].encode(),
         config['settings']['mqtt_server'],
-        1883,
+        MQTT_PORT,
         config['settings']['mqtt_user'].encode(),
-        config['settings']['mqtt_pass'].encode())
+        config['settings']['mqtt_pass'].encode(),
+        keepalive=keepalive_ms // 1000,
+        timeout=SOCKET_TIMEOUT)
     
     client.set_callback(mqtt_callback)
-    client.connect()
-    client.subscribe('sleep2mqtt/control'.encode())
-    client.subscribe('hass/status'.encode())
+    mqtt_connecting = True
+    connect_started = utime.ticks_ms()
+    client.connect_start()
+
+
+def mqtt_connect_step():
+    # returns True once connected. raises when the broker refuses, or doesn't
+    # finish within CONNECT_TIMEOUT_MS
+    global mqtt_connecting
+    global mqtt_connected
+    global mqtt_poller
+
+    if not client.connect_poll():
+        if utime.ticks_diff(utime.ticks_ms(), connect_started) > CONNECT_TIMEOUT_MS:
+            raise OSError('broker did not answer in {} ms'.format(CONNECT_TIMEOUT_MS))
+        return False
+    # the SUBACKs are picked up by check_msg like anything else
+    client.subscribe('sleep2mqtt/control'.encode(), wait=False)
+    client.subscribe('hass/status'.encode(), wait=False)
+    mqtt_poller = uselect.poll()
+    mqtt_poller.register(client.sock, uselect.POLLIN | uselect.POLLOUT)
+    mqtt_connecting = False
+    mqtt_connected = True
+    return True
+
+
+def mqtt_disconnected():
+    # stop publishing directly, close the old socket and schedule a reconnect attempt
+    global mqtt_connected
+    global mqtt_connecting
+    mqtt_connected = False
+    mqtt_connecting = False
+    if client is not None:
+        # transitions that were sent but never acked go out again after the reconnect
+        if client.inflight:
+            outbox.requeue([entry[1:3] for entry in client.inflight])
+            client.inflight = []
+        if client.sock is not None:
+            try:
+                client.sock.close()
+            except Exception:
+                pass
+    mqtt_backoff.failed()
 
 
-def publish_mqtt(message, sensor=None, topic=None, raw=False):
+def reconnect_mqtt():
+    # one attempt each time the backoff runs out. an attempt takes a few passes,
+    # each one only does what the socket is ready for
+    try:
+        if not mqtt_connecting:
+            if not mqtt_backoff.ready():
+                return
+            mqtt_connect()
+        if not mqtt_connect_step():
+            return
+    except Exception as e:
+        log('Exception trying reconnect to mqtt: {}'.format(e), ERROR)
+        diagnostics.connect_failures += 1
+        mqtt_disconnected()
+        return
+
+    mqtt_backoff.reset()
+    if boot_stage == 'mqtt':
+        # the first connect, boot_step() sends what's queued once it's up to date
+        return
+    diagnostics.reconnects += 1
+    log('Successful reconnecting to MQTT')
+    drain_outbox()
+
+
+def drain_outbox():
+    # replay everything queued while the broker was away
+    try:
+        sent = outbox.drain(send_mqtt)
+    except Exception as e:
+        log('Exception draining outbox: {}'.format(e), ERROR)
+        mqtt_disconnected()
+        return
+    # in async mode everything goes through the outbox, that's not news
+    if sent and not queue_only:
+        log('published {} queued messages'.format(sent))
+
+
+def send_queued():
+    # about to restart, send what's queued with plain blocking writes. in the
+    # asyncio runtime publishes only queue, the mqtt task would never get to them
+    global mqtt_writes
+    if mqtt_connected and outbox.pending():
+        mqtt_writes = None
+        drain_outbox()
+
+
+def send_mqtt(topic, msg, critical=False):
+    # critical messages (occupancy transitions) go at QoS 1 without waiting for
+    # the PUBACK, returns False when the in-flight window is full and it has to wait
+    if critical and len(client.inflight) >= qos_window:
+        return False
+    if not mqtt_ready():
+        return False
+    start = utime.ticks_us()
+    # sensor topics and discovery configs are already bytes
+    if isinstance(topic, str):
+        topic = topic.encode()
+    if isinstance(msg, str):
+        msg = msg.encode()
+    if critical:
+        client.publish(topic, msg, retain=True, qos=1, wait=False)
+    else:
+        client.publish(topic, msg, retain=True)
+    diagnostics.lap('publish', start)
+    return True
+
+
+def send_raw():
+    # raw frames go at QoS 0 and aren't retained. they never go through the
+    # outbox, while the broker is away each stream drops its own oldest frames
+    for sensor in BedSensor.sensors():
+        stream = sensor.stream
+        if stream is None:
+            continue
+        frame = stream.next()
+        while frame is not None:
+            if not mqtt_ready():
+                return
+            client.publish(stream.topic, frame)
+            stream.done()
+            frame = stream.next()
+
+
+def publish_diagnostics():
+    # loop timing, heap and connection health for this device
+    message = diagnostics.report()
+    message['outbox'] = outbox.pending()
+    message['dropped'] = outbox.dropped
+    message['state_file'] = BedSensor.store.stats()
+    message['config_writes'] = config_store.writes
+    streams = [sensor.stream for sensor in BedSensor.sensors() if sensor.stream is not None]
+    if streams:
+        message['raw_frames'] = sum(stream.sent for stream in streams)
+        message['raw_dropped'] = sum(stream.dropped for stream in streams)
+    publish_mqtt(message, topic='sleep2mqtt/{}/diagnostics'.format(config['settings']['mqtt_clientid']))
+
+
+def publish_mqtt(message, sensor=None, topic=None, raw=False, critical=False):
+    # publish right away when connected, otherwise queue in the outbox
+    # critical messages (occupancy transitions) are never dropped from the outbox
     if topic is None:
-        topic = "sleep2mqtt/{}".format(sensor.name)
-    # retry logic range() times with fib backoff
+        topic = sensor.topic
     if raw:
         msg = message
     else:
         msg = json.dumps(message)
 
-    for retry in range(2):
-        try:
-            client.publish(topic.encode(), msg.encode(), retain=True)
-            if sensor is not None:
-                sensor.timestamp(True)
-            return True
-        except Exception as e:
-            log('Exception trying to publish update: {}'.format(e))
-            utime.sleep(2)
+    if sensor is not None:
+        # queued counts too, so the 30s updates don't pile up while offline
+        sensor.timestamp(True)
 
-    # only get here after retries
-    # attempt to disconnect and reconnect to MQTT
-    for retry in range(2):
+    # in async mode everything goes through the outbox for the mqtt task
+    if not queue_only and mqtt_connected and not outbox.pending():
         try:
-            mqtt_connect()
-            success = publish_mqtt(message, sensor, topic)
-            if success:
-                log('Successful reconnecting to MQTT')
+            if send_mqtt(topic, msg, critical):
                 return True
-            else:
-                log('NOT successful reconnecting to MQTT')
-                network_setup()
         except Exception as e:
-            log('Exception trying reconnect to mqtt: {}'.format(e))
-            utime.sleep(fib(retry))
-
-    # if all else fails
-    log('Failed attempts to reconnect, rebooting...')
-    restart_and_reconnect()
-
-
-def update_mqtt_attributes(sensor):
-    message = {
-        "occupancy": sensor.state(),
-        "pressure": "{:0.2f}".format(sensor.value),
-        "avg_off": "{:0.2f}".format(sensor.history["off_avg"]),
-        "avg_on": "{:0.2f}".format(sensor.history["on_avg"]),
-        "ideal_pressure": sensor.ideal_pressure,
-        "delta": sensor.delta,
-        "last_seen": current_time()
-        }
-    result = publish_mqtt(message, sensor=sensor)
+            log('Exception trying to publish update: {}'.format(e), ERROR)
+            mqtt_disconnected()
+
+    if isinstance(msg, memoryview):
+        # the buffer behind it gets reused, the outbox needs its own copy
+        msg = bytes(msg)
+    outbox.put(topic, msg, critical)
+    return False
+
+
+def update_mqtt_attributes(sensor, critical=False):
+    on_avg = sensor.history["on"].avg
+    off_avg = sensor.history["off"].avg
+    message = ATTRIBUTES.format(
+        "true" if sensor.current_state else "false",
+        sensor.percent(sensor.value),
+        sensor.percent(off_avg),
+        sensor.percent(on_avg),
+        sensor.ideal_pressure,
+        sensor.delta,
+        current_time())
+    sensor.published = (sensor.current_state, sensor.value, on_avg, off_avg,
+        sensor.ideal_pressure, sensor.delta)
+    result = publish_mqtt(message, sensor=sensor, raw=True, critical=critical)
     return result
 
 
@@ -738,58 +2353,63 @@ def update_mqtt_attributes(sensor):
 ##################################
 
 
+def import_display():
+    # the display stack is only loaded on an M5Stack
+    global lcd
+    global M5TextBox
+    global btnA
+    global btnB
+    global btnC
+    from m5ui import lcd, M5TextBox, btnA, btnB, btnC
+
+
+def setup_screen():
+    # draw sleep2mqtt header to screen and create the status lines
+    global brightness
+    global display
+
+    import_display()
+
+    brightness = config['settings']['brightness']
+    lcd.setBrightness(brightness)
+    
+    lcd.setRotation(1)
+    
+    M5TextBox(0, 2, 'sleep2mqtt by hobbysprawl', lcd.FONT_DejaVu18,0xFFFFFF, rotate=0)
+    M5TextBox(0, 22, 'Adaptive Bed Sensor', lcd.FONT_DejaVu18,0xFFFFFF, rotate=0)
+    
+    for i in range(42, 46):
+        lcd.drawLine(0,i,320,i)
+
+    display = Display(BedSensor.sensors())
+    
+    # register button callbacks
+    btnA.wasPressed(buttonA_wasPressed)
+    btnB.wasPressed(buttonB_wasPressed)
+    btnC.wasPressed(buttonC_wasPressed)
+
+    # # register button callbacks
+    # btnA = Pin(39, Pin.IN, handler=buttonA_wasPressed, trigger=Pin.IRQ_FALLING, debounce= 500)
+    # btnB = Pin(38, Pin.IN, handler=buttonB_wasPressed, trigger=Pin.IRQ_FALLING, debounce= 500)
+    # btnC = Pin(37, Pin.IN, handler=buttonC_wasPressed, trigger=Pin.IRQ_FALLING, debounce= 500)
+
+
 def update_screen():
-    # update screen with useful data
+    # update screen with useful data, only lines that changed get redrawn
     if brightness > 0:
-        i = 50 # increment
-        h = 20 # line height
-        for sensor in BedSensor.sensors():
-            # sensor name label
-            M5TextBox(0, i, "{}:".format(
-                sensor.name.split(' ')[0]),
-                lcd.FONT_DejaVu18,
-                0xFFFFFF,
-                rotate=0)
-
-            # move down 1 line
-            i = i+h
-            # erase previous pressure value
-            M5Rect(0, i, 320, h, 0x000000, 0x000000)
-            # format and write pressure reading
-            line = '  p: {}%'.format(sensor.p_value)
-            M5TextBox(0, i, line, lcd.FONT_DejaVu18,0xFFFFFF, rotate=0)
-            # move down 1 line
-            i = i+h
-            # erase previous occupancy
-            M5Rect(0, i, 320, h, 0x000000, 0x000000)
-            # format and write occupancy value
-            if sensor.state():
-                M5TextBox(0, i, '  occupied', lcd.FONT_DejaVu18,0xFFFFFF, rotate=0)
-            else:
-                M5TextBox(0, i, '  vacant', lcd.FONT_DejaVu18,0xFFFFFF, rotate=0)
-            # move to next line
-            i = i+h
-            # erase previous data
-            M5Rect(0, i, 320, h, 0x000000, 0x000000)
-            M5TextBox(0, i, '  on: {:0.2f} / off: {:0.2f}'.format(
-                sensor.history['on_avg'],
-                sensor.history['off_avg']),
-                lcd.FONT_DejaVu18,0xFFFFFF,
-                rotate=0)
-            i = i+h
+        display.refresh()
+    else:
+        # the backlight is off, redraw everything once it comes back
+        display.invalidate()
 
 
 def update_sensor(sensor, push=False):
     # the sensor.read() method determines state and stores sensor values
     state_changed = sensor.read()
 
-    # always push to mqtt if it's been more than 30s
-    if utime.time() - sensor.timestamp() > 30:
-        push = True
-
-    # update mqtt state/attributes topic for HA
-    if state_changed or push:
-        update_mqtt_attributes(sensor)
+    # update mqtt state/attributes topic for HA when the publish policy says so
+    if push or policy.due(sensor, state_changed):
+        update_mqtt_attributes(sensor, critical=state_changed)
 
 
 def bed_sensor_loop():
@@ -798,73 +2418,281 @@ def bed_sensor_loop():
 
     log('Running infinite sensor loop')
 
+    # sensors are read whenever their cadence says so, everything else runs
+    # once a second on the pass
+    cadence = BedSensor.cadence
+    next_pass = utime.ticks_ms()
     while True:
+        now = utime.ticks_ms()
+        start = mark = utime.ticks_us()
+
+        sampled = False
         for sensor in BedSensor.sensors():
-            update_sensor(sensor)
+            if cadence.due(sensor, now):
+                update_sensor(sensor)
+                sampled = True
+        if sampled:
+            mark = diagnostics.lap('sample', mark)
+
+        if utime.ticks_diff(now, next_pass) >= 0:
+            next_pass = utime.ticks_add(next_pass, 1000)
+            if utime.ticks_diff(next_pass, now) <= 0:
+                # fell more than a pass behind, don't try to catch up
+                next_pass = utime.ticks_add(now, 1000)
+
+            if config['settings']['m5stack']:
+                update_screen()
+                mark = diagnostics.lap('screen', mark)
+
+            # look for control topic messages, publish anything queued
+            check_mqtt()
+            mark = diagnostics.lap('mqtt', mark)
+
+            # write out sensor state, config changes and buffered log lines when they're due
+            BedSensor.store.flush()
+            config_store.flush()
+            if logger is not None:
+                logger.flush()
+            mark = diagnostics.lap('sd', mark)
+
+            # garbage collect
+            gc.collect()
+            free = gc.mem_free()
+            gc.threshold(free // 4 + gc.mem_alloc())
+            mark = diagnostics.lap('gc', mark)
+
+            diagnostics.loop(utime.ticks_diff(mark, start), free)
+            if diagnostics.ready():
+                publish_diagnostics()
+
+        # take a nap until the next sensor read or pass, you worked hard
+        now = utime.ticks_ms()
+        utime.sleep_ms(min(cadence.wake(now), max(0, utime.ticks_diff(next_pass, now))))
 
-        if config['settings']['m5stack']:
-            update_screen()
 
-        # look for control topic messages
-        check_mqtt()
+##################################
+###
+###     ASYNC RUNTIME
+###     same work as bed_sensor_loop, split into cooperative tasks. the
+###     broker socket is only used when a poll says it's ready, and sd card
+###     writes hand the event loop back between operations
+###
+##################################
+
+
+async def sensor_task(sensor):
+    # sample and detect, publishes only go into the outbox from here
+    while True:
+        mark = utime.ticks_us()
+        update_sensor(sensor)
+        diagnostics.lap('sample', mark)
+        # the cadence picks the next read, fast while something is happening
+        await asyncio.sleep(sensor.period / 1000)
+
+
+async def mqtt_task():
+    # drain the outbox, look for control topic messages and reconnect when needed.
+    # one write per pass, a pass that used it comes straight back for the next
+    while True:
+        mark = utime.ticks_us()
+        check_mqtt(writes=1)
+        diagnostics.lap('mqtt', mark)
+        await asyncio.sleep(0 if mqtt_writes == 0 else 0.1)
+
+
+async def display_task():
+    while True:
+        mark = utime.ticks_us()
+        update_screen()
+        diagnostics.lap('screen', mark)
+        await asyncio.sleep(1)
+
+
+async def persistence_task():
+    # write out sensor state when it's due, keep the heap tidy and report diagnostics
+    # waking late from the one second sleep means some task held the event loop,
+    # this task's own sd and gc time are laps of their own
+    while True:
+        mark = utime.ticks_us()
+        await asyncio.sleep(1)
+        start = utime.ticks_us()
+        lag = utime.ticks_diff(start, mark) - 1000000
+        mark = start
+
+        for step in BedSensor.store.flushing():
+            await asyncio.sleep(0)
+        config_store.flush()
+        if logger is not None:
+            await asyncio.sleep(0)
+            for step in logger.flushing():
+                await asyncio.sleep(0)
+        mark = diagnostics.lap('sd', mark)
 
-        # garbage collect
         gc.collect()
-        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+        free = gc.mem_free()
+        gc.threshold(free // 4 + gc.mem_alloc())
+        mark = diagnostics.lap('gc', mark)
+
+        diagnostics.loop(max(0, lag), free)
+        if diagnostics.ready():
+            publish_diagnostics()
 
-        # take a nap, you worked hard
-        utime.sleep(1)
+
+async def run_tasks():
+    global queue_only
+    queue_only = True
+    if logger is not None:
+        logger.deferred = True
+
+    tasks = [asyncio.create_task(mqtt_task()), asyncio.create_task(persistence_task())]
+    for sensor in BedSensor.sensors():
+        update_mqtt_attributes(sensor)
+        tasks.append(asyncio.create_task(sensor_task(sensor)))
+    if config['settings']['m5stack']:
+        tasks.append(asyncio.create_task(display_task()))
+
+    log('Running async sensor tasks')
+    await asyncio.gather(*tasks)
 
 
 def main():
 
+    started = utime.ticks_ms()
     print('booting sleep2mqtt bed sensor')
     global config
     global config_file
     global client
+    global queue_only
+    global logger
+    global config_store
+    global outbox
+    global config_json
+    global mqtt_connected
+    global mqtt_connecting
+    global connect_started
+    global mqtt_poller
+    global mqtt_writes
+    global mqtt_backoff
+    global wifi_backoff
+    global ntp_backoff
+    global keepalive_ms
+    global qos_window
+    global qos_timeout_ms
+    global clock_synced
+    global ntp_socket
+    global ntp_started
+    global policy
+    global diagnostics
+    global boot_stage
 
     # global config vars
     config_file='/sd/config.json'
     config = {}
+    # sd card log sink, created once the config is loaded
+    logger = None
+    # debounced config.json saves from mqtt commands
+    config_store = None
 
     # global mqtt client object
     client = None
+    mqtt_connected = False
+    # a non-blocking broker connect is under way, see mqtt_connect()
+    mqtt_connecting = False
+    connect_started = 0
+    # polls the broker socket for the asyncio runtime, see mqtt_ready()
+    mqtt_poller = None
+    mqtt_writes = None
+    clock_synced = False
+    # an ntp query waiting on its reply, see sync_clock()
+    ntp_socket = None
+    ntp_started = 0
+    # publish_mqtt only queues in async mode, the mqtt task does the sending
+    queue_only = False
+    # network setup runs in steps from check_mqtt, None once it's all done
+    boot_stage = 'wifi'
 
     # for config, state, and data logging
     mount_sd()
 
     # load configuration from SD card into global config dictonary
     load_config()
+    config_store = ConfigStore(settle=config['settings'].get('config_settle', 5))
+
+    if config['settings']['logging']:
+        logger = LogSink(
+            level=LOG_LEVELS.get(config['settings'].get('log_level', 'info'), INFO),
+            max_size=config['settings'].get('log_size', 65536),
+            files=config['settings'].get('log_files', 2))
+
+    # loop timing and health, published to sleep2mqtt/<clientid>/diagnostics
+    diagnostics = Diagnostics(
+        interval=config['settings'].get('diagnostics_interval', 300),
+        started=started)
+    diagnostics.phase('config')
+
+    # detection in hundredths of a percent as small ints instead of floats
+    if config['settings'].get('fixed_point'):
+        BedSensor.scale = 100
+
+    # when sensor state topics get published, the deadband is in the sensors' units
+    deadband = config['settings'].get('publish_deadband', 0.5)
+    if BedSensor.scale:
+        deadband = int(round(deadband * BedSensor.scale))
+    policy = PublishPolicy(
+        interval=config['settings'].get('publish_interval', 30),
+        heartbeat=config['settings'].get('publish_heartbeat', 300),
+        deadband=deadband)
+
+    # config topic payloads are serialized here, kept between publishes
+    config_json = JsonBuffer()
+
+    # publishes wait here while the broker is unreachable
+    outbox = Outbox(
+        size=config['settings'].get('outbox_size', 32),
+        spill='/sd/outbox.txt' if config['settings'].get('outbox_spill') else None)
+
+    # reconnect timing for wifi, the broker and ntp, and how often to ping the broker
+    mqtt_backoff = Backoff(base_ms=1000, cap_ms=60000)
+    wifi_backoff = Backoff(base_ms=15000, cap_ms=120000)
+    ntp_backoff = Backoff(base_ms=60000, cap_ms=3600000)
+    keepalive_ms = config['settings'].get('mqtt_keepalive', 60) * 1000
+    if 0 < keepalive_ms < KEEPALIVE_MIN_MS:
+        # the ping reply is only read once a pass, a shorter keepalive would
+        # time out before it's seen
+        log('mqtt_keepalive raised to {} s'.format(KEEPALIVE_MIN_MS // 1000), WARNING)
+        keepalive_ms = KEEPALIVE_MIN_MS
+    # occupancy transitions go at QoS 1, this many unacknowledged at a time
+    qos_window = config['settings'].get('qos_window', 4)
+    qos_timeout_ms = config['settings'].get('qos_timeout', 10) * 1000
+
+    # start joining wifi, ntp and mqtt follow from the loop once it's up
+    start_wifi()
+
+    # timer driven sampling, one reading per decimation period. by default a
+    # period is read_fast_ms long, so fast reads always find a new reading
+    sample_rate = config['settings'].get('sample_rate')
+    fast_ms = config['settings'].get('read_fast_ms', 100)
+    if sample_rate:
+        # the timer runs in whole ms, so the rate it really samples at is what
+        # decimation has to be worked out from
+        sample_ms = 1000 // max(1, min(1000, sample_rate))
+        if sample_ms * sample_rate != 1000:
+            log('sample_rate of {} runs at {:.1f} Hz, one sample every {} ms'.format(
+                sample_rate, 1000 / sample_ms, sample_ms), WARNING)
+        decimation = config['settings'].get('sample_decimation', max(1, fast_ms // sample_ms))
+        if decimation * sample_ms > fast_ms:
+            log('sample_decimation gives a new reading every {} ms, read_fast_ms of {} '
+                'will mostly find nothing new'.format(decimation * sample_ms, fast_ms), WARNING)
+    else:
+        decimation = None
 
-    # wifi setup and creation of mqtt client
-    network_setup()
-
-    # draw sleep2mqtt header to screen
-    if config['settings']['m5stack']:    
-        # from m5ui import M5TextBox, M5Rect, btnA, btnB, btnC,lcd
-        from m5ui import *
-
-        global brightness
-        brightness = config['settings']['brightness']
-        lcd.setBrightness(brightness)
-        
-        lcd.setRotation(1)
-        
-        M5TextBox(0, 02, 'sleep2mqtt by hobbysprawl', lcd.FONT_DejaVu18,0xFFFFFF, rotate=0)
-        M5TextBox(0, 22, 'Adaptive Bed Sensor', lcd.FONT_DejaVu18,0xFFFFFF, rotate=0)
-        
-        for i in range(42, 46):
-            lcd.drawLine(0,i,320,i)
-        
-        # register button callbacks
-        btnA.wasPressed(buttonA_wasPressed)
-        btnB.wasPressed(buttonB_wasPressed)
-        btnC.wasPressed(buttonC_wasPressed)
+    # one state file writer shared by all sensors
+    BedSensor.store = StateStore(interval=config['settings'].get('state_interval', 300))
 
-        # # register button callbacks
-        # btnA = Pin(39, Pin.IN, handler=buttonA_wasPressed, trigger=Pin.IRQ_FALLING, debounce= 500)
-        # btnB = Pin(38, Pin.IN, handler=buttonB_wasPressed, trigger=Pin.IRQ_FALLING, debounce= 500)
-        # btnC = Pin(37, Pin.IN, handler=buttonC_wasPressed, trigger=Pin.IRQ_FALLING, debounce= 500)
+    # sensors are read fast while something is happening and slowly otherwise
+    BedSensor.cadence = Cadence(
+        fast_ms=fast_ms,
+        slow_ms=config['settings'].get('read_slow_ms', 2000))
 
     # create bed sensors from config
     for sensor, value in config['sensors'].items():
@@ -872,23 +2700,37 @@ def main():
             name = '{} Bed Occupancy'.format(sensor),
             pin = value['pin'],
             ideal_pressure= value['ideal_pressure'],
-            delta = value['delta'])
+            delta = value['delta'],
+            history_size = value.get('history_size', 10),
+            decimation = decimation,
+            key = sensor)
+        # raw readings for tuning, off unless asked for
+        if config['settings'].get('raw_stream'):
+            s.stream = RawStream(
+                'sleep2mqtt/{}/raw/{}'.format(config['settings']['mqtt_clientid'], sensor).encode(),
+                samples=config['settings'].get('raw_samples', 32),
+                frames=config['settings'].get('raw_frames', 4))
+
+    if sample_rate:
+        Sampler.start(sample_ms)
 
     # set sensitivity, 1-10 to trigger state change
     BedSensor.set_sensitivity(config['settings']['state_sensitivity'])
+    diagnostics.phase('sensors')
 
-    # create and publish home assistant configs to mqtt
-    create_ha_configs()
+    # draw sleep2mqtt header to screen
+    if config['settings']['m5stack']:
+        setup_screen()
+        diagnostics.phase('screen')
 
-    # subscribe to control topic
-    try:
-        client.subscribe('sleep2mqtt/control'.encode())
-    except Exception as e:
-        log('error subscribing to mqtt: {}'.format(e))
-        restart_and_reconnect()
+    # build home assistant configs, boot_step() publishes them after the first states
+    create_ha_configs()
 
-    # run the infinite bed controller loop
-    bed_sensor_loop()
+    # run the infinite bed controller loop, or the async tasks
+    if config['settings'].get('runtime') == 'asyncio':
+        asyncio.run(run_tasks())
+    else:
+        bed_sensor_loop()
 
 
 if __name__ == '__main__':